@@ -4,7 +4,7 @@ from imblearn.over_sampling import SMOTE
 from torch.utils.data import Dataset
 import torch.nn.functional as F
 
-from learning_utils import interpolate_epochs_nan
+from utils import interpolate_epochs
 
 
 class EpochDatset(Dataset):
@@ -15,7 +15,7 @@ class EpochDatset(Dataset):
         Args:
 
         """
-        self.X = interpolate_epochs_nan(np.load(data_path))  # remove nan
+        self.X, _ = interpolate_epochs(np.load(data_path))  # remove nan
         assert np.sum(np.isnan(self.X)) == 0
 
         self.X = np.mean(self.X, axis=1)
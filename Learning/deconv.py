@@ -1,11 +1,10 @@
 import mne
 import scipy
-import torch
 import numpy as np
 from matplotlib import pyplot as plt
 from scipy import stats
-from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import StandardScaler
+
+from Learning.deconv_utils import cross_validate_ridge, overlap_corrected_epochs, ChannelNormalizer
 
 
 def plot_design_matrix(dms, deconv_window, tau, covariates, num=0):
@@ -21,17 +20,6 @@ def plot_design_matrix(dms, deconv_window, tau, covariates, num=0):
             break
 
 
-def z_norm_by_channel(X):
-    scalers = {}
-    X_out = np.empty(X.shape)
-    for i in range(X.shape[2]):
-        scalers[i] = StandardScaler()
-        X_out[:, :, i] = scalers[i].fit_transform(X[:, :, i].reshape(-1, 1)).reshape(data.shape[:2])
-        # this_x_ch = X[:, :, i]
-        # X_out[:, :, i] = (this_x_ch - np.mean(this_x_ch)) / np.std(this_x_ch)
-        # scalers[i] = [ np.mean(this_x_ch),  np.std(this_x_ch)]
-    return X_out, scalers
-
 def create_dm_for_cov(dms, tau, cov_index, deconv_window, srate):
     out = np.zeros(dms.shape[1:])
     dm_start_index = int(-deconv_window[0] * srate), cov_index * tau
@@ -39,48 +27,6 @@ def create_dm_for_cov(dms, tau, cov_index, deconv_window, srate):
         out[dm_start_index[0] + i, dm_start_index[1] + i] = 1
     return out[None, :]
 
-def ridge_regression_gd(X, Y, X_test, Y_test, lamb, learning_rate=1., iterations=400, device='cuda', dtype=torch.float32):
-    X = torch.tensor(X, device=device, dtype=dtype)
-    Y = torch.tensor(Y, device=device, dtype=dtype)
-    X_test = torch.tensor(X_test, device=device, dtype=dtype)
-    Y_test = torch.tensor(Y_test, device=device, dtype=dtype)
-
-    weights = torch.randn((X.shape[2], Y.shape[2]), device=device, dtype=dtype, requires_grad=True)
-    bias = torch.randn(Y.shape[1:], device=device, dtype=dtype, requires_grad=True)
-    losses_train = []
-    losses_test = []
-
-    loss_func = torch.nn.L1Loss()
-    optimizer = torch.optim.SGD(params=[weights, bias], lr=learning_rate, momentum=0.9)
-    # optimizer = torch.optim.SGD(params=[weights], lr=learning_rate, momentum=0.9)
-
-    # main training loop
-    for k in range(iterations):
-        optimizer.zero_grad()
-        # Y_pred = (torch.matmul(X, weights))
-        Y_pred = (torch.matmul(X, weights) + bias)
-        loss = loss_func(Y, Y_pred)
-        l2_norm = sum(p.pow(2.0).sum() for p in weights) + sum(b.pow(2.0).sum() for b in bias)
-        loss = loss + lamb * l2_norm
-        if np.isnan(loss.item()):
-            print("Warning: GD diverged on iteration %i" % k)
-            break
-        losses_train.append(loss.item())
-        loss.backward()
-        optimizer.step()
-
-        with torch.no_grad():
-            Y_test_pred = (torch.matmul(X_test, weights) + bias)
-            # Y_test_pred = (torch.matmul(X_test, weights))
-            loss_test = loss_func(Y_test, Y_test_pred)
-            losses_test.append(loss_test.item())
-
-        print("Iteration %d, training loss: %.6f, test loss: %.6f"% (k, loss.item(), loss_test.item()))
-
-    return weights, bias, losses_train, losses_test
-    # return weights, [], losses_train, losses_test
-
-
 # path to data and design matrix
 covariates = {'Distractor':1, 'Target':2, 'Novelty':3}
 color_dict = {'Target': 'red', 'Distractor': 'blue', 'Novelty': 'green'}
@@ -104,16 +50,14 @@ epoch_label_path = 'C:/Users/S-Vec/Dropbox/ReNa/Data/ReNaPilot-2022Spring/Subjec
 
 srate = 128
 deconv_window = (-1.2, 2.4)
-frp_window=(0., .8)
 viz_window=(0., .8)
 
 manual_seed = 42
+lambdas = np.logspace(-3, 3, 13)  # ridge penalties to cross-validate
+n_folds = 5
 
 viz_index_window = [int(srate * (-deconv_window[0] + viz_window[0])), int(srate * (-deconv_window[0] + viz_window[1]))]
 # viz_index_window = [0, int(srate * (-deconv_window[0] + deconv_window[1]))]
-frp_index_window = [int(srate * (-deconv_window[0] + frp_window[0])), int(srate * (-deconv_window[0] + frp_window[1]))]
-
-torch.manual_seed(manual_seed)
 
 # load data and change axes
 data = np.load(epoch_data_path)
@@ -129,37 +73,33 @@ tau = int(dms.shape[-1] /  len(covariates))
 print('Distractor, Target, Novelty prevalence: %f, %f, %f' % (np.sum(labels==1)/len(labels), np.sum(labels==2)/len(labels), np.sum(labels==3)/len(labels)))
 
 # z normalize data along channel
-data_znormed, scalars = z_norm_by_channel(data)
-dms_train, dms_test, data_znormed_train, data_znormed_test = train_test_split(dms, data_znormed, test_size=0.01, random_state=manual_seed)
-
-beta, error, losses_train, losses_test = ridge_regression_gd(X=dms_train, Y=data_znormed_train, X_test=dms_test, Y_test=data_znormed_test, lamb=1e-1)
+normalizer = ChannelNormalizer(channel_axis=-1).fit(data)
+data_znormed = normalizer.transform(data)
+best_lamb, fold_losses, beta, error = cross_validate_ridge(dms, data_znormed, lambdas, n_folds=n_folds, random_state=manual_seed)
+print('Best lambda from {0}-fold cross-validation: {1}'.format(n_folds, best_lamb))
 
 eeg_chs = mne.channels.make_standard_montage('biosemi64').ch_names
 eeg_ch = 'CPz'
 eeg_index = eeg_chs.index(eeg_ch)
 
-plt.plot(losses_train, label='Train loss')
-plt.plot(losses_test, label='Test loss')
-plt.xlabel("Epoch")
+fold_losses_mean = np.mean(fold_losses, axis=0)
+fold_losses_sem = scipy.stats.sem(fold_losses, axis=0)
+plt.fill_between(lambdas, fold_losses_mean - fold_losses_sem, fold_losses_mean + fold_losses_sem, alpha=0.5)
+plt.plot(lambdas, fold_losses_mean, 'o-', label='Test loss')
+plt.axvline(best_lamb, color='red', linestyle='--', label='Best lambda')
+plt.xscale('log')
+plt.xlabel("Lambda")
 plt.ylabel("Loss")
-plt.ylim(0,1.2)
-plt.title('Losses')
+plt.title('{0}-fold cross-validated losses'.format(n_folds))
+plt.legend()
 plt.show()
 
-# data_recon = torch.matmul(torch.tensor(dms, device='cuda', dtype=torch.float64), beta) + error.expand(data.shape[1], data.shape[2])
-# data_recon = data_recon.cpu().detach().numpy()
-# data_recon = data_recon[:, viz_deconv_index_window[0]:viz_deconv_index_window[1], eeg_index]
-# data_recon = scalars[eeg_index].inverse_transform(data_recon)
-
 # plotting covariate betas
 plt.rcParams["figure.figsize"] = (12.8, 7.2)
 for cov, cov_code in covariates.items():
     dm_cov =  create_dm_for_cov(dms, tau, cov_code-1, deconv_window, srate)  # cov_code - 1 because distractor starts at 1
-    # cov_beta = torch.matmul(torch.tensor(dm_cov, device='cuda', dtype=torch.float32), beta) + error.expand(data.shape[0], -1, -1)
-    cov_beta = torch.matmul(torch.tensor(dm_cov, device='cuda', dtype=torch.float32), beta)
-    cov_beta = cov_beta.cpu().detach().numpy()
-    cov_beta = cov_beta[:, viz_index_window[0]:viz_index_window[1], eeg_index]
-    cov_beta = scalars[eeg_index].inverse_transform(cov_beta)[0]
+    cov_beta = normalizer.inverse_transform(np.matmul(dm_cov, beta))
+    cov_beta = cov_beta[0, viz_index_window[0]:viz_index_window[1], eeg_index]
 
     time_vector = np.linspace(viz_window[0], viz_window[1], cov_beta.shape[0])
     plt.plot(time_vector, cov_beta, label='Estimated Beta Coefficient for Cov {0}'.format(cov))
@@ -180,23 +120,17 @@ for cov, cov_code in covariates.items():
     plt.show()
 
 # plot deconv corrected FRP
+data_corrected, corrected_stats = overlap_corrected_epochs(data, dms, labels, beta, error, list(covariates.values()),
+                                                           onset_index=int(-deconv_window[0] * srate),
+                                                           index_window=viz_index_window,
+                                                           channel_mean=normalizer.mean, channel_std=normalizer.std)
+time_vector = np.linspace(viz_window[0], viz_window[1], data_corrected.shape[1])
 for cov, cov_code in covariates.items():
     data_orig = data[:, viz_index_window[0]:viz_index_window[1], eeg_index][labels == cov_code]
-    dm_orig = dms[:, viz_index_window[0]:viz_index_window[1], :][labels == cov_code]
-
-    data_corrected = []
-    for d, dm in zip(data_orig, dm_orig):  # remove the other overlapping signals
-        dm_other = dm.copy()
-        dm_other[frp_index_window[0]:frp_index_window[1]] = 0
-        weights_other = torch.matmul(torch.tensor(dm_other, device='cuda', dtype=torch.float32), beta[:, eeg_index]) + error[viz_index_window[0]:viz_index_window[1], eeg_index]
-        weights_other = weights_other.cpu().detach().numpy()
-        weights_other_rescaled = scalars[eeg_index].inverse_transform(weights_other.reshape(1, -1))[0]
-        data_corrected.append(d - weights_other_rescaled)
-    time_vector = np.linspace(viz_window[0], viz_window[1], weights_other.shape[0])
-    data_corrected = np.array(data_corrected)
-    data_corrected_mean = np.mean(data_corrected, axis=0)
-    data_corrected_upper = data_corrected_mean + scipy.stats.sem(data_corrected, axis=0)  # this is the upper envelope
-    data_corrected_lower = data_corrected_mean - scipy.stats.sem(data_corrected, axis=0)  # this is the lower envelope
+
+    data_corrected_mean = corrected_stats[cov_code][0][:, eeg_index]
+    data_corrected_upper = data_corrected_mean + corrected_stats[cov_code][1][:, eeg_index]  # this is the upper envelope
+    data_corrected_lower = data_corrected_mean - corrected_stats[cov_code][1][:, eeg_index]  # this is the lower envelope
     plt.fill_between(time_vector, data_corrected_upper, data_corrected_lower, where=data_corrected_lower <= data_corrected_upper, facecolor='blue',
                      interpolate=True,
                      alpha=0.5)
@@ -213,9 +147,3 @@ for cov, cov_code in covariates.items():
     plt.legend()
     plt.title('{0} on Channel {1}'.format(cov, eeg_ch))
     plt.show()
-
-
-# dm_copy = dm.copy()
-# dm_copy[frp_index_window[0]:frp_index_window[1]] = 0
-# plt.imshow(dm_copy)
-# plt.show()
\ No newline at end of file
@@ -0,0 +1,298 @@
+import inspect
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.linalg
+import scipy.sparse
+import scipy.sparse.linalg
+import scipy.stats
+from sklearn.model_selection import KFold
+
+# the relative tolerance of cg is tol before scipy 1.12 and rtol since
+_CG_RTOL_KEYWORD = 'rtol' if 'rtol' in inspect.signature(scipy.sparse.linalg.cg).parameters else 'tol'
+
+
+def _ridge_sufficient_statistics(X, Y):
+    """
+    :param X: design matrices of shape (epochs, time, features)
+    :param Y: data of shape (epochs, time, channels)
+    :return: the gram matrix X^T X, X^T Y, and the sums of X and Y over the epochs
+    """
+    X_flat = X.reshape(-1, X.shape[-1])
+    Y_flat = Y.reshape(-1, Y.shape[-1])
+    return X_flat.T @ X_flat, X_flat.T @ Y_flat, X.sum(axis=0), Y.sum(axis=0)
+
+
+def ridge_regression_direct(X, Y, X_test, Y_test, lamb, dtype=np.float64):
+    """
+    direct solver of Y = X @ weights + bias, with an L2 penalty of lamb on both the weights and the bias, bias has one
+    value per time point and channel
+    the bias is eliminated with its Schur complement, leaving a (features x features) system that is solved with a
+    Cholesky factorization for all the channels at once, on CPU
+    :param X: design matrices of shape (epochs, time, features)
+    :param Y: data of shape (epochs, time, channels)
+    :return: weights (features, channels), bias (time, channels), and the train and test losses (mean absolute error,
+    the train loss includes the L2 penalty), as one-element lists
+    """
+    X, Y = np.asarray(X, dtype=dtype), np.asarray(Y, dtype=dtype)
+    gram, XtY, X_sum, Y_sum = _ridge_sufficient_statistics(X, Y)
+    num_epochs = X.shape[0]
+
+    # bias = (Y_sum - X_sum @ weights) / (num_epochs + lamb), substitute it into the weight equations
+    A = gram + lamb * np.eye(gram.shape[0]) - X_sum.T @ X_sum / (num_epochs + lamb)
+    b = XtY - X_sum.T @ Y_sum / (num_epochs + lamb)
+    weights = scipy.linalg.cho_solve(scipy.linalg.cho_factor(A), b)
+    bias = (Y_sum - X_sum @ weights) / (num_epochs + lamb)
+
+    loss_train = np.mean(np.abs(Y - (X @ weights + bias))) + lamb * (np.sum(weights ** 2) + np.sum(bias ** 2))
+    loss_test = np.mean(np.abs(np.asarray(Y_test, dtype=dtype) - (np.asarray(X_test, dtype=dtype) @ weights + bias)))
+    return weights, bias, [float(loss_train)], [float(loss_test)]
+
+
+def ridge_path(X, Y, lambdas, dtype=np.float64):
+    """
+    ridge solutions for a whole grid of lambdas from one eigendecomposition of the gram matrix (equivalent to the SVD of
+    the design matrix), every additional lambda only costs a (features x features) @ (features x channels) product
+    unlike ridge_regression_direct, the bias is not penalized here, it is the per time point mean that the centering
+    removes
+    :param X: design matrices of shape (epochs, time, features)
+    :param Y: data of shape (epochs, time, channels)
+    :return: weights of shape (lambdas, features, channels) and bias of shape (lambdas, time, channels)
+    """
+    X, Y = np.asarray(X, dtype=dtype), np.asarray(Y, dtype=dtype)
+    return _ridge_path_from_statistics(*_ridge_sufficient_statistics(X, Y), X.shape[0], lambdas)
+
+
+def _ridge_path_from_statistics(gram, XtY, X_sum, Y_sum, num_epochs, lambdas):
+    """
+    ridge_path from the sufficient statistics of _ridge_sufficient_statistics, statistics of disjoint sets of epochs add
+    up, which lets cross_validate_ridge get the training statistics of a fold by subtraction
+    """
+    X_mean, Y_mean = X_sum / num_epochs, Y_sum / num_epochs
+    # center per time point without materializing the centered arrays
+    gram = gram - num_epochs * X_mean.T @ X_mean
+    XtY = XtY - num_epochs * X_mean.T @ Y_mean
+
+    eigenvalues, eigenvectors = np.linalg.eigh(gram)
+    eigenvalues = np.clip(eigenvalues, 0, None)
+    projected = eigenvectors.T @ XtY
+    lambdas = np.asarray(lambdas, dtype=gram.dtype)
+    weights = np.einsum('fk,lk,kc->lfc', eigenvectors, 1 / (eigenvalues[None, :] + lambdas[:, None]), projected)
+    bias = Y_mean[None] - np.einsum('tf,lfc->ltc', X_mean, weights)
+    return weights, bias
+
+
+def cross_validate_ridge(X, Y, lambdas, n_folds=5, n_jobs=None, random_state=None, dtype=np.float64):
+    """
+    choose the ridge penalty of ridge_path by K-fold cross-validation over a grid of lambdas
+    the sufficient statistics are computed once per fold, a fold's training statistics are the total minus its own, and
+    the whole lambda grid of a fold comes from one eigendecomposition; the folds, and then the (fold, lambda) test
+    losses, run in parallel threads
+    :param X: design matrices of shape (epochs, time, features)
+    :param Y: data of shape (epochs, time, channels)
+    :param n_jobs: number of threads, None for the default of ThreadPoolExecutor
+    :return: the best lambda, the test losses (mean absolute error) of shape (folds, lambdas), and the weights
+    (features, channels) and bias (time, channels) refit on all the epochs with the best lambda
+    """
+    X, Y = np.asarray(X, dtype=dtype), np.asarray(Y, dtype=dtype)
+    lambdas = np.asarray(lambdas, dtype=dtype)
+    folds = [test_index for _, test_index in KFold(n_splits=n_folds, shuffle=True, random_state=random_state).split(X)]
+
+    def fold_path(k):
+        train_statistics = [total - this_fold for total, this_fold in zip(total_statistics, fold_statistics[k])]
+        return _ridge_path_from_statistics(*train_statistics, X.shape[0] - len(folds[k]), lambdas)
+
+    def test_loss(fold_lambda):
+        k, l = fold_lambda
+        weights, bias = fold_paths[k]
+        return np.mean(np.abs(Y[folds[k]] - (X[folds[k]] @ weights[l] + bias[l])))
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        fold_statistics = list(executor.map(lambda test_index: _ridge_sufficient_statistics(X[test_index], Y[test_index]),
+                                            folds))
+        total_statistics = [sum(statistics) for statistics in zip(*fold_statistics)]
+        fold_paths = list(executor.map(fold_path, range(n_folds)))
+        fold_losses = np.array(list(executor.map(test_loss, [(k, l) for k in range(n_folds) for l in range(len(lambdas))])))
+    fold_losses = fold_losses.reshape(n_folds, len(lambdas))
+
+    best_lambda = lambdas[np.argmin(fold_losses.mean(axis=0))]
+    weights, bias = _ridge_path_from_statistics(*total_statistics, X.shape[0], [best_lambda])
+    return best_lambda, fold_losses, weights[0], bias[0]
+
+
+def deconvolve_continuous(data, design_matrix, lamb=0., method='cholesky', sample_mask=None, tol=1e-8, max_iter=None):
+    """
+    solve the deconvolution of continuous data in one regularized regression, data = design_matrix @ betas, on the
+    whole session rather than on overlapping epochs, so every sample enters the regression exactly once
+    only sparse products with the design matrix are used, memory grows with its nonzeros and not with samples x columns
+    :param data: continuous data of shape (channels, samples), e.g., the cleaned EEG of a session
+    :param design_matrix: sparse time-expanded design matrix of shape (samples, columns), see build_design_matrix in
+    utils.py
+    :param lamb: ridge penalty, with lamb=0. the regression is unregularized and its normal equations are singular when
+    some columns are never or always jointly active, e.g., an event type that always follows another at a fixed lag
+    :param method: 'cholesky': factorize the (columns x columns) normal equations once and solve all the channels
+    together, falls back to 'lsqr' if they are not positive definite; 'lsqr': sparse LSQR on the design matrix, one
+    channel at a time, with damping sqrt(lamb); 'cg': conjugate gradients on the normal equations, one channel at a time
+    :param sample_mask: optional boolean array of the samples to include, e.g., to leave out artifact segments
+    :param tol: the stopping tolerance of 'lsqr' (atol and btol) and the relative residual tolerance of 'cg'
+    :return: betas of shape (columns, channels)
+    """
+    design_matrix = scipy.sparse.csr_matrix(design_matrix)
+    data = np.asarray(data)
+    if sample_mask is not None:
+        design_matrix = design_matrix[sample_mask]
+        data = data[:, sample_mask]
+    # samples no event touches do not contribute to the regression
+    used_rows = np.diff(design_matrix.indptr) > 0
+    design_matrix = design_matrix[used_rows]
+    data = data[:, used_rows]
+
+    if method == 'cholesky':
+        gram = (design_matrix.T @ design_matrix).toarray() + lamb * np.eye(design_matrix.shape[1])
+        Xty = design_matrix.T @ data.T
+        try:
+            return scipy.linalg.cho_solve(scipy.linalg.cho_factor(gram), Xty)
+        except np.linalg.LinAlgError:
+            warnings.warn('deconvolve_continuous: the normal equations are singular with lamb={0}, falling back to lsqr, '
+                          'use a positive lamb to regularize the deconvolution'.format(lamb))
+            method = 'lsqr'
+    if method == 'lsqr':
+        return np.array([scipy.sparse.linalg.lsqr(design_matrix, y, damp=np.sqrt(lamb), atol=tol, btol=tol,
+                                                  iter_lim=max_iter)[0] for y in data]).T
+    elif method == 'cg':
+        normal_operator = scipy.sparse.linalg.LinearOperator(
+            (design_matrix.shape[1], design_matrix.shape[1]),
+            matvec=lambda v: design_matrix.T @ (design_matrix @ v) + lamb * v)
+        Xty = design_matrix.T @ data.T
+        betas = []
+        for c in range(Xty.shape[1]):
+            beta, info = scipy.sparse.linalg.cg(normal_operator, Xty[:, c], maxiter=max_iter, atol=0., **{_CG_RTOL_KEYWORD: tol})
+            if info > 0:
+                warnings.warn('deconvolve_continuous: conjugate gradients did not converge on channel {0}'.format(c))
+            betas.append(beta)
+        return np.array(betas).T
+    else:
+        raise ValueError("Unknown method {0}, must be one of 'cholesky', 'lsqr' or 'cg'".format(method))
+
+
+def split_rerps(betas, block_names, num_samples_erp_window):
+    """
+    :param betas: from deconvolve_continuous, of shape (columns, channels)
+    :param block_names: name of each block of erp window columns in the design matrix, i.e., the event types followed
+    by the covariates
+    :return: dict of block name -> rERP of shape (channels, erp window)
+    """
+    return dict((name, betas[i * num_samples_erp_window:(i + 1) * num_samples_erp_window].T)
+                for i, name in enumerate(block_names))
+
+
+def overlap_corrected_epochs(data, design_matrices, labels, weights, bias, event_codes, onset_index, index_window=None,
+                             channel_mean=0., channel_std=1.):
+    """
+    remove the predicted responses of the overlapping events from every epoch and channel at once, what remains is the
+    response to the epoch's own event plus the residual
+    the prediction of all the events in an epoch is one contraction of the design matrices with the weights, the epoch's
+    own event is taken out of it by subtracting the weight block of its event type starting at its onset
+    :param data: epochs in the original units, of shape (epochs, time, channels)
+    :param design_matrices: of shape (epochs, time, features), the features are one block of erp window columns per
+    event type
+    :param labels: event type of each epoch, each must be one of event_codes
+    :param weights: of shape (features, channels), bias of shape (time, channels), the fitted betas on normalized data
+    :param event_codes: the event type of each block of columns in the design matrices, in order
+    :param onset_index: index of the epochs' own event in the time axis
+    :param index_window: (start, end) time indices to correct, defaults to the whole epoch
+    :param channel_mean: per channel statistics the betas were fitted with, to put the prediction back in the original
+    units
+    :return: corrected epochs of shape (epochs, index window, channels), and dict of event type -> (mean, SEM) of the
+    corrected epochs of shape (index window, channels)
+    """
+    num_times = design_matrices.shape[1]
+    start, end = index_window if index_window is not None else (0, num_times)
+    num_samples_erp_window = weights.shape[0] // len(event_codes)
+
+    own_prediction = np.zeros((len(event_codes), num_times, weights.shape[1]), dtype=weights.dtype)
+    own_end = min(onset_index + num_samples_erp_window, num_times)
+    for i in range(len(event_codes)):
+        block_start = i * num_samples_erp_window
+        own_prediction[i, onset_index:own_end] = weights[block_start:block_start + own_end - onset_index]
+    is_block = np.asarray(labels)[:, None] == np.asarray(event_codes)[None, :]
+    if not np.all(np.any(is_block, axis=1)):
+        raise ValueError('Labels {0} are not in the event codes {1}'.format(
+            np.unique(np.asarray(labels)[~np.any(is_block, axis=1)]).tolist(), list(event_codes)))
+    block_index = np.argmax(is_block, axis=1)
+
+    prediction_other = np.einsum('etf,fc->etc', design_matrices[:, start:end], weights) + bias[start:end] \
+                       - own_prediction[block_index, start:end]
+    corrected = data[:, start:end] - (prediction_other * channel_std + channel_mean)
+
+    corrected_stats = {}
+    for event_code in event_codes:
+        event_corrected = corrected[labels == event_code]
+        corrected_stats[event_code] = (np.mean(event_corrected, axis=0), scipy.stats.sem(event_corrected, axis=0))
+    return corrected, corrected_stats
+
+
+class ChannelNormalizer:
+    """
+    per channel z-normalization with the statistics stored as arrays, so the same statistics can be applied to the
+    train and test data, or to another session, and saved with the fitted betas
+    the statistics are accumulated in one pass over chunks of the leading axis (merging the chunk means and sums of
+    squared deviations), which also works on a memmap larger than memory, and partial_fit can keep accumulating across
+    sessions
+    """
+    def __init__(self, channel_axis=-1, chunk_size=256):
+        self.channel_axis = channel_axis
+        self.chunk_size = chunk_size
+        self.count = 0
+        self.mean = None
+        self.std = None
+        self._sum_squared_deviations = None
+
+    def partial_fit(self, X):
+        X = np.moveaxis(X, self.channel_axis, -1)
+        for chunk_start in range(0, X.shape[0], self.chunk_size):
+            chunk = np.asarray(X[chunk_start:chunk_start + self.chunk_size], dtype=np.float64).reshape(-1, X.shape[-1])
+            chunk_mean = chunk.mean(axis=0)
+            chunk_sum_squared_deviations = ((chunk - chunk_mean) ** 2).sum(axis=0)
+            if self.count == 0:
+                self.mean, self._sum_squared_deviations = chunk_mean, chunk_sum_squared_deviations
+            else:
+                count = self.count + len(chunk)
+                delta = chunk_mean - self.mean
+                self.mean = self.mean + delta * len(chunk) / count
+                self._sum_squared_deviations = self._sum_squared_deviations + chunk_sum_squared_deviations + \
+                                               delta ** 2 * self.count * len(chunk) / count
+            self.count += len(chunk)
+        self.std = np.sqrt(self._sum_squared_deviations / self.count)
+        self.std[self.std == 0] = 1.  # constant channels are left unscaled, like sklearn's StandardScaler
+        return self
+
+    def fit(self, X):
+        self.count = 0
+        return self.partial_fit(X)
+
+    def _broadcast_shape(self, X):
+        shape = [1] * np.ndim(X)
+        shape[self.channel_axis] = -1
+        return shape
+
+    def transform(self, X):
+        shape = self._broadcast_shape(X)
+        return (X - self.mean.reshape(shape)) / self.std.reshape(shape)
+
+    def inverse_transform(self, X):
+        shape = self._broadcast_shape(X)
+        return X * self.std.reshape(shape) + self.mean.reshape(shape)
+
+    def save(self, path):
+        np.savez(path, mean=self.mean, std=self.std, count=self.count, channel_axis=self.channel_axis,
+                 sum_squared_deviations=self._sum_squared_deviations)
+
+    @classmethod
+    def load(cls, path):
+        stats = np.load(path)
+        normalizer = cls(channel_axis=int(stats['channel_axis']))
+        normalizer.mean, normalizer.std, normalizer.count = stats['mean'], stats['std'], int(stats['count'])
+        normalizer._sum_squared_deviations = stats['sum_squared_deviations']
+        return normalizer
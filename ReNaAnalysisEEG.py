@@ -12,32 +12,32 @@
 
 import json
 import os
-import pickle
 import time
 from collections import defaultdict
 
 import matplotlib.pyplot as plt
 import numpy as np
 import mne
-from rena.utils.data_utils import RNStream
 
-from eyetracking import gaze_event_detection
-from fs_utils import load_participant_session_dict
+from eyetracking import varjo_gaze_xy_status, load_participant_gaze_model
+from fs_utils import load_session_data, save_checkpoint
 from params import event_ids, event_viz_groups
-from utils import generate_pupil_event_epochs, \
-    flatten_list, generate_eeg_event_epochs, visualize_pupil_epochs, visualize_eeg_epochs, \
-    read_file_lines_as_list, add_gaze_em_to_data, add_em_ts_to_data, rescale_merge_exg, create_gaze_behavior_events, \
-    extract_block_data, find_fixation_saccade_targets, flat2gen
+from profiling import profile_stage, get_profiler, summary_table, save_trace
+from session_pipeline import run_sessions, reduce_session_result, aggregate_key, load_aggregate, fit_session_icas
+from utils import flatten_list, visualize_pupil_epochs, visualize_eeg_epochs, read_file_lines_as_list, \
+    EpochAccumulator, GrandAverageAccumulator, prepare_pupil_epochs_for_viz, visualize_eeg_grand_average, \
+    visualize_pupil_grand_average
 
 #################################################################################################
-is_data_preloaded = True
-is_epochs_preloaded = True
 is_regenerate_ica = False
-is_save_loaded_data = False
-
-preloaded_dats_path = 'Data/participant_session_dict.p'
-preloaded_epoch_path = 'Data/participant_condition_epoch_dict_VS.p'
-preloaded_block_path = 'Data/participant_condition_block_dict_VS.p'
+is_interactive_ica = False  # ask for the ICA exclusions when fitting, otherwise the flagged ECG and EOG components are excluded, review them with review_ica.py
+
+# per-session stage checkpoints, see session_pipeline.py, set to None to disable
+# only the stages downstream of a changed parameter or input file are recomputed
+checkpoint_root = 'Data/Checkpoints'
+recompute_stages = ()  # stages to recompute even if checkpointed, e.g., ('gaze_detect',), their downstream stages and the aggregate are also recomputed, ('aggregate',) only recomputes the aggregate
+exg_preprocess_mode = 'standard'  # 'standard' or 'decimate_first', validate with compare_eeg_preprocessing.py
+is_ica_on_epochs = False  # apply the ICA to the epochs instead of reconstructing the continuous session exg
 # base_root = "C:/Users/Lab-User/Dropbox/ReNa/Data/ReNaPilot-2022Spring/"
 base_root = "C:/Users/S-Vec/Dropbox/ReNa/Data/ReNaPilot-2022Spring/"
 data_directory = "Subjects"
@@ -84,382 +84,307 @@ info_chns = ["info1", "info2", "info3"]
 
 locked_marker = 'GazeBehavior'
 
+gaze_detector = 'ivt'  # gaze event detector backend, 'ivt' or 'nslr_hmm'
+is_personalize_gaze_model = True  # for nslr_hmm, fit a gaze model per participant, it is saved in the participant directory
+is_refit_gaze_model = False
+gaze_model_file_name = 'GazeHMMModel.npz'
+
+is_preprocess_pupil = True  # clean the session's continuous pupil size (blinks, padding, interpolation, low-pass) before epoching
+
 eeg_channel_names = mne.channels.make_standard_montage('biosemi64').ch_names
 ecg_ch_name='ECG00'
+exg_channels = eeg_channel_names + [ecg_ch_name]
+exg_channel_types = ['eeg'] * len(eeg_channel_names) + ['ecg']
+
+is_streaming_grand_average = True  # plot the cross-participant averages from running statistics instead of concatenated epochs
+
+n_session_workers = 1  # number of sessions processed in parallel, see session_pipeline.py
+n_ica_workers = 1  # number of session ICAs fitted in parallel before the sessions are processed, see fit_session_icas in session_pipeline.py
+n_ica_threads = None  # BLAS and OpenMP threads of each ICA worker, None to split the cores across the workers
+ica_decim = 2  # the ICA is fit on every ica_decim-th sample of the preprocessed exg, and applied to all of them
+ica_max_duration = None  # seconds of each session the ICA is fit on, spread over the session, None for the whole session
+profile_root = 'Data/Profiles'  # the stage timing trace-event JSON is saved here, see profiling.py, set to None to not save it
+
+is_deconvolve_continuous = False  # deconvolve rERPs on each session's continuous cleaned EEG, alongside the epochs
+deconvolution_erp_window = (-0.2, 0.8)
+deconvolution_lambda = 1.  # ridge penalty, relative to the event counts on the diagonal of the normal equations, 0. is unregularized and can be singular
+deconvolution_method = 'cholesky'  # 'cholesky', 'lsqr' or 'cg', see deconvolve_continuous in Learning/deconv_utils.py
+
+# the parameters of process_session in session_pipeline.py, the Varjo channel names are added from the preset
+session_config = dict(eyetracking_srate=eyetracking_srate,
+                      exg_srate=exg_srate, exg_channels=exg_channels, exg_channel_types=exg_channel_types,
+                      is_preprocess_pupil=is_preprocess_pupil, is_regenerate_ica=is_regenerate_ica, is_interactive_ica=is_interactive_ica,
+                      ica_decim=ica_decim, ica_max_duration=ica_max_duration,
+                      checkpoint_root=checkpoint_root, recompute_stages=recompute_stages, exg_preprocess_mode=exg_preprocess_mode,
+                      is_ica_on_epochs=is_ica_on_epochs, eventMarker_conditionIndex_dict=eventMarker_conditionIndex_dict,
+                      gaze_detector=gaze_detector, info_chns=info_chns, event_ids=event_ids, locked_marker=locked_marker,
+                      tmin_pupil=tmin_pupil, tmax_pupil=tmax_pupil, tmin_eeg=tmin_eeg, tmax_eeg=tmax_eeg,
+                      is_deconvolve_continuous=is_deconvolve_continuous,
+                      deconvolution_erp_window=deconvolution_erp_window, deconvolution_lambda=deconvolution_lambda,
+                      deconvolution_method=deconvolution_method)
 
 # end of setup parameters, start of the main block ######################################################
-start_time = time.time()
-participant_list = os.listdir(data_root)
-participant_directory_list = [os.path.join(data_root, x) for x in participant_list]
-
-gaze_statistics_path = preloaded_epoch_path.strip('.p') + 'gaze_statistics' + '.p'
-gaze_behavior_path = preloaded_epoch_path.strip('.p') + 'gaze_behavior' + '.p'
-participant_session_dict = defaultdict(dict)  # create a dict that holds participant -> sessions -> list of sessionFiles
-participant_condition_epoch_dict = defaultdict(dict)  # participants -> condition name -> epoch object
-participant_condition_block_dict = defaultdict(dict)
-condition_gaze_statistics = defaultdict(dict)
-condition_gaze_behaviors = defaultdict(dict)
-for condition_names in eventMarker_conditionIndex_dict.keys():
-    condition_gaze_behaviors[condition_names]['fixations'] = []
-    condition_gaze_behaviors[condition_names]['saccades'] = []
-participant_badchannel_dict = dict()
-# create a dict that holds participant -> condition epochs
-for participant, participant_directory in zip(participant_list, participant_directory_list):
-    file_names = os.listdir(participant_directory)
-    # assert len(file_names) % 3 == 0
-    # must have #files divisible by 3. That is, we have a itemCatalog, SessionLog and data file for each experiment session.
-    num_sessions = flatten_list([[int(s) for s in txt if s.isdigit()] for txt in file_names])
-    num_sessions = len(np.unique(num_sessions))
-    if os.path.exists(os.path.join(participant_directory, 'badchannels.txt')):  # load bad channels for this participant
-        participant_badchannel_dict[participant] = read_file_lines_as_list(
-            os.path.join(participant_directory, 'badchannels.txt'))
-    for i in range(num_sessions):
-        participant_session_dict[participant][i] = [os.path.join(participant_directory, x) for
-                                                    x in ['{0}.dats'.format(i),
-                                                          '{0}_ReNaItemCatalog.json'.format(i),
-                                                          '{0}_ReNaSessionLog.json'.format(i),
-                                                          '{0}_ParticipantSessionICA'.format(
-                                                              i)]]  # file path for ICA solution and
-
-# preload all the .dats
-if not is_epochs_preloaded:
-    participant_session_dict = load_participant_session_dict(participant_session_dict, is_data_preloaded,
-                                                             is_save_loaded_data, preloaded_dats_path)
-    dats_loading_end_time = time.time()
-    print("Loading data took {0} seconds".format(dats_loading_end_time - start_time))
-
+if __name__ == '__main__':  # the session workers re-import this script when they are spawned
+    start_time = time.time()
+    participant_list = os.listdir(data_root)
+    participant_directory_list = [os.path.join(data_root, x) for x in participant_list]
+
+    participant_session_dict = defaultdict(dict)  # create a dict that holds participant -> sessions -> list of sessionFiles
+    participant_condition_epoch_dict = defaultdict(dict)  # participants -> condition name -> EpochAccumulator of (pupil ArrayEpochs, eeg, eeg ica epochs, labels, EpochDesignMatrix)
+    participant_condition_block_dict = defaultdict(dict)
+    participant_condition_rerp_dict = defaultdict(lambda: defaultdict(list))  # participants -> condition name -> per session rERPs
+    eeg_grand_average = GrandAverageAccumulator(event_viz_groups, ch_type='eeg')  # condition -> event group -> running stats
+    pupil_grand_average = GrandAverageAccumulator(event_viz_groups, transform=prepare_pupil_epochs_for_viz)
+    participant_eeg_grand_averages = dict()  # participants -> GrandAverageAccumulator, for the per-participant plots
+    condition_gaze_statistics = defaultdict(dict)
+    condition_gaze_behaviors = defaultdict(dict)
+    for condition_names in eventMarker_conditionIndex_dict.keys():
+        condition_gaze_behaviors[condition_names]['fixations'] = []
+        condition_gaze_behaviors[condition_names]['saccades'] = []
+    participant_badchannel_dict = dict()
+    # create a dict that holds participant -> condition epochs
+    for participant, participant_directory in zip(participant_list, participant_directory_list):
+        file_names = os.listdir(participant_directory)
+        # assert len(file_names) % 3 == 0
+        # must have #files divisible by 3. That is, we have a itemCatalog, SessionLog and data file for each experiment session.
+        num_sessions = flatten_list([[int(s) for s in txt if s.isdigit()] for txt in file_names])
+        num_sessions = len(np.unique(num_sessions))
+        if os.path.exists(os.path.join(participant_directory, 'badchannels.txt')):  # load bad channels for this participant
+            participant_badchannel_dict[participant] = read_file_lines_as_list(
+                os.path.join(participant_directory, 'badchannels.txt'))
+        for i in range(num_sessions):
+            participant_session_dict[participant][i] = [os.path.join(participant_directory, x) for
+                                                        x in ['{0}.dats'.format(i),
+                                                              '{0}_ReNaItemCatalog.json'.format(i),
+                                                              '{0}_ReNaSessionLog.json'.format(i),
+                                                              '{0}_ParticipantSessionICA'.format(
+                                                                  i)]]  # file path for ICA solution and
+
+    varjoEyetracking_preset = json.load(open(varjoEyetrackingComplete_preset_path))
+    varjoEyetracking_channelNames = varjoEyetracking_preset['ChannelNames']
+
+    session_config['varjoEyetracking_channelNames'] = varjoEyetracking_channelNames
+    session_tasks = []
     for p_i, (participant_index, session_dict) in enumerate(participant_session_dict.items()):
         # print("Working on participant {0} of {1}".format(int(participant_index) + 1, len(participant_session_dict)))
+        gaze_model_path = None
+        if gaze_detector == 'nslr_hmm' and is_personalize_gaze_model:
+            # the model is fit on all the sessions of this participant, the sessions are classified by the workers
+            gaze_model_path = os.path.join(os.path.dirname(list(session_dict.values())[0][2]), gaze_model_file_name)
+            if is_refit_gaze_model or not os.path.exists(gaze_model_path):
+                participant_gaze = []
+                for session_index, session_files in session_dict.items():
+                    with profile_stage('load', participant=participant_index, session=session_index):
+                        data = load_session_data(session_files[0])
+                    participant_gaze.append(varjo_gaze_xy_status(data['Unity.VarjoEyeTrackingComplete'][0], varjoEyetracking_channelNames) +
+                                            (data['Unity.VarjoEyeTrackingComplete'][1],))
+                    del data
+                with profile_stage('gaze_model_fitting', participant=participant_index):
+                    load_participant_gaze_model(gaze_model_path, participant_gaze, is_refit=True)
+                del participant_gaze
         for session_index, session_files in session_dict.items():
-            data, item_catalog_path, session_log_path, session_ICA_path = session_files
-            item_catalog = json.load(open(item_catalog_path))
-            session_log = json.load(open(session_log_path))
-            item_codes = list(item_catalog.values())
-
-            # markers
-            event_markers_timestamps = data['Unity.ReNa.EventMarkers'][1]
-            item_markers = data['Unity.ReNa.ItemMarkers'][0]
-            item_marker_timestamps = data['Unity.ReNa.ItemMarkers'][1]
-
-            # data
-            varjoEyetracking_preset = json.load(open(varjoEyetrackingComplete_preset_path))
-            varjoEyetracking_channelNames = varjoEyetracking_preset['ChannelNames']
-
-            eyetracking_timestamps = data['Unity.VarjoEyeTrackingComplete'][1]
-            eyetracking_data = data['Unity.VarjoEyeTrackingComplete'][0]
-
-            exg_timestamps = data['BioSemi'][1]
-            eeg_data = data['BioSemi'][0][1:65, :]  # take only the EEG channels
-            ecg_data = data['BioSemi'][0][65:67, :]  # take only the EEG channels
-
-            for condition_name, condition_event_marker_index in eventMarker_conditionIndex_dict.items():
-                print("Processing Condition {0} for participant-code[{1}]: {5} of {2}, session {3} of {4}".format(
-                    condition_name,
-                    int(participant_index),
-                    len(participant_session_dict),
-                    session_index + 1,
-                    len(session_dict), p_i + 1))
-                event_markers = data['Unity.ReNa.EventMarkers'][0][condition_event_marker_index]
-
-                # merge and rescale eeg and ecg
-                exg_data = rescale_merge_exg(eeg_data, ecg_data)
-                #########################
-                #  detect the gaze events
-                #########################
-
-                # identify the events and add event array to the data array for both eyetracking and exg
-                # add events
-                data_eyetracking_em = add_em_ts_to_data(event_markers,
-                                                        event_markers_timestamps,
-                                                        eyetracking_data,
-                                                        eyetracking_timestamps, session_log,
-                                                        item_codes, eyetracking_srate)
-                data_exg_em = add_em_ts_to_data(event_markers,
-                                                event_markers_timestamps,
-                                                exg_data,
-                                                exg_timestamps, session_log,
-                                                item_codes, exg_srate)
-
-                # add gaze events
-                data_eyetracking_egm, fixation_durations, normalized_fixation_count = add_gaze_em_to_data(
-                    item_markers, item_marker_timestamps, event_markers,
-                    event_markers_timestamps, data_eyetracking_em, session_log,
-                    item_codes, eyetracking_srate, verbose=1)
-                data_exg_egm, _, _ = add_gaze_em_to_data(
-                    item_markers, item_marker_timestamps, event_markers,
-                    event_markers_timestamps, data_exg_em, session_log,
-                    item_codes, exg_srate, verbose=1)
-                del data_eyetracking_em, data_exg_em
-
-                # add gaze behaviors
-                gaze_xy = eyetracking_data[
-                    [varjoEyetracking_channelNames.index('gaze_forward_{0}'.format(x)) for x in ['x', 'y']]]
-                gaze_status = eyetracking_data[varjoEyetracking_channelNames.index('status')]
-                gaze_behavior_events, fixations, saccades = gaze_event_detection(gaze_xy, gaze_status,
-                                                                                 eyetracking_timestamps)
-
-                fixations = find_fixation_saccade_targets(fixations, saccades, eyetracking_timestamps, data_exg_egm)
-
-                exg_gb_markers = create_gaze_behavior_events(fixations, saccades, eyetracking_timestamps, data_exg_egm[0])
-                data_exg_egbm = np.concatenate([data_exg_egm, exg_gb_markers])
-
-                eyetracking_gb_markers = create_gaze_behavior_events(fixations, saccades, eyetracking_timestamps, data_eyetracking_egm[0])
-                data_eyetracking_egbm = np.concatenate([data_eyetracking_egm, eyetracking_gb_markers])
-                del data_exg_egm, data_eyetracking_egm
-
-                # create channels based on the event channels added
-                exg_egbm_channles = ['LSLTimestamp'] + eeg_channel_names + [ecg_ch_name] + info_chns + ['EventMarker'] + ['GazeMarker'] + ["GazeBehavior"]
-                exg_egbm_channle_types = ['misc'] + ['eeg'] * len(eeg_channel_names) + ['ecg'] + ['stim'] * 3 + ['stim'] * 3
-                eyetracking_egbm_channels = ['LSLTimestamp'] + varjoEyetracking_channelNames + info_chns + ['EventMarker'] + ['GazeMarker'] + ["GazeBehavior"]
-                eyetracking_egbm_channel_types = ['misc'] + ['misc'] * len(varjoEyetracking_channelNames) + ['stim'] * 3 + ['stim'] * 3
-
-                #########################
-
-                # generate the epochs
-                _epochs_pupil, _ = generate_pupil_event_epochs(data_eyetracking_egbm,
-                                                               eyetracking_egbm_channels, eyetracking_egbm_channel_types, tmin_pupil, tmax_pupil,
-                                                               event_ids, locked_marker)
-
-                _epochs_exg, _epochs_eeg_ICA_cleaned, labels_array, _, _ = generate_eeg_event_epochs(
-                    data_exg_egbm,
-                    exg_egbm_channles,
-                    exg_egbm_channle_types,
-                    session_ICA_path,
-                    tmin_eeg, tmax_eeg,
-                    event_ids, locked_marker,
-                    is_regenerate_ica=is_regenerate_ica,
-                    bad_channels=participant_badchannel_dict[
-                        participant_index] if participant_index in participant_badchannel_dict.keys() else None)
-
-                #########################
-
-                # extract block data
-                # _blocks_eyetracking = extract_block_data(data_eyetracking_egbm, eyetracking_egbm_channels, eyetracking_srate, fixations, saccades)  # TODO move block visualization outside of the loop
-                # _blocks_exg = extract_block_data(data_exg_egbm, exg_egbm_channles, exg_srate, fixations, saccades)
-                del data_eyetracking_egbm, data_exg_egbm
-
-                # record gaze statistics
-                if fixation_durations is not None and normalized_fixation_count is not None:
-                    if 'durations' in condition_gaze_statistics[condition_name].keys():
-                        condition_gaze_statistics[condition_name]['durations'] = dict([(event_type, duration_list +
-                                                                                        condition_gaze_statistics[
-                                                                                            condition_name][
-                                                                                            'durations'][event_type])
-                                                                                       for event_type, duration_list in
-                                                                                       fixation_durations.items()])
-                    else:
-                        condition_gaze_statistics[condition_name]['durations'] = fixation_durations
-                    if 'counts' in condition_gaze_statistics[condition_name].keys():
-                        condition_gaze_statistics[condition_name]['counts'] = dict([(event_type, 0.5 * (
-                                norm_count + condition_gaze_statistics[condition_name]['counts'][event_type])) for
-                                                                                    event_type, norm_count in
-                                                                                    normalized_fixation_count.items()])
-                    else:
-                        condition_gaze_statistics[condition_name]['counts'] = normalized_fixation_count
-
-                # Add to gaze behaviors
-                condition_gaze_behaviors[condition_name]['fixations'] = condition_gaze_behaviors[condition_name]['fixations'] + fixations
-                condition_gaze_behaviors[condition_name]['saccades'] = condition_gaze_behaviors[condition_name]['saccades'] + saccades
-
-                # Add the new epochs to the epoch dictionary
-                if condition_name not in participant_condition_epoch_dict[participant_index].keys():
-                    participant_condition_epoch_dict[participant_index][condition_name] = (
-                        _epochs_pupil, _epochs_exg, _epochs_eeg_ICA_cleaned, labels_array)
-                else:
-                    participant_condition_epoch_dict[participant_index][condition_name] = (
-                        mne.concatenate_epochs(
-                            [participant_condition_epoch_dict[participant_index][condition_name][0], _epochs_pupil]),
-                        mne.concatenate_epochs(
-                            [participant_condition_epoch_dict[participant_index][condition_name][1], _epochs_exg]),
-                        mne.concatenate_epochs(
-                            [participant_condition_epoch_dict[participant_index][condition_name][2],
-                             _epochs_eeg_ICA_cleaned]),
-                        np.concatenate(
-                            [participant_condition_epoch_dict[participant_index][condition_name][3], labels_array]
-                        )
-                    )
-                # Add the new blocks to the block dictionary
-                # if condition_name not in participant_condition_block_dict[participant_index].keys():
-                #     participant_condition_block_dict[participant_index][condition_name] = (
-                #         _blocks_eyetracking, _blocks_exg)
-                # else:
-                #     participant_condition_block_dict[participant_index][condition_name] = (
-                #         participant_condition_block_dict[participant_index][condition_name][0] + _blocks_eyetracking,
-                #         participant_condition_block_dict[participant_index][condition_name][1] + _blocks_exg
-                #     )
-
-                # continue to the next condition
-            # continue to the next session
-        # continue to the next participant
-
-    if is_save_loaded_data:
-        pickle.dump(participant_condition_epoch_dict, open(preloaded_epoch_path, 'wb'))
-        # pickle.dump(participant_condition_block_dict, open(preloaded_epoch_path, 'wb'))
-        pickle.dump(condition_gaze_statistics, open(gaze_statistics_path, 'wb'))
-        pickle.dump(condition_gaze_behaviors, open(gaze_behavior_path, 'wb'))
-
-else:  # if epochs are preloaded and saved
-    print("Loading preloaded epochs ...")
-    participant_condition_epoch_dict = pickle.load(open(preloaded_epoch_path, 'rb'))
-    condition_gaze_statistics = pickle.load(open(gaze_statistics_path, 'rb'))
-    condition_gaze_behaviors = pickle.load(open(gaze_behavior_path, 'rb'))
-    dats_loading_end_time = time.time()
-    print("Loading data took {0} seconds".format(dats_loading_end_time - start_time))
-
-# if condition_gaze_statistics is not None:
-#     for condition_name in eventMarker_conditionIndex_dict.keys():
-#         for event in event_ids.keys():
-#             durations = np.array(condition_gaze_statistics[condition_name]['durations'][event.lower()])
-#             durations = durations[durations < 1.4]
-#             plt.hist(durations * 1e3, label=event, bins=20)
-#             plt.legend()
-#             plt.xlabel('Millisecond')
-#             plt.ylabel('Count')
-#             plt.xlim(0, 1500)
-#             plt.ylim(0, 700)
-#             plt.title('Fixation duration {0}-{1} (min = 141.4 ms)'.format(condition_name, event))
-#             plt.show()
-#     # plot counts
-#     plt.rcParams["figure.figsize"] = (12.8, 7.2)
-#     X = np.arange(3)
-#     for i, condition_name in enumerate(eventMarker_conditionIndex_dict.keys()):
-#         bar = plt.bar(X + 0.25 * i, [condition_gaze_statistics[condition_name]['counts'][event.lower()] for event in
-#                                      event_ids.keys()], label=condition_name, width=0.25)
-#         for rect in bar:
-#             height = rect.get_height()
-#             plt.text(rect.get_x() + rect.get_width() / 2.0, height, f'{height:.3f}', ha='center', va='bottom')
-#
-#     plt.xticks(np.linspace(0, 2.5, 3), event_ids.keys())
-#     plt.legend()
-#     plt.title('Normalized fixation counts across conditions and item types')
-#     plt.show()
-X = np.arange(3)
-plt.rcParams["figure.figsize"] = (12.8, 7.2)
-for i, condition_name in enumerate(eventMarker_conditionIndex_dict.keys()):
-    # fixations = condition_gaze_behaviors[condition_name]['fixations']
-    # plt.hist([f.duration for f in fixations if f.duration<4 and f.stim != 'null'], bins=20)
-    # plt.xlabel('Time (sec)')
-    # plt.ylabel('Count')
-    # plt.title('Non-null Fixation Duration. Condition {0}'.format(condition_name))
-    # plt.show()
-
-    saccades = condition_gaze_behaviors[condition_name]['saccades']
-    saccade_amplitudes = [s.amplitude for s in saccades if s.to_stim is not None and s.amplitude < 20 and s.peak_velocity < 700]
-    saccade_peak_velocities = [s.peak_velocity for s in saccades if s.to_stim is not None and s.amplitude < 20 and s.peak_velocity < 700]
-    saccade_peak_durations = [s.duration for s in saccades]
-
-    plt.hist(saccade_amplitudes, bins=20)
-    plt.xlabel('Degree')
-    plt.ylabel('Count')
-    plt.title('Non-null designated Saccade Amplitude. Condition {0}'.format(condition_name))
-    plt.show()
-
-    plt.hist(saccade_peak_velocities, bins=20)
-    plt.xlabel('Degree/sec')
-    plt.ylabel('Count')
-    plt.title('Non-null designated Saccade Peak Velocity. Condition {0}'.format(condition_name))
-    plt.show()
-
-    plt.hist(saccade_peak_durations, bins=20)
-    plt.xlabel('Sec')
-    plt.ylabel('Count')
-    plt.title('Non-null designated Saccade Duration. Condition {0}'.format(condition_name))
-    plt.show()
-
-    plt.scatter(saccade_peak_velocities, saccade_amplitudes)
-    plt.ylabel('Saccade Amplitude (Degree)')
-    plt.xlabel('Saccade Peak Velocity (Deg/sec)')
-    plt.title('Non-null designated Saccade Amplitude vs. Peak Velocity. Condition {0}'.format(condition_name))
-    plt.show()
-    # for stim in ['target', 'distractor', 'novelty']:
-    #     fixations = condition_gaze_behaviors[condition_name]['fixations']
-    #     plt.hist([f.duration for f in fixations if f.duration < 4 and f.stim == stim], bins=20)
-    #     plt.xlabel('Time (sec)')
-    #     plt.ylabel('Count')
-    #     plt.title('{1} Fixation Duration. Condition {0}'.format(condition_name, stim))
+            bad_channels = participant_badchannel_dict[participant_index] if participant_index in participant_badchannel_dict.keys() else None
+            session_tasks.append(tuple(session_files) + (participant_index, session_index, bad_channels,
+                                                         gaze_model_path, session_config, None))
+
+    if not is_interactive_ica:  # fit the missing ICAs in parallel, the interactive ones are fitted as the sessions are processed
+        with profile_stage('ica_fitting'):
+            session_tasks = fit_session_icas(session_tasks, n_workers=n_ica_workers, n_threads=n_ica_threads)
+
+    # the aggregate stage, checkpointed by the epoch keys of all the sessions
+    aggregate = load_aggregate(session_tasks, is_streaming_grand_average=is_streaming_grand_average)
+    if aggregate is None:
+        def reduce_session(task, session_result):
+            # when streaming, the epochs only feed the running statistics and are not kept
+            grand_averages = [(eeg_grand_average, 2), (pupil_grand_average, 0),
+                              (participant_eeg_grand_averages.setdefault(task[4], GrandAverageAccumulator(event_viz_groups, ch_type='eeg')), 2)] \
+                if is_streaming_grand_average else []
+            reduce_session_result(task[4], session_result, participant_condition_epoch_dict, condition_gaze_statistics,
+                                  condition_gaze_behaviors, participant_condition_rerp_dict,
+                                  grand_averages=grand_averages, is_keep_epochs=not is_streaming_grand_average)
+        with profile_stage('aggregate'):
+            run_sessions(session_tasks, reduce_session, n_workers=n_session_workers)
+        participant_condition_rerp_dict = dict((participant_index, dict(condition_rerps)) for participant_index, condition_rerps in participant_condition_rerp_dict.items())
+        if checkpoint_root is not None:
+            aggregate_checkpoint_key = aggregate_key(session_tasks, is_streaming_grand_average=is_streaming_grand_average)  # the keys change if new ICAs were fitted
+            # when streaming, the epoch dictionary is empty and the running statistics are checkpointed instead
+            save_checkpoint(checkpoint_root, 'aggregate', aggregate_checkpoint_key,
+                            (participant_condition_epoch_dict, condition_gaze_statistics, condition_gaze_behaviors, participant_condition_rerp_dict,
+                             eeg_grand_average, pupil_grand_average, participant_eeg_grand_averages))
+    else:
+        print("Loaded the aggregate from checkpoint {0}".format(aggregate_key(session_tasks, is_streaming_grand_average=is_streaming_grand_average)))
+        participant_condition_epoch_dict, condition_gaze_statistics, condition_gaze_behaviors, participant_condition_rerp_dict, \
+            eeg_grand_average, pupil_grand_average, participant_eeg_grand_averages = aggregate
+    print("Processing sessions took {0} seconds".format(time.time() - start_time))
+
+    # the plot stage is not checkpointed, it is rerun from the aggregate
+    # if condition_gaze_statistics is not None:
+    #     for condition_name in eventMarker_conditionIndex_dict.keys():
+    #         for event in event_ids.keys():
+    #             durations = np.array(condition_gaze_statistics[condition_name]['durations'][event.lower()])
+    #             durations = durations[durations < 1.4]
+    #             plt.hist(durations * 1e3, label=event, bins=20)
+    #             plt.legend()
+    #             plt.xlabel('Millisecond')
+    #             plt.ylabel('Count')
+    #             plt.xlim(0, 1500)
+    #             plt.ylim(0, 700)
+    #             plt.title('Fixation duration {0}-{1} (min = 141.4 ms)'.format(condition_name, event))
+    #             plt.show()
+    #     # plot counts
+    #     plt.rcParams["figure.figsize"] = (12.8, 7.2)
+    #     X = np.arange(3)
+    #     for i, condition_name in enumerate(eventMarker_conditionIndex_dict.keys()):
+    #         bar = plt.bar(X + 0.25 * i, [condition_gaze_statistics[condition_name]['counts'][event.lower()] for event in
+    #                                      event_ids.keys()], label=condition_name, width=0.25)
+    #         for rect in bar:
+    #             height = rect.get_height()
+    #             plt.text(rect.get_x() + rect.get_width() / 2.0, height, f'{height:.3f}', ha='center', va='bottom')
+    #
+    #     plt.xticks(np.linspace(0, 2.5, 3), event_ids.keys())
+    #     plt.legend()
+    #     plt.title('Normalized fixation counts across conditions and item types')
     #     plt.show()
-    # bar = plt.bar(X + 0.25 * i, [condition_gaze_statistics[condition_name]['counts'][event.lower()] for event in
-    #                              event_ids.keys()], label=condition_name, width=0.25)
-
-# plot saccade durations across stims
-for i, condition_name in enumerate(eventMarker_conditionIndex_dict.keys()):
-    saccades = condition_gaze_behaviors[condition_name]['saccades']
-    for stim in stims:
-        saccade_durations = [s.duration for s in saccades if s.epoched and s.to_stim == stim]
-        plt.hist(saccade_durations, bins=20)
+    X = np.arange(3)
+    plt.rcParams["figure.figsize"] = (12.8, 7.2)
+    for i, condition_name in enumerate(eventMarker_conditionIndex_dict.keys()):
+        # fixations = condition_gaze_behaviors[condition_name]['fixations']
+        # plt.hist([f.duration for f in fixations if f.duration<4 and f.stim != 'null'], bins=20)
+        # plt.xlabel('Time (sec)')
+        # plt.ylabel('Count')
+        # plt.title('Non-null Fixation Duration. Condition {0}'.format(condition_name))
+        # plt.show()
+
+        saccades = condition_gaze_behaviors[condition_name]['saccades']
+        saccade_amplitudes = [s.amplitude for s in saccades if s.to_stim is not None and s.amplitude < 20 and s.peak_velocity < 700]
+        saccade_peak_velocities = [s.peak_velocity for s in saccades if s.to_stim is not None and s.amplitude < 20 and s.peak_velocity < 700]
+        saccade_peak_durations = [s.duration for s in saccades]
+
+        plt.hist(saccade_amplitudes, bins=20)
         plt.xlabel('Degree')
         plt.ylabel('Count')
-        plt.xlim(0, 0.1)
-        plt.title('Saccade Duration. Condition {0}. Stim {1}'.format(condition_name, stim))
+        plt.title('Non-null designated Saccade Amplitude. Condition {0}'.format(condition_name))
         plt.show()
 
-# plot fixation durations across stims
-for i, condition_name in enumerate(eventMarker_conditionIndex_dict.keys()):
-    fixations = condition_gaze_behaviors[condition_name]['fixations']
-    for stim in stims:
-        fixation_durations = [f.duration for f in fixations if f.epoched and f.stim == stim]
-        plt.hist(fixation_durations, bins=20)
-        plt.xlabel('Degree')
+        plt.hist(saccade_peak_velocities, bins=20)
+        plt.xlabel('Degree/sec')
         plt.ylabel('Count')
-        plt.xlim(0, 2)
-        plt.title('Fixation Duration. Condition {0}. Stim {1}'.format(condition_name, stim))
+        plt.title('Non-null designated Saccade Peak Velocity. Condition {0}'.format(condition_name))
         plt.show()
 
+        plt.hist(saccade_peak_durations, bins=20)
+        plt.xlabel('Sec')
+        plt.ylabel('Count')
+        plt.title('Non-null designated Saccade Duration. Condition {0}'.format(condition_name))
+        plt.show()
 
-# get all the epochs for conditions and plots per condition
-print("Creating plots across all participants per condition")
-for condition_name in eventMarker_conditionIndex_dict.keys():
-    print("Creating plots for condition {0}".format(condition_name))
-    condition_epoch_list = flatten_list([x.items() for x in participant_condition_epoch_dict.values()])
-    condition_epochs = [e for c, e in condition_epoch_list if c == condition_name]
-    condition_epochs_pupil = mne.concatenate_epochs([pupil for pupil, _, _, _ in condition_epochs])
-    # condition_epochs_eeg = mne.concatenate_epochs([eeg for pupil, eeg, _ in condition_epochs])
-    condition_epochs_eeg_ica = mne.concatenate_epochs([eeg_ica for _, _, eeg_ica, _ in condition_epochs])
-    title = 'Averaged across Participants, Condition {0}, {1} Locked'.format(condition_name, locked_marker)
-    visualize_pupil_epochs(condition_epochs_pupil, event_viz_groups, tmin_pupil_viz, tmax_pupil_viz, color_dict, title, gaze_behavior=condition_gaze_behaviors[condition_name]['saccades'])
-    visualize_eeg_epochs(condition_epochs_eeg_ica, event_viz_groups, tmin_eeg_viz, tmax_eeg_viz, color_dict, eeg_picks,
-                         title, is_plot_topo_map=True, gaze_behavior=condition_gaze_behaviors[condition_name]['saccades'])
-
-# get all the epochs and plots per participant
-for participant_index, condition_epoch_dict in participant_condition_epoch_dict.items():
-    for condition_name, condition_epochs in condition_epoch_dict.items():
-        condition_epochs_pupil = condition_epochs[0]
-        condition_epochs_eeg_ica = condition_epochs[2]
-        title = 'Participants {0} - Condition {1}'.format(participant_index, condition_name)
-        # visualize_pupil_epochs(condition_epochs_pupil, event_ids, tmin_pupil, tmax_pupil, color_dict, title)
-        visualize_eeg_epochs(condition_epochs_eeg_ica, event_viz_groups, tmin_eeg_viz, tmax_eeg_viz, color_dict, eeg_picks, title, is_plot_timeseries=True, is_plot_topo_map=False, out_dir='Figures')
-
-
-''' Export the per-trial epochs for gaze behavior analysis
-epochs_carousel_gaze_this_participant_trial_dfs = varjo_epochs_to_df(epochs_carousel_gaze_this_participant.copy())
-for trial_index, single_trial_df in enumerate(epochs_carousel_gaze_this_participant_trial_dfs):
-    trial_export_path = os.path.join(trial_data_export_root, str(participant_index + 1), str(trial_index + 1))
-    os.makedirs(trial_export_path, exist_ok=True)
-    fn = 'varjo_gaze_output_single_trial_participant_{0}_{1}.csv'.format(participant_index + 1, trial_index + 1)
-    single_trial_df.reset_index()
-    single_trial_df.to_csv(os.path.join(trial_export_path, fn), index=False)
-'''
-
-''' Export per-condition eeg-ica epochs with design matrices
-'''
-# print("exporting data")
-# for condition_name in eventMarker_conditionIndex_dict.keys():
-#     locking = 'FixationLocked' if condition_name in FixationLocking_conditions else 'EventLocked'
-#     condition_epoch_list = flatten_list([x.items() for x in participant_condition_epoch_dict.values()])
-#     condition_epochs = [e for c, e in condition_epoch_list if c == condition_name]
-#     condition_epochs_eeg_ica: mne.Epochs = mne.concatenate_epochs([eeg_ica for pupil, eeg, eeg_ica, labels in condition_epochs])
-#     condition_epochs_labels =  np.concatenate([labels for pupil, eeg, eeg_ica, labels in condition_epochs])
-#
-#     trial_x_export_path = os.path.join(epoch_data_export_root,
-#                                        "epochs_{0}_eeg_ica_condition_{1}_data.npy".format(locking, condition_name))
-#     trial_dm_export_path = os.path.join(epoch_data_export_root,
-#                                        "epochs_{0}_eeg_ica_condition_{1}_DM.npy".format(locking, condition_name))
-#     trial_y_export_path = os.path.join(epoch_data_export_root,
-#                                        "epochs_{0}_eeg_ica_condition_{1}_labels.npy".format(locking, condition_name))
-#     np.save(trial_x_export_path, condition_epochs_eeg_ica.copy().pick('eeg').get_data())
-#     DM_picks = mne.pick_channels_regexp(condition_epochs_eeg_ica.ch_names, regexp=r'DM_.*')
-#     np.save(trial_dm_export_path, condition_epochs_eeg_ica.copy().pick(DM_picks).get_data())
-#     np.save(trial_y_export_path, condition_epochs_labels)
-
-end_time = time.time()
-print("Took {0} seconds".format(end_time - start_time))
+        plt.scatter(saccade_peak_velocities, saccade_amplitudes)
+        plt.ylabel('Saccade Amplitude (Degree)')
+        plt.xlabel('Saccade Peak Velocity (Deg/sec)')
+        plt.title('Non-null designated Saccade Amplitude vs. Peak Velocity. Condition {0}'.format(condition_name))
+        plt.show()
+        # for stim in ['target', 'distractor', 'novelty']:
+        #     fixations = condition_gaze_behaviors[condition_name]['fixations']
+        #     plt.hist([f.duration for f in fixations if f.duration < 4 and f.stim == stim], bins=20)
+        #     plt.xlabel('Time (sec)')
+        #     plt.ylabel('Count')
+        #     plt.title('{1} Fixation Duration. Condition {0}'.format(condition_name, stim))
+        #     plt.show()
+        # bar = plt.bar(X + 0.25 * i, [condition_gaze_statistics[condition_name]['counts'][event.lower()] for event in
+        #                              event_ids.keys()], label=condition_name, width=0.25)
+
+    # plot saccade durations across stims
+    for i, condition_name in enumerate(eventMarker_conditionIndex_dict.keys()):
+        saccades = condition_gaze_behaviors[condition_name]['saccades']
+        for stim in stims:
+            saccade_durations = [s.duration for s in saccades if s.epoched and s.to_stim == stim]
+            plt.hist(saccade_durations, bins=20)
+            plt.xlabel('Degree')
+            plt.ylabel('Count')
+            plt.xlim(0, 0.1)
+            plt.title('Saccade Duration. Condition {0}. Stim {1}'.format(condition_name, stim))
+            plt.show()
+
+    # plot fixation durations across stims
+    for i, condition_name in enumerate(eventMarker_conditionIndex_dict.keys()):
+        fixations = condition_gaze_behaviors[condition_name]['fixations']
+        for stim in stims:
+            fixation_durations = [f.duration for f in fixations if f.epoched and f.stim == stim]
+            plt.hist(fixation_durations, bins=20)
+            plt.xlabel('Degree')
+            plt.ylabel('Count')
+            plt.xlim(0, 2)
+            plt.title('Fixation Duration. Condition {0}. Stim {1}'.format(condition_name, stim))
+            plt.show()
+
+
+    # get all the epochs for conditions and plots per condition
+    print("Creating plots across all participants per condition")
+    for condition_name in eventMarker_conditionIndex_dict.keys():
+        print("Creating plots for condition {0}".format(condition_name))
+        with profile_stage('plot', condition=condition_name):
+            title = 'Averaged across Participants, Condition {0}, {1} Locked'.format(condition_name, locked_marker)
+            if is_streaming_grand_average:
+                visualize_pupil_grand_average(pupil_grand_average, condition_name, tmin_pupil_viz, tmax_pupil_viz, color_dict, title, gaze_behavior=condition_gaze_behaviors[condition_name]['saccades'])
+                visualize_eeg_grand_average(eeg_grand_average, condition_name, tmin_eeg_viz, tmax_eeg_viz, color_dict, eeg_picks,
+                                            title, is_plot_topo_map=True, gaze_behavior=condition_gaze_behaviors[condition_name]['saccades'])
+                continue
+            condition_epoch_list = flatten_list([x.items() for x in participant_condition_epoch_dict.values()])
+            condition_epochs = EpochAccumulator.merge([e for c, e in condition_epoch_list if c == condition_name])
+            condition_epochs_pupil = condition_epochs[0]
+            # condition_epochs_eeg = condition_epochs[1]
+            condition_epochs_eeg_ica = condition_epochs[2]
+            visualize_pupil_epochs(condition_epochs_pupil, event_viz_groups, tmin_pupil_viz, tmax_pupil_viz, color_dict, title, gaze_behavior=condition_gaze_behaviors[condition_name]['saccades'])
+            visualize_eeg_epochs(condition_epochs_eeg_ica, event_viz_groups, tmin_eeg_viz, tmax_eeg_viz, color_dict, eeg_picks,
+                                 title, is_plot_topo_map=True, gaze_behavior=condition_gaze_behaviors[condition_name]['saccades'])
+
+    # get all the epochs and plots per participant
+    for participant_index, participant_eeg_grand_average in participant_eeg_grand_averages.items():
+        for condition_name in participant_eeg_grand_average.stats.keys():
+            with profile_stage('plot', participant=participant_index, condition=condition_name):
+                title = 'Participants {0} - Condition {1}'.format(participant_index, condition_name)
+                visualize_eeg_grand_average(participant_eeg_grand_average, condition_name, tmin_eeg_viz, tmax_eeg_viz, color_dict, eeg_picks, title, is_plot_timeseries=True, is_plot_topo_map=False, out_dir='Figures')
+    for participant_index, condition_epoch_dict in participant_condition_epoch_dict.items():
+        for condition_name, condition_epochs in condition_epoch_dict.items():
+            with profile_stage('plot', participant=participant_index, condition=condition_name):
+                condition_epochs_pupil = condition_epochs[0]
+                condition_epochs_eeg_ica = condition_epochs[2]
+                title = 'Participants {0} - Condition {1}'.format(participant_index, condition_name)
+                # visualize_pupil_epochs(condition_epochs_pupil, event_ids, tmin_pupil, tmax_pupil, color_dict, title)
+                visualize_eeg_epochs(condition_epochs_eeg_ica, event_viz_groups, tmin_eeg_viz, tmax_eeg_viz, color_dict, eeg_picks, title, is_plot_timeseries=True, is_plot_topo_map=False, out_dir='Figures')
+
+
+    ''' Export the per-trial epochs for gaze behavior analysis
+    epochs_carousel_gaze_this_participant_trial_dfs = varjo_epochs_to_df(epochs_carousel_gaze_this_participant.copy())
+    for trial_index, single_trial_df in enumerate(epochs_carousel_gaze_this_participant_trial_dfs):
+        trial_export_path = os.path.join(trial_data_export_root, str(participant_index + 1), str(trial_index + 1))
+        os.makedirs(trial_export_path, exist_ok=True)
+        fn = 'varjo_gaze_output_single_trial_participant_{0}_{1}.csv'.format(participant_index + 1, trial_index + 1)
+        single_trial_df.reset_index()
+        single_trial_df.to_csv(os.path.join(trial_export_path, fn), index=False)
+    '''
+
+    ''' Export per-condition eeg-ica epochs with design matrices
+    '''
+    # print("exporting data")
+    # for condition_name in eventMarker_conditionIndex_dict.keys():
+    #     locking = 'FixationLocked' if condition_name in FixationLocking_conditions else 'EventLocked'
+    #     condition_epoch_list = flatten_list([x.items() for x in participant_condition_epoch_dict.values()])
+    #     condition_epochs = EpochAccumulator.merge([e for c, e in condition_epoch_list if c == condition_name])
+    #     _, _, condition_epochs_eeg_ica, condition_epochs_labels, condition_epochs_dm = condition_epochs
+    #
+    #     trial_x_export_path = os.path.join(epoch_data_export_root,
+    #                                        "epochs_{0}_eeg_ica_condition_{1}_data.npy".format(locking, condition_name))
+    #     trial_dm_export_path = os.path.join(epoch_data_export_root,
+    #                                        "epochs_{0}_eeg_ica_condition_{1}_DM.npy".format(locking, condition_name))
+    #     trial_y_export_path = os.path.join(epoch_data_export_root,
+    #                                        "epochs_{0}_eeg_ica_condition_{1}_labels.npy".format(locking, condition_name))
+    #     np.save(trial_x_export_path, condition_epochs_eeg_ica.copy().pick('eeg').get_data())
+    #     condition_epochs_dm.save(trial_dm_export_path)
+    #     np.save(trial_y_export_path, condition_epochs_labels)
+
+    end_time = time.time()
+    print("Took {0} seconds".format(end_time - start_time))
+    print(summary_table(get_profiler().records))
+    if profile_root is not None:
+        save_trace(get_profiler().records, os.path.join(profile_root, 'trace_{0}.json'.format(time.strftime('%Y%m%d-%H%M%S'))))
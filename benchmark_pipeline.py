@@ -0,0 +1,187 @@
+"""
+End-to-end benchmark of the session pipeline on synthetic sessions, see synthetic_session.py
+
+Generates synthetic participants for every session duration, then runs the sessions of each participant count through
+run_sessions and plots the grand averages, timing every stage with profiling.py. A cold run starts from empty stage
+checkpoints, a warm run reruns the same sessions on the checkpoints of the cold run. The per-stage times of every run
+are appended to results_path as a JSON line together with the git version of the tree, and compare_benchmark_results
+prints the stage times of the compared versions side by side.
+
+The session and epoching parameters are those of ReNaAnalysisEEG.py, except the Varjo channel names, the conditions and
+the checkpoint root.
+"""
+import json
+import os
+import shutil
+import subprocess
+import time
+from collections import defaultdict
+
+import matplotlib
+matplotlib.use('Agg')  # the plots are timed but not shown
+import matplotlib.pyplot as plt
+
+import ReNaAnalysisEEG as analysis
+from params import event_viz_groups
+from profiling import profile_stage, get_profiler, summarize_records, summary_table, format_table, save_trace
+from session_pipeline import run_sessions, reduce_session_result, fit_session_icas
+from synthetic_session import write_synthetic_participants, VARJO_CHANNEL_NAMES
+from utils import GrandAverageAccumulator, prepare_pupil_epochs_for_viz, visualize_eeg_grand_average, \
+    visualize_pupil_grand_average
+
+#################################################################################################
+benchmark_root = 'Data/Benchmark'
+results_path = os.path.join(benchmark_root, 'results.jsonl')
+session_durations = [300.]  # seconds of every synthetic session
+participant_counts = [1, 2]
+num_sessions_per_participant = 2
+n_session_workers = 1
+n_ica_workers = 1
+n_ica_threads = None
+is_benchmark_warm = True  # rerun every benchmark on the checkpoints of its cold run
+is_benchmark_plot = True
+is_refit_ica = True  # delete the sessions' ICA solutions before a cold run so that the ICA fit is timed
+compared_versions = None  # git versions to compare, e.g., ['a20c296', 'a20c296-dirty'], None for the last two recorded
+seed = 0
+
+# the synthetic sessions have all four conditions
+eventMarker_conditionIndex_dict = {
+    'RSVP': slice(0, 4),
+    'Carousel': slice(4, 8),
+    'VS': slice(8, 12),
+    'TS': slice(12, 16)
+}
+
+
+def git_version():
+    """
+    :return: the commit of the tree, suffixed with -dirty if it has uncommitted changes, None if it's not a git tree
+    """
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def synthetic_session_tasks(data_root, num_participants, num_sessions, config):
+    """
+    :return: the process_session argument tuples of the synthetic sessions written by write_synthetic_participants,
+    the data paths are those of the .dats, which load_session_data reads from the .p
+    """
+    session_tasks = []
+    for participant_index in [str(x) for x in range(num_participants)]:
+        for session_index in range(num_sessions):
+            session_files = [os.path.join(data_root, participant_index, x.format(session_index)) for x in
+                             ['{0}.dats', '{0}_ReNaItemCatalog.json', '{0}_ReNaSessionLog.json', '{0}_ParticipantSessionICA']]
+            session_tasks.append(tuple(session_files) + (participant_index, session_index, None, None, config, None))
+    return session_tasks
+
+
+def benchmark_sessions(session_tasks, n_workers=1, n_ica_workers=1, n_ica_threads=None, is_plot=True):
+    """
+    run the sessions through the pipeline and plot their grand averages the way ReNaAnalysisEEG.py does
+    :return: the profile records of the run
+    """
+    get_profiler().drain()
+    participant_condition_epoch_dict = defaultdict(dict)
+    participant_condition_rerp_dict = defaultdict(lambda: defaultdict(list))
+    condition_gaze_statistics = defaultdict(dict)
+    condition_gaze_behaviors = defaultdict(lambda: {'fixations': [], 'saccades': []})
+    eeg_grand_average = GrandAverageAccumulator(event_viz_groups, ch_type='eeg')
+    pupil_grand_average = GrandAverageAccumulator(event_viz_groups, transform=prepare_pupil_epochs_for_viz)
+
+    def reduce_session(task, session_result):
+        reduce_session_result(task[4], session_result, participant_condition_epoch_dict, condition_gaze_statistics,
+                              condition_gaze_behaviors, participant_condition_rerp_dict,
+                              grand_averages=[(eeg_grand_average, 2), (pupil_grand_average, 0)], is_keep_epochs=False)
+    with profile_stage('ica_fitting'):
+        session_tasks = fit_session_icas(session_tasks, n_workers=n_ica_workers, n_threads=n_ica_threads)
+    with profile_stage('aggregate'):
+        run_sessions(session_tasks, reduce_session, n_workers=n_workers)
+    if is_plot:
+        for condition_name in session_tasks[0][8]['eventMarker_conditionIndex_dict'].keys():
+            with profile_stage('plot', condition=condition_name):
+                title = 'Benchmark, Condition {0}, {1} Locked'.format(condition_name, analysis.locked_marker)
+                saccades = condition_gaze_behaviors[condition_name]['saccades']
+                visualize_pupil_grand_average(pupil_grand_average, condition_name, analysis.tmin_pupil_viz, analysis.tmax_pupil_viz,
+                                              analysis.color_dict, title, gaze_behavior=saccades)
+                visualize_eeg_grand_average(eeg_grand_average, condition_name, analysis.tmin_eeg_viz, analysis.tmax_eeg_viz,
+                                            analysis.color_dict, analysis.eeg_picks, title, is_plot_topo_map=True, gaze_behavior=saccades)
+                plt.close('all')
+    return get_profiler().drain()
+
+
+def record_benchmark_result(results_path, records, **benchmark_config):
+    """
+    append the per-stage summary of the records to results_path as a JSON line
+    :param benchmark_config: describes the benchmark, e.g., session_duration, num_participants and run, the results
+    of the same benchmark are compared across versions
+    """
+    result = dict(version=git_version(), time=time.strftime('%Y-%m-%d %H:%M:%S'), benchmark=benchmark_config,
+                  stages=dict((name, stats) for (name,), stats in summarize_records(records).items()))
+    if os.path.dirname(results_path):
+        os.makedirs(os.path.dirname(results_path), exist_ok=True)
+    with open(results_path, 'a') as f:
+        f.write(json.dumps(result) + '\n')
+    return result
+
+
+def compare_benchmark_results(results_path, versions=None, field='self_wall'):
+    """
+    :param versions: the versions to compare, None for the last two recorded. The latest result of a version is used
+    if the same benchmark was recorded more than once
+    :param field: the stage statistic to compare, one of count, wall, self_wall, cpu, self_cpu and peak_rss
+    :return: a printable table per benchmark of the stage's field in every version
+    """
+    with open(results_path) as f:
+        results = [json.loads(line) for line in f if line.strip()]
+    if versions is None:
+        versions = list(dict.fromkeys(x['version'] for x in results))[-2:]
+    benchmark_results = defaultdict(dict)  # benchmark -> version -> result
+    for result in results:
+        if result['version'] in versions:
+            benchmark_results[json.dumps(result['benchmark'], sort_keys=True)][result['version']] = result
+    tables = []
+    for benchmark, version_results in benchmark_results.items():
+        stage_names = list(dict.fromkeys(name for x in version_results.values() for name in x['stages']))
+        rows = [[name] + ['{0:.3f}'.format(version_results[v]['stages'][name][field]) if v in version_results and name in version_results[v]['stages'] else '-'
+                          for v in versions] for name in stage_names]
+        tables.append('{0} ({1})\n{2}'.format(benchmark, field, format_table(['stage'] + [str(v) for v in versions], rows)))
+    return '\n\n'.join(tables)
+
+
+# end of setup parameters, start of the main block ######################################################
+if __name__ == '__main__':  # the session workers re-import this script when they are spawned
+    version = git_version()
+    for session_duration in session_durations:
+        data_root = os.path.join(benchmark_root, 'Sessions', '{0:g}s'.format(session_duration))
+        write_synthetic_participants(data_root, max(participant_counts), num_sessions_per_participant, session_duration, seed=seed,
+                                     eyetracking_srate=analysis.eyetracking_srate, exg_srate=analysis.exg_srate)
+        for num_participants in participant_counts:
+            checkpoint_root = os.path.join(benchmark_root, 'Checkpoints', '{0:g}s_{1}p'.format(session_duration, num_participants))
+            config = dict(analysis.session_config, varjoEyetracking_channelNames=VARJO_CHANNEL_NAMES,
+                          eventMarker_conditionIndex_dict=eventMarker_conditionIndex_dict, checkpoint_root=checkpoint_root,
+                          recompute_stages=(), is_regenerate_ica=False, is_interactive_ica=False)
+            session_tasks = synthetic_session_tasks(data_root, num_participants, num_sessions_per_participant, config)
+            shutil.rmtree(checkpoint_root, ignore_errors=True)
+            if is_refit_ica:
+                for task in session_tasks:
+                    for ica_path in [task[3] + '-ica.fif', task[3] + '.txt', task[3] + '-flags.json']:
+                        if os.path.exists(ica_path):
+                            os.remove(ica_path)
+            for run in ['cold', 'warm'] if is_benchmark_warm else ['cold']:
+                print('Benchmarking {0} sessions of {1} seconds, {2} participants, {3} run'.format(
+                    len(session_tasks), session_duration, num_participants, run))
+                start_time = time.time()
+                records = benchmark_sessions(session_tasks, n_workers=n_session_workers, n_ica_workers=n_ica_workers,
+                                             n_ica_threads=n_ica_threads, is_plot=is_benchmark_plot)
+                print('Took {0} seconds'.format(time.time() - start_time))
+                print(summary_table(records))
+                record_benchmark_result(results_path, records, session_duration=session_duration, num_participants=num_participants,
+                                        num_sessions=num_sessions_per_participant, n_session_workers=n_session_workers,
+                                        n_ica_workers=n_ica_workers, n_ica_threads=n_ica_threads,
+                                        is_plot=is_benchmark_plot, is_refit_ica=is_refit_ica, run=run)
+                save_trace(records, os.path.join(benchmark_root, 'Traces', 'trace_{0}_{1:g}s_{2}p_{3}_{4}.json'.format(
+                    version, session_duration, num_participants, run, time.strftime('%Y%m%d-%H%M%S'))))
+    print(compare_benchmark_results(results_path, compared_versions))
@@ -0,0 +1,53 @@
+"""
+Validation report and timing benchmark of the decimate-first EEG preprocessing path against the standard path
+(filter at 2048 Hz, then resample), see filter_resample_exg in utils.py
+
+Epochs the event-locked ERPs of one session with both paths, prints the per-mode timing and ERP agreement, and plots
+the two ERPs of a channel on top of each other
+"""
+import os
+import pickle
+
+import matplotlib.pyplot as plt
+import mne
+import numpy as np
+from rena.utils.data_utils import RNStream
+
+from utils import rescale_merge_exg, compare_preprocessing_modes
+
+#################################################################################################
+session_data_path = "C:/Users/S-Vec/Dropbox/ReNa/Data/ReNaPilot-2022Spring/Subjects/0/0.dats"
+condition_event_marker_index = slice(0, 4)  # RSVP
+exg_srate = 2048
+resample_srate = 128
+tmin = -0.1
+tmax = 0.8
+plot_channel = 'CPz'
+
+eeg_channel_names = mne.channels.make_standard_montage('biosemi64').ch_names
+ecg_ch_name = 'ECG00'
+
+# end of setup parameters, start of the main block ######################################################
+if os.path.exists(session_data_path.replace('dats', 'p')):
+    data = pickle.load(open(session_data_path.replace('dats', 'p'), 'rb'))
+else:
+    data = RNStream(session_data_path).stream_in(ignore_stream=('monitor1'), jitter_removal=False)
+
+exg_timestamps = data['BioSemi'][1]
+exg_data = rescale_merge_exg(data['BioSemi'][0][1:65, :], data['BioSemi'][0][65:67, :])
+event_markers = data['Unity.ReNa.EventMarkers'][0][condition_event_marker_index]
+event_timestamps = data['Unity.ReNa.EventMarkers'][1][event_markers[0] != 0]
+
+report = compare_preprocessing_modes(exg_data, exg_timestamps, eeg_channel_names + [ecg_ch_name],
+                                     ['eeg'] * len(eeg_channel_names) + ['ecg'], event_timestamps, tmin=tmin, tmax=tmax,
+                                     srate=exg_srate, resample_srate=resample_srate)
+
+channel_index = eeg_channel_names.index(plot_channel)
+for mode, mode_report in report.items():
+    time_vector = np.linspace(tmin, tmax, mode_report['erp'].shape[-1])
+    plt.plot(time_vector, mode_report['erp'][channel_index] * 1e6, label='{0} ({1:.1f} sec)'.format(mode, mode_report['seconds']))
+plt.xlabel('Time (sec)')
+plt.ylabel('BioSemi Channel {0} (μV)'.format(plot_channel))
+plt.title('Event-locked ERP by preprocessing mode')
+plt.legend()
+plt.show()
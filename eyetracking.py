@@ -1,11 +1,19 @@
 import math
+import os
 
 import numpy as np
 from matplotlib import pyplot as plt
+from scipy.signal import butter, sosfiltfilt
 
 SACCADE_CODE = 1
 FIXATION_CODE = 2
 
+# sample classes used by nslr_hmm, see nslr-hmm-master/nslr_hmm/nslr_hmm.py
+NSLR_HMM_FIXATION = 1
+NSLR_HMM_SACCADE = 2
+NSLR_HMM_PSO = 3
+NSLR_HMM_SMOOTH_PURSUIT = 4
+
 
 class Saccade:
     def __init__(self, amplitude, duration, peak_velocity, average_velocity, onset, offset, onset_time, offset_time, peak):
@@ -41,6 +49,26 @@ def running_mean(x, N):
     return (cumsum[N:] - cumsum[:-N]) / float(N)
 
 
+def varjo_gaze_xy_status(eyetracking_data, channel_names):
+    """
+    @return: tuple of the gaze forward x and y rows and the gaze status row of the Varjo eyetracking data
+    """
+    gaze_xy = eyetracking_data[[channel_names.index('gaze_forward_{0}'.format(x)) for x in ['x', 'y']]]
+    gaze_status = eyetracking_data[channel_names.index('status')]
+    return gaze_xy, gaze_status
+
+
+def gaze_velocities(gaze_xy_deg, gaze_timestamps):
+    """
+    @return: eye velocities in deg/s, the first velocity is assumed to be 0
+    """
+    dxy = np.diff(gaze_xy_deg, axis=1, prepend=gaze_xy_deg[:, :1])
+    dtheta = np.linalg.norm(dxy, axis=0)
+    velocities = dtheta / np.diff(gaze_timestamps, prepend=1)
+    velocities[0] = 0.  # assume the first velocity is 0
+    return velocities
+
+
 def gaze_event_detection(gaze_xy, gaze_status, gaze_timestamps,
                          saccade_min_peak=6, saccade_min_amplitude=2, saccade_spacing=20e-3, saccade_min_sample=2,
                          fixation_min_sample=2, glitch_threshold=1000):
@@ -69,10 +97,7 @@ def gaze_event_detection(gaze_xy, gaze_status, gaze_timestamps,
     gaze_xy_deg = (180 / math.pi) * np.arcsin(gaze_xy)
 
     # calculate eye velocity in degrees
-    dxy = np.diff(gaze_xy_deg, axis=1, prepend=gaze_xy_deg[:, :1])
-    dtheta = np.linalg.norm(dxy, axis=0)
-    velocities = dtheta / np.diff(gaze_timestamps, prepend=1)
-    velocities[0] = 0.  # assume the first velocity is 0
+    velocities = gaze_velocities(gaze_xy_deg, gaze_timestamps)
 
     events[velocities > glitch_threshold] = -1
 
@@ -148,3 +173,193 @@ def gaze_event_detection(gaze_xy, gaze_status, gaze_timestamps,
     for f in fixations:
         events[f.onset:f.offset] = FIXATION_CODE
     return events, fixations, saccades
+
+
+def _nslr_hmm_gaze_input(gaze_xy, gaze_status, gaze_timestamps):
+    """
+    convert the Varjo gaze direction to the (ts, xs) input nslr expects, xs is in degrees of shape (n, 2)
+    samples with invalid status are linearly interpolated from the valid ones so they don't break the segmentation
+    """
+    gaze_xy_deg = (180 / math.pi) * np.arcsin(gaze_xy)
+    valid = gaze_status == 2
+    if np.any(valid) and not np.all(valid):
+        gaze_xy_deg = np.array([np.interp(gaze_timestamps, gaze_timestamps[valid], x[valid]) for x in gaze_xy_deg])
+    return gaze_timestamps, gaze_xy_deg.T
+
+
+def nslr_hmm_classify_sessions(sessions, **kwargs):
+    """
+    classify the gaze samples of multiple sessions (e.g., all sessions of a participant) with NSLR-HMM in one call
+    requires the vendored nslr-hmm-master to be installed, along with its dependency nslr
+    @param sessions: list of tuples of (gaze_xy, gaze_status, gaze_timestamps), one for each session
+    @param kwargs: passed to nslr_hmm.classify_gaze_batch, e.g., observation_model, transition_model, structural_error
+    @return: list of sample class arrays, one for each session, values are the NSLR_HMM_* codes
+    """
+    import nslr_hmm
+    results = nslr_hmm.classify_gaze_batch([_nslr_hmm_gaze_input(*s) for s in sessions], **kwargs)
+    return [sample_classes for sample_classes, _, _ in results]
+
+
+def load_participant_gaze_model(model_path, sessions, is_refit=False, n_iterations=30):
+    """
+    load the personalized NSLR-HMM gaze model of a participant from model_path, the model is fit on the participant's
+    sessions with Baum-Welch reestimation and saved to model_path if it does not exist yet
+    @param sessions: list of tuples of (gaze_xy, gaze_status, gaze_timestamps), one for each session
+    @param is_refit: refit and overwrite the model even if it exists
+    @return: dict of the transition_model and observation_model, can be passed as kwargs to nslr_hmm_classify_sessions
+    """
+    import nslr_hmm
+    if not is_refit and os.path.exists(model_path):
+        transition_model, observation_model, metadata = nslr_hmm.load_model(model_path)
+        print('Loaded gaze model fit on {0} segments from {1}'.format(metadata['n_segments'], model_path))
+    else:
+        features = nslr_hmm.dataset_features([_nslr_hmm_gaze_input(*s) + (None,) for s in sessions])
+        features = [np.array(f) for f in features if len(f) > 0]
+        transition_model, observation_model = nslr_hmm.reestimate_observations_baum_welch(features, n_iterations=n_iterations)
+        nslr_hmm.save_model(model_path, transition_model, observation_model, method='baum_welch',
+                            n_iterations=n_iterations, n_sessions=len(features), n_segments=int(sum(len(f) for f in features)))
+        print('Saved gaze model to {0}'.format(model_path))
+    return {'transition_model': transition_model, 'observation_model': observation_model}
+
+
+def _class_runs(mask):
+    """
+    @return: onset (inclusive) and offset (exclusive) indices of the consecutive True runs in mask
+    """
+    edges = np.diff(np.concatenate([[0], mask.astype(int), [0]]))
+    return np.argwhere(edges == 1)[:, 0], np.argwhere(edges == -1)[:, 0]
+
+
+def gaze_event_detection_nslr_hmm(gaze_xy, gaze_status, gaze_timestamps, sample_classes=None,
+                                  saccade_min_sample=2, fixation_min_sample=2, **kwargs):
+    """
+    gaze event detection based on NSLR-HMM (https://doi.org/10.1038/s41598-017-17983-x)
+    produces the same outputs as gaze_event_detection so it can be used in its place
+    fixations are the samples classified as fixation between two consecutive saccades, post-saccadic oscillations
+    and smooth pursuits are not turned into events
+
+    @param sample_classes: precomputed sample classes from nslr_hmm_classify_sessions, the classification is run on
+    this session alone if not given
+    @param kwargs: passed to nslr_hmm_classify_sessions
+    @return
+    event types: -1: noise or glitch; 1: saccade; 2: fixation
+    """
+    if sample_classes is None:
+        sample_classes = nslr_hmm_classify_sessions([(gaze_xy, gaze_status, gaze_timestamps)], **kwargs)[0]
+    events = np.zeros(gaze_timestamps.shape)
+    events[gaze_status != 2] = -1  # remove points where the status is invalid from the eyetracker
+    saccades = []
+    fixations = []
+
+    gaze_xy_deg = (180 / math.pi) * np.arcsin(gaze_xy)
+    velocities = gaze_velocities(gaze_xy_deg, gaze_timestamps)
+    last_index = len(gaze_timestamps) - 1
+
+    for onset, offset in zip(*_class_runs(sample_classes == NSLR_HMM_SACCADE)):
+        offset = min(offset, last_index)
+        if offset - onset < saccade_min_sample:
+            continue
+        if np.any(events[onset:offset] == -1):  # check if gaze status is invalid during the saccade
+            continue
+        peak = onset + np.argmax(velocities[onset:offset])
+        amplitude = np.linalg.norm(gaze_xy_deg[:, offset] - gaze_xy_deg[:, onset], axis=0)
+        duration = gaze_timestamps[offset] - gaze_timestamps[onset]
+        saccades.append(Saccade(amplitude, duration, velocities[peak], np.mean(velocities[onset:offset]), onset, offset,
+                                gaze_timestamps[onset], gaze_timestamps[offset], peak))
+
+    # identify the fixations for all the intervals between saccades
+    is_fixation = np.logical_and(sample_classes == NSLR_HMM_FIXATION, events != -1)
+    for i in range(1, len(saccades)):
+        interval_fixation_indices = saccades[i - 1].offset + np.argwhere(is_fixation[saccades[i - 1].offset:saccades[i].onset])[:, 0]
+        if len(interval_fixation_indices) <= fixation_min_sample:
+            continue
+        onset, offset = interval_fixation_indices[0], interval_fixation_indices[-1] + 1
+        _xy_deg = gaze_xy_deg[:, interval_fixation_indices]
+        dispersion = np.max(_xy_deg, axis=1) - np.min(_xy_deg, axis=1)
+        fixations.append(Fixation(gaze_timestamps[offset] - gaze_timestamps[onset], dispersion, saccades[i - 1], saccades[i],
+                                  onset, offset, gaze_timestamps[onset], gaze_timestamps[offset]))
+
+    for s in saccades:
+        events[s.onset:s.offset] = SACCADE_CODE
+    for f in fixations:
+        events[f.onset:f.offset] = FIXATION_CODE
+    return events, fixations, saccades
+
+
+# gaze detector backends that can be chosen per run, all of them return (events, fixations, saccades)
+gaze_event_detectors = {'ivt': gaze_event_detection, 'nslr_hmm': gaze_event_detection_nslr_hmm}
+
+
+def detect_gaze_events(detector, gaze_xy, gaze_status, gaze_timestamps, **kwargs):
+    """
+    @param detector: str: name of the detector backend, one of the keys of gaze_event_detectors
+    """
+    if detector not in gaze_event_detectors.keys():
+        raise ValueError("Unknown gaze detector {0}, must be one of {1}".format(detector, list(gaze_event_detectors.keys())))
+    return gaze_event_detectors[detector](gaze_xy, gaze_status, gaze_timestamps, **kwargs)
+
+
+def _pad_mask(mask, pad_before, pad_after):
+    """
+    @return: mask with every True sample extended by pad_before samples before it and pad_after samples after it
+    """
+    mask_cumsum = np.concatenate([np.zeros(mask.shape[:-1] + (1,)), np.cumsum(mask, axis=-1)], axis=-1)
+    indices = np.arange(mask.shape[-1])
+    window_end = np.minimum(indices + pad_before + 1, mask.shape[-1])
+    window_start = np.maximum(indices - pad_after, 0)
+    return mask_cumsum[..., window_end] - mask_cumsum[..., window_start] > 0
+
+
+def average_binocular_pupil(pupil, axis=0, is_zero_nan=False):
+    """
+    NaN-aware average of the left and right pupil sizes, where one eye is nan it falls back to the other eye
+    @param pupil: the pupil sizes, with left and right along axis
+    @param is_zero_nan: treat zeros as nan, e.g., the pupil size is zero when the eye is not tracked
+    @return: the binocular pupil size without axis, nan only where both eyes are
+    """
+    pupil = np.asarray(pupil, dtype=float)
+    valid = ~np.isnan(pupil)
+    if is_zero_nan:
+        valid &= pupil != 0
+    with np.errstate(invalid='ignore'):  # 0 / 0 is nan where no eye is valid
+        return np.sum(np.where(valid, pupil, 0.), axis=axis) / np.sum(valid, axis=axis)
+
+
+def preprocess_pupil(eyetracking_data, eyetracking_timestamps, channel_names, srate=200, blink_padding=(0.1, 0.15),
+                     dilation_speed_n_mad=8, lowpass=4., min_pupil_size=1e-3):
+    """
+    clean the continuous left and right pupil size of a whole session before epoching, both eyes are processed together
+    1. blinks and tracking loss: samples where the eye status is invalid (0) or the pupil size is missing
+    2. dilation speed outliers (Kret & Sjak-Shie 2019): the larger of the backward and forward pupil size change speed
+    exceeds its median by dilation_speed_n_mad median absolute deviations
+    3. the invalid samples are padded by blink_padding, linearly interpolated over time, and low-pass filtered
+    @param channel_names: the Varjo channel names, must have left/right_pupil_size and left/right_status
+    @param blink_padding: seconds padded before and after each invalid interval
+    @param lowpass: cutoff in Hz of the zero-phase Butterworth low-pass, None to not filter
+    @return: the cleaned pupil sizes of shape (2, samples) for left and right, their binocular average (see
+    average_binocular_pupil), and the invalid mask of shape (2, samples)
+    """
+    pupil = eyetracking_data[[channel_names.index('{0}_pupil_size'.format(x)) for x in ['left', 'right']]].astype(float)
+    eye_status = eyetracking_data[[channel_names.index('{0}_status'.format(x)) for x in ['left', 'right']]]
+    invalid = np.logical_or.reduce([eye_status == 0, np.isnan(pupil), pupil < min_pupil_size])
+
+    dt = np.diff(eyetracking_timestamps)
+    speed = np.abs(np.diff(pupil, axis=1)) / dt
+    speed = np.fmax(np.pad(speed, ((0, 0), (1, 0)), constant_values=np.nan),
+                    np.pad(speed, ((0, 0), (0, 1)), constant_values=np.nan))  # the larger of backward and forward
+    valid_speed = np.where(invalid, np.nan, speed)
+    speed_median = np.nanmedian(valid_speed, axis=1, keepdims=True)
+    speed_mad = np.nanmedian(np.abs(valid_speed - speed_median), axis=1, keepdims=True)
+    invalid |= speed > speed_median + dilation_speed_n_mad * speed_mad
+
+    invalid = _pad_mask(invalid, int(blink_padding[0] * srate), int(blink_padding[1] * srate))
+    for eye_pupil, eye_invalid in zip(pupil, invalid):
+        if np.all(eye_invalid):
+            eye_pupil[:] = np.nan
+            print('preprocess_pupil: no valid pupil samples for one of the eyes')
+        elif np.any(eye_invalid):
+            eye_pupil[eye_invalid] = np.interp(eyetracking_timestamps[eye_invalid], eyetracking_timestamps[~eye_invalid],
+                                               eye_pupil[~eye_invalid])
+    if lowpass is not None:
+        pupil = sosfiltfilt(butter(4, lowpass, btype='lowpass', fs=srate, output='sos'), pupil, axis=1)
+    return pupil, average_binocular_pupil(pupil), invalid
@@ -1,31 +1,102 @@
+import hashlib
+import json
 import os
 import pickle
 
+import numpy as np
+
 from rena.utils.data_utils import RNStream
 
 
-def load_participant_session_dict(participant_session_dict, is_data_preloaded, is_save_loaded_data, preloaded_dats_path):
-    if not is_data_preloaded:
-        print("Preloading .dats")  # TODO parallelize loading of .dats
-        for p_i, (participant_index, session_dict) in enumerate(participant_session_dict.items()):
-            print("Working on participant-code[{0}]: {2} of {1}".format(int(participant_index),
-                                                                        len(participant_session_dict), p_i + 1))
-            for session_index, session_files in session_dict.items():
-                print("Session {0} of {1}".format(session_index + 1, len(session_dict)))
-                data_path, item_catalog_path, session_log_path, session_ICA_path = session_files
-                if os.path.exists(
-                        data_path.replace('dats', 'p')):  # load pickle if it's available as it is faster than dats
-                    data = pickle.load(open(data_path.replace('dats', 'p'), 'rb'))
-                else:
-                    data = RNStream(data_path).stream_in(ignore_stream=('monitor1'), jitter_removal=False)
-                participant_session_dict[participant_index][session_index][0] = data
-        # save the preloaded .dats
-        if is_save_loaded_data:
-            print("Saving preloaded sessions...")
-            pickle.dump(participant_session_dict, open(preloaded_dats_path, 'wb'))
-    else:
-        print("Loading preloaded sessions...")
-        participant_session_dict = pickle.load(open(preloaded_dats_path, 'rb'))
-    return participant_session_dict
+def load_session_data(data_path):
+    """
+    load the streams of a session, from its pickle if it's available as it is faster than dats
+    """
+    if os.path.exists(data_path.replace('dats', 'p')):
+        return pickle.load(open(data_path.replace('dats', 'p'), 'rb'))
+    return RNStream(data_path).stream_in(ignore_stream=('monitor1'), jitter_removal=False)
+
+
+def file_identity(path):
+    """
+    size and modification time of a file, used in place of its content in the keys of inputs that are too large to
+    hash, None if the file does not exist
+    """
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _json_default(x):
+    if isinstance(x, slice):
+        return [x.start, x.stop, x.step]
+    return np.asarray(x).tolist()
+
+
+def hash_inputs(*arrays, **params):
+    """
+    content hash of the given arrays and parameters, used as the key of the disk caches
+    changing any array value, shape or dtype, or any parameter gives a different key
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        h.update(str((a.shape, a.dtype.str)).encode())
+        h.update(memoryview(a).cast('B'))
+    h.update(json.dumps(params, sort_keys=True, default=_json_default).encode())
+    return h.hexdigest()
+
+
+def load_cached_array(cache_root, key):
+    """
+    :return: the cached array memory-mapped read-only and its metadata, or (None, None) if the key is not cached
+    """
+    array_path = os.path.join(cache_root, key + '.npy')
+    metadata_path = os.path.join(cache_root, key + '.json')
+    if not os.path.exists(array_path) or not os.path.exists(metadata_path):
+        return None, None
+    with open(metadata_path, 'r') as f:
+        metadata = json.load(f)
+    return np.load(array_path, mmap_mode='r'), metadata
+
+
+def save_cached_array(cache_root, key, array, **metadata):
+    """
+    save the array as .npy so it can be memory-mapped when loaded, along with a json of its metadata
+    the files are written under temporary names first so an interrupted run does not leave a partial cache entry
+    """
+    os.makedirs(cache_root, exist_ok=True)
+    array_path = os.path.join(cache_root, key + '.npy')
+    metadata_path = os.path.join(cache_root, key + '.json')
+    with open(array_path + '.tmp', 'wb') as f:
+        np.save(f, array)
+    os.replace(array_path + '.tmp', array_path)
+    with open(metadata_path + '.tmp', 'w') as f:
+        json.dump(metadata, f, default=lambda x: np.asarray(x).tolist())
+    os.replace(metadata_path + '.tmp', metadata_path)
+
+
+def load_checkpoint(checkpoint_root, stage, key):
+    """
+    :return: the pickled output of a stage, or None if the key is not checkpointed
+    """
+    checkpoint_path = os.path.join(checkpoint_root, stage, key + '.p')
+    if not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path, 'rb') as f:
+        return pickle.load(f)
+
+
+def save_checkpoint(checkpoint_root, stage, key, output):
+    """
+    pickle the output of a stage, written under a temporary name first so an interrupted run does not leave a partial
+    checkpoint
+    """
+    os.makedirs(os.path.join(checkpoint_root, stage), exist_ok=True)
+    checkpoint_path = os.path.join(checkpoint_root, stage, key + '.p')
+    with open(checkpoint_path + '.tmp', 'wb') as f:
+        pickle.dump(output, f)
+    os.replace(checkpoint_path + '.tmp', checkpoint_path)
 
 # def save_epoch_dict(epoch_dict, file_path):
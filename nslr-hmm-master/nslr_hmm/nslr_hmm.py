@@ -1,10 +1,11 @@
 # Copyleft 2017 Jami Pekkanen <jami.pekkanen@gmail.com>.
 # Released under AGPL-3.0, see LICENSE.
 
+import json
 import numpy as np
-import scipy.stats
 import nslr
 import itertools
+import collections
 
 class ObservationModel:
     def __init__(self, dists):
@@ -28,6 +29,29 @@ class ObservationModel:
     def dist(self, cls):
         return self.dists[self.classidx[cls]]
 
+class GaussianObservationModel(ObservationModel):
+    """Observation model of multivariate normal classes evaluated with plain numpy.
+
+    Takes a dict of class -> (mean, covariance). The inverse covariances and
+    normalizing constants are computed once, so evaluating the likelihoods
+    does not construct any scipy distribution objects. dists holds the
+    (mean, covariance) tuples.
+    """
+    def __init__(self, params):
+        super().__init__({cls: (np.asarray(m, dtype=float), np.asarray(c, dtype=float)) for cls, (m, c) in params.items()})
+        self.means = np.array([m for m, _ in self.dists])
+        self.covs = np.array([c for _, c in self.dists])
+        self.precisions = np.linalg.inv(self.covs)
+        _, logdets = np.linalg.slogdet(self.covs)
+        self.log_norms = -0.5*(self.means.shape[1]*np.log(2*np.pi) + logdets)
+
+    def liks(self, d):
+        d = np.asarray(d, dtype=float)
+        diff = np.atleast_2d(d)[:, None, :] - self.means[None]
+        mahalanobis = np.einsum('nki,kij,nkj->nk', diff, self.precisions, diff)
+        scores = np.exp(self.log_norms - 0.5*mahalanobis)
+        return scores[0] if d.ndim == 1 else scores
+
 FIXATION = 1
 SACCADE = 2
 PSO = 3
@@ -42,12 +66,7 @@ def gaze_observation_model():
         SMOOTH_PURSUIT: [[0.8175021916433242, 0.3047120126632254], [[0.13334607025750783, 0.0], [0.0, 2.5328705587328173]]]
     }
         
-    dists = {
-        cls: scipy.stats.multivariate_normal(m, c)
-        for cls, (m, c) in params.items()
-    }
-    
-    return ObservationModel(dists)
+    return GaussianObservationModel(params)
 
 
 def gaze_transition_model():
@@ -64,6 +83,36 @@ def gaze_transition_model():
 GazeObservationModel = gaze_observation_model()
 GazeTransitionModel = gaze_transition_model()
 
+MODEL_FORMAT_VERSION = 1
+
+def save_model(path, transition_probs, observation_model, **metadata):
+    """Save a (transition_probs, observation_model) pair as a compact .npz.
+
+    The file holds the class codes, means, covariances and transition
+    probabilities as plain arrays plus a JSON metadata string, so it can
+    be loaded without pickling or scipy.
+    """
+    params = [observation_model.dist(cls) for cls in observation_model.idxclass]
+    params = [(dist.mean, dist.cov) if hasattr(dist, 'cov') else dist for dist in params]
+    metadata = dict(metadata, format_version=MODEL_FORMAT_VERSION)
+    np.savez(path,
+        classes=np.asarray(observation_model.idxclass),
+        means=np.array([m for m, _ in params], dtype=float),
+        covs=np.array([c for _, c in params], dtype=float),
+        transitions=np.asarray(transition_probs, dtype=float),
+        metadata=np.array(json.dumps(metadata)))
+
+def load_model(path):
+    """Load a model saved with save_model, returns (transition_probs, observation_model, metadata)"""
+    with np.load(path, allow_pickle=False) as f:
+        metadata = json.loads(str(f['metadata']))
+        if metadata.get('format_version') != MODEL_FORMAT_VERSION:
+            raise ValueError("Unsupported gaze model format version {0} in {1}".format(metadata.get('format_version'), path))
+        observation_model = GaussianObservationModel({
+            cls: (m, c) for cls, m, c in zip(f['classes'].tolist(), f['means'], f['covs'])
+        })
+        return f['transitions'], observation_model, metadata
+
 def safelog(x):
     return np.log10(np.clip(x, 1e-6, None))
 
@@ -191,7 +240,7 @@ def reestimate_observations_baum_welch(sessions,
             cov = np.cov(all_observations, aweights=w, rowvar=False)
             if plot_process:
                 plt.plot(mean[0], mean[1], 'o', color=CLASS_COLORS[cls])
-            dists[cls] = scipy.stats.multivariate_normal(mean, cov)
+            dists[cls] = (mean, cov)
         if plot_process:
             plt.pause(0.1)
             plt.cla()
@@ -201,7 +250,7 @@ def reestimate_observations_baum_welch(sessions,
             transition_probs = np.mean(all_transition_probs, axis=0)
             transition_probs /= np.sum(transition_probs, axis=1).reshape(-1, 1)
         if estimate_observation_model:
-            observation_model=ObservationModel(dists)
+            observation_model=GaussianObservationModel(dists)
     return transition_probs, observation_model
 
 def reestimate_observations_viterbi_robust(
@@ -255,7 +304,7 @@ def reestimate_observations_viterbi_robust(
 
             # Don't reestimate if such class is not found
             if np.sum(my) < 2:
-                dists[cls] = observation_model.dists[cls]
+                dists[cls] = observation_model.dist(cls)
                 continue
             
             # Use this for non-robust
@@ -265,7 +314,7 @@ def reestimate_observations_viterbi_robust(
             robust = MinCovDet().fit(all_observations[my])
             mean = robust.location_
             cov = robust.covariance_
-            dists[cls] = scipy.stats.multivariate_normal(mean, cov)
+            dists[cls] = (mean, cov)
             
             if plot_process:
                 plt.plot(mean[0], mean[1], 'o', color=CLASS_COLORS[cls])
@@ -286,29 +335,109 @@ def reestimate_observations_viterbi_robust(
             transition_probs = new_transition_probs
 
         if estimate_observation_model:
-            observation_model=ObservationModel(dists)
+            observation_model=GaussianObservationModel(dists)
     return transition_probs, observation_model
 
+def segment_feature(segment, prev_direction):
+    duration = float(np.diff(segment.t))
+    speed = np.diff(segment.x, axis=0) / duration
+    velocity = float(np.linalg.norm(speed))
+    direction = speed/velocity
+    cosangle = float(np.dot(direction, prev_direction.T))
+
+    # Fisher transform, avoid exact |1|
+    cosangle *= (1 - 1e-6)
+    cosangle = np.arctanh(cosangle)
+    if cosangle != cosangle:
+        cosangle = 0.0
+
+    return (safelog(velocity), cosangle), direction
+
 def segment_features(segments, outliers=None):
     prev_direction = np.array([0.0, 0.0])
     if outliers is None:
-        outliers = np.zeros(segments[-1].participant_index[-1], dtype=bool)
+        outliers = np.zeros(segments[-1].i[-1], dtype=bool)
     for segment in segments:
-        if np.any(outliers[segment.participant_index[0]:segment.participant_index[1]]): continue
-        duration = float(np.diff(segment.t))
-        speed = np.diff(segment.single_trial_df, axis=0) / duration
-        velocity = float(np.linalg.norm(speed))
-        direction = speed/velocity
-        cosangle = float(np.dot(direction, prev_direction.T))
-        
-        # Fisher transform, avoid exact |1|
-        cosangle *= (1 - 1e-6)
-        cosangle = np.arctanh(cosangle)
-        if cosangle != cosangle:
-            cosangle = 0.0
-        
-        yield safelog(velocity), cosangle
-        prev_direction = direction
+        if np.any(outliers[segment.i[0]:segment.i[1]]): continue
+        feature, prev_direction = segment_feature(segment, prev_direction)
+        yield feature
+
+class FixedLagViterbi:
+    """Online Viterbi decoder that commits class labels with a fixed lag.
+
+    Segments (or their features) are pushed one at a time as the segmentation
+    produces them. Each push costs one O(N^2) Viterbi step over the N classes
+    plus an O(lag) traceback to commit the label of the segment that is `lag`
+    segments old; that label is final and is never revised. With lag=0 every
+    segment is committed immediately, a larger lag approaches the offline
+    Viterbi path of classify_segments.
+    """
+    def __init__(self, lag=5,
+            observation_model=GazeObservationModel,
+            transition_model=GazeTransitionModel,
+            initial_probabilities=None):
+        if lag < 0:
+            raise ValueError("lag must be non-negative")
+        if initial_probabilities is None:
+            initial_probabilities = np.ones(len(transition_model))
+            initial_probabilities /= np.sum(initial_probabilities)
+        self.lag = lag
+        self.observation_model = observation_model
+        self.log_transitions = safelog(transition_model)
+        self.log_initial = safelog(initial_probabilities)
+        self.n_states = len(transition_model)
+        self.reset()
+
+    def reset(self):
+        self.probs = None
+        self.backpointers = collections.deque()  # backpointer arrays of the uncommitted segments
+        self.n_seen = 0
+        self.n_committed = 0
+        self.prev_direction = np.array([0.0, 0.0])
+
+    def push_segment(self, segment):
+        """Push a new NSLR segment, returns the newly committed (segment index, class) pairs"""
+        feature, self.prev_direction = segment_feature(segment, self.prev_direction)
+        return self.push_feature(feature)
+
+    def push_feature(self, feature):
+        """Push the features of a new segment, returns the newly committed (segment index, class) pairs"""
+        emission = np.array(self.observation_model.liks(feature), dtype=float).reshape(-1)
+        emission /= np.sum(emission)
+        if self.probs is None:
+            self.probs = safelog(emission) + self.log_initial
+        else:
+            trans_probs = self.log_transitions + np.row_stack(self.probs)
+            most_likely_states = np.argmax(trans_probs, axis=0)
+            self.probs = safelog(emission) + trans_probs[most_likely_states, np.arange(self.n_states)]
+            self.probs -= np.max(self.probs)  # keep the log probabilities bounded on long streams
+            if self.n_seen > self.n_committed:  # the transition from a committed segment is never traced back
+                self.backpointers.append(most_likely_states)
+        self.n_seen += 1
+
+        committed = []
+        if self.n_seen - self.n_committed > self.lag:
+            committed.append(self._commit_oldest())
+        return committed
+
+    def flush(self):
+        """End the stream: commit the remaining segments using the best path and reset the decoder"""
+        committed = []
+        while self.n_committed < self.n_seen:
+            committed.append(self._commit_oldest())
+        self.reset()
+        return committed
+
+    def _commit_oldest(self):
+        # backpointers hold exactly the transitions between the uncommitted segments
+        state = np.argmax(self.probs)
+        for most_likely_states in reversed(self.backpointers):
+            state = most_likely_states[state]
+        if self.backpointers:
+            self.backpointers.popleft()
+        index = self.n_committed
+        self.n_committed += 1
+        return index, self.observation_model.idxclass[state]
 
 def classify_segments(segments,
         observation_model=GazeObservationModel,
@@ -322,16 +451,61 @@ def classify_segments(segments,
     path = viterbi(initial_probabilities, transition_model, observation_likelihoods)
     return observation_model.idxclass[path]
     
-def classify_gaze(ts, xs, **kwargs):
-    fit_params = {k: kwargs[k]
+def segment_sample_classes(segments, seg_classes, n_samples):
+    """Expand per-segment classes to per-sample classes with a single vectorized repeat"""
+    sample_classes = np.zeros(n_samples)
+    if len(segments) == 0:
+        return sample_classes
+    bounds = np.array([s.i for s in segments], dtype=int)
+    lengths = bounds[:, 1] - bounds[:, 0]
+    offsets = np.arange(np.sum(lengths)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    sample_classes[np.repeat(bounds[:, 0], lengths) + offsets] = np.repeat(seg_classes, lengths)
+    return sample_classes
+
+def _fit_params(kwargs):
+    return {k: kwargs[k]
             for k in ('structural_error', 'optimize_noise', 'split_likelihood') if k in kwargs
     }
-    segmentation = nslr.fit_gaze(ts, xs, **fit_params)
+
+def classify_gaze(ts, xs, **kwargs):
+    segmentation = nslr.fit_gaze(ts, xs, **_fit_params(kwargs))
     seg_classes = classify_segments(segmentation.segments)
-    sample_classes = np.zeros(len(ts))
-    for c, s in zip(seg_classes, segmentation.segments):
-        start = s.participant_index[0]
-        end = s.participant_index[1]
-        sample_classes[start:end] = c
+    sample_classes = segment_sample_classes(segmentation.segments, seg_classes, len(ts))
 
     return sample_classes, segmentation, seg_classes
+
+def classify_gaze_batch(sessions,
+        observation_model=GazeObservationModel,
+        transition_model=GazeTransitionModel,
+        initial_probabilities=None,
+        **kwargs):
+    """Classify several recordings (e.g. all sessions of a participant) in one call.
+
+    The segment features of all the sessions are scored by the observation
+    model in one vectorized call, after which each session is decoded
+    separately as the sessions are independent sequences.
+
+    sessions: iterable of (ts, xs) tuples, as passed to classify_gaze
+    returns a list of (sample_classes, segmentation, seg_classes), one per session
+    """
+    if initial_probabilities is None:
+        initial_probabilities = np.ones(len(transition_model))
+        initial_probabilities /= np.sum(initial_probabilities)
+    fit_params = _fit_params(kwargs)
+
+    sessions = list(sessions)
+    segmentations = [nslr.fit_gaze(ts, xs, **fit_params) for ts, xs in sessions]
+    features = [np.array(list(segment_features(s.segments))).reshape(-1, 2) for s in segmentations]
+    split_indices = np.cumsum([len(f) for f in features])[:-1]
+    all_liks = observation_model.liks(np.vstack(features)).reshape(-1, len(transition_model))
+
+    results = []
+    for (ts, xs), segmentation, liks in zip(sessions, segmentations, np.split(all_liks, split_indices)):
+        if len(liks) == 0:
+            seg_classes = observation_model.idxclass[[]]
+        else:
+            path = viterbi(initial_probabilities, transition_model, liks)
+            seg_classes = observation_model.idxclass[path]
+        sample_classes = segment_sample_classes(segmentation.segments, seg_classes, len(ts))
+        results.append((sample_classes, segmentation, seg_classes))
+    return results
@@ -0,0 +1,158 @@
+"""
+Profiling of the analysis pipeline: wall time, CPU time and peak RSS of every stage of every session
+
+A stage is timed with the profile_stage context manager into the profiler of the current process. Stages can be nested,
+a nested stage inherits the arguments (e.g., participant and session) of the stage it runs in on the same thread, and
+its time is subtracted from the self time of its parent. The session workers have their own profilers, whose records
+are sent back with the session results and added to the main process's profiler, see run_sessions in
+session_pipeline.py.
+
+The records are summarized with summary_table, and saved with save_trace as a trace-event JSON timeline that can be
+opened in chrome://tracing or https://ui.perfetto.dev, one track per process.
+"""
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import psutil
+
+
+class StageProfiler:
+    """
+    records of the stages run in this process, a record is a dict of name, args, pid, tid, start (seconds since the
+    epoch), wall, cpu, self_wall, self_cpu (seconds) and peak_rss (bytes)
+    the peak RSS of a stage is sampled every rss_interval seconds by a background thread while the stage is running.
+    The CPU time is that of the whole process, so it includes the threads of numpy and mne
+    """
+    def __init__(self, rss_interval=0.05):
+        self.rss_interval = rss_interval
+        self.records = []
+        self._reset()
+
+    def _reset(self):
+        self._process = psutil.Process()
+        self._open_stages = []
+        self._lock = threading.Lock()
+        self._sampler = None
+
+    def _sample_rss(self):
+        while True:
+            rss = self._process.memory_info().rss
+            with self._lock:
+                if len(self._open_stages) == 0:
+                    self._sampler = None
+                    return
+                for open_stage in self._open_stages:
+                    open_stage['peak_rss'] = max(open_stage['peak_rss'], rss)
+            time.sleep(self.rss_interval)
+
+    @contextmanager
+    def stage(self, name, **args):
+        if self._process.pid != os.getpid():  # a forked worker starts with a copy of its parent's profiler
+            self.records = []
+            self._reset()
+        with self._lock:
+            parents = [x for x in self._open_stages if x['tid'] == threading.get_ident()]
+            parent = parents[-1] if len(parents) > 0 else None
+            open_stage = {'args': dict(parent['args'], **args) if parent else args, 'tid': threading.get_ident(),
+                          'peak_rss': self._process.memory_info().rss, 'children_wall': 0., 'children_cpu': 0.}
+            self._open_stages.append(open_stage)
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample_rss, daemon=True)
+                self._sampler.start()
+        start, start_wall, start_cpu = time.time(), time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+            rss = self._process.memory_info().rss
+            with self._lock:
+                self._open_stages = [x for x in self._open_stages if x is not open_stage]
+                if parent is not None:
+                    parent['children_wall'] += wall
+                    parent['children_cpu'] += cpu
+                    parent['peak_rss'] = max(parent['peak_rss'], open_stage['peak_rss'], rss)
+            self.records.append({'name': name, 'args': open_stage['args'], 'pid': os.getpid(), 'tid': threading.get_ident(),
+                                 'start': start, 'wall': wall, 'cpu': cpu,
+                                 'self_wall': wall - open_stage['children_wall'], 'self_cpu': cpu - open_stage['children_cpu'],
+                                 'peak_rss': max(open_stage['peak_rss'], rss)})
+
+    def drain(self):
+        """
+        :return: the records so far, and clear them, used by the session workers to send their records back
+        """
+        records, self.records = self.records, []
+        return records
+
+
+_profiler = StageProfiler()
+
+
+def get_profiler():
+    """
+    :return: the profiler of this process
+    """
+    return _profiler
+
+
+def profile_stage(name, **args):
+    """
+    time a stage into the profiler of this process
+    with profile_stage('epoching', participant=participant_index, session=session_index):
+        ...
+    """
+    return _profiler.stage(name, **args)
+
+
+def summarize_records(records, by=('name',)):
+    """
+    :param by: the record fields or args to group the records by, e.g., ('name', 'participant', 'session')
+    :return: dict of group -> dict of count, the summed wall, self_wall, cpu and self_cpu in seconds, and the max
+    peak_rss in bytes. Wall and CPU are inclusive of the nested stages, self wall and self CPU are not
+    """
+    groups = defaultdict(list)
+    for record in records:
+        groups[tuple(record[x] if x in record else record['args'].get(x) for x in by)].append(record)
+    return dict((key, dict([('count', len(group))] + [(x, sum(r[x] for r in group)) for x in ['wall', 'self_wall', 'cpu', 'self_cpu']] +
+                           [('peak_rss', max(r['peak_rss'] for r in group))]))
+                for key, group in groups.items())
+
+
+def format_table(header, rows):
+    """
+    :return: the rows as a printable table with left-aligned columns
+    """
+    widths = [max(len(str(x)) for x in column) for column in zip(header, *rows)]
+    lines = ['  '.join(str(x).ljust(w) for x, w in zip(row, widths)) for row in [header] + rows]
+    return '\n'.join(lines[:1] + ['-' * len(lines[0])] + lines[1:])
+
+
+def summary_table(records, by=('name',)):
+    """
+    :return: the summary of summarize_records as a printable table, the groups are sorted by their total self wall time,
+    times are in seconds and the peak RSS in MB
+    """
+    summary = summarize_records(records, by)
+    header = list(by) + ['count', 'wall', 'self wall', 'cpu', 'self cpu', 'peak rss']
+    rows = [list(key) + [group['count']] + ['{0:.3f}'.format(group[x]) for x in ['wall', 'self_wall', 'cpu', 'self_cpu']] +
+            ['{0:.1f}'.format(group['peak_rss'] / 2 ** 20)]
+            for key, group in sorted(summary.items(), key=lambda x: -x[1]['self_wall'])]
+    return format_table(header, rows)
+
+
+def save_trace(records, path):
+    """
+    save the records as a trace-event JSON of complete events, the CPU time and peak RSS are in the events' args
+    """
+    trace_events = [{'name': record['name'], 'cat': 'stage', 'ph': 'X', 'pid': record['pid'], 'tid': record['tid'],
+                     'ts': record['start'] * 1e6, 'dur': record['wall'] * 1e6,
+                     'args': dict(record['args'], cpu=record['cpu'], self_cpu=record['self_cpu'],
+                                  peak_rss_mb=record['peak_rss'] / 2 ** 20)}
+                    for record in records]
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f, default=str)
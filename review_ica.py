@@ -0,0 +1,59 @@
+"""
+Manual review of the ICA exclusions that ReNaAnalysisEEG.py saved without asking, see load_or_fit_ica in utils.py
+
+For every session ICA solution in data_root whose exclusions are not reviewed yet, prints the flagged ECG and EOG-like
+components with their scores, plots the components and, if is_plot_sources, the sources on the session's preprocessed
+exg, which is loaded from its preprocess checkpoint if there is one. The entered exclusions are saved in place of the
+proposed ones, which changes the ICA checkpoint keys, so the next analysis run recomputes the ICA and epoch stages of
+the reviewed sessions.
+"""
+import glob
+import json
+import os
+
+import matplotlib.pyplot as plt
+import mne
+
+import ReNaAnalysisEEG as analysis
+from session_pipeline import process_session
+from utils import load_ica_flags, save_ica_excludes, read_file_lines_as_list
+
+#################################################################################################
+data_root = analysis.data_root
+is_review_all = False  # also review the solutions that are already reviewed, or were fitted interactively without flags
+is_plot_sources = True
+
+# end of setup parameters, start of the main block ######################################################
+if __name__ == '__main__':
+    session_config = dict(analysis.session_config, varjoEyetracking_channelNames=json.load(open(analysis.varjoEyetrackingComplete_preset_path))['ChannelNames'])
+    for ica_fif_path in sorted(glob.glob(os.path.join(data_root, '*', '*_ParticipantSessionICA-ica.fif'))):
+        ica_path = ica_fif_path[:-len('-ica.fif')]
+        ica_flags = load_ica_flags(ica_path)
+        if not is_review_all and (ica_flags is None or ica_flags['reviewed']):
+            continue
+        participant_directory, session_file_name = os.path.split(ica_path)
+        participant_index, session_index = os.path.basename(participant_directory), int(session_file_name.split('_')[0])
+        print('Reviewing the ICA of participant {0}, session {1}'.format(participant_index, session_index))
+
+        ica = mne.preprocessing.read_ica(ica_fif_path)
+        with open(ica_path + '.txt', 'r') as filehandle:
+            ica.exclude = [int(line.rstrip()) for line in filehandle.readlines()]
+        for artifact in ['ecg', 'eog']:
+            [print('Flagged {0} component at ICA index {1} with score {2}'.format(artifact.upper(), x, ica_flags[artifact + '_scores'][x]))
+             for x in (ica_flags or {}).get(artifact, [])]
+
+        if is_plot_sources:
+            bad_channels = read_file_lines_as_list(os.path.join(participant_directory, 'badchannels.txt')) \
+                if os.path.exists(os.path.join(participant_directory, 'badchannels.txt')) else None
+            session_files = [os.path.join(participant_directory, x.format(session_index)) for x in
+                             ['{0}.dats', '{0}_ReNaItemCatalog.json', '{0}_ReNaSessionLog.json', '{0}_ParticipantSessionICA']]
+            raw_exg, _ = process_session(*session_files, participant_index, session_index, bad_channels, None, session_config,
+                                         return_stage='preprocess')
+            ica.plot_sources(raw_exg, show=False)
+        ica.plot_components(show=False)
+        plt.show(block=False)
+        ica_excludes = input("Enter ICA components to exclude (use space to deliminate), or nothing to keep {0}: ".format(ica.exclude))
+        if len(ica_excludes.strip()) > 0: ica.exclude = [int(x) for x in ica_excludes.split()]
+        save_ica_excludes(ica_path, ica.exclude, dict(ica_flags or {}, reviewed=True))
+        print('Saved ICA exclude components {0}'.format(ica.exclude))
+        plt.close('all')
@@ -0,0 +1,461 @@
+"""
+Map-reduce runner of the per-session processing in ReNaAnalysisEEG.py
+
+The processing of a session is a DAG of named stages, see SESSION_STAGES: load, align (event markers), gaze_detect,
+preprocess (exg filtering and resampling), ica and epoch. The output of every stage but load is checkpointed per session
+in config['checkpoint_root'], keyed by the keys of its upstream stages and the parameters it depends on, so changing a
+parameter recomputes only the stages downstream of it. The stages are run lazily from the epoch stage, a session whose
+epochs are checkpointed is not loaded at all. The key of load is the size and modification time of the .dats (or its
+pickle if there is no .dats), and that of the align, gaze_detect and ica stages also include the session log, item
+catalog, personalized gaze model and ICA files, a newly fitted ICA is keyed by the files it is saved to. The cross-session stages,
+aggregate (reduce_session_result over all the sessions) and plot, are run by ReNaAnalysisEEG.py, the aggregate is
+checkpointed with aggregate_key. The stages, and the steps inside them, are timed with profile_stage, see profiling.py.
+
+process_session is the map: it runs the stages of one session, sessions are independent so they can run in a process
+pool. reduce_session_result merges a session's results into the participant epoch dictionary, or only into the running
+statistics of the grand averages, and the condition gaze statistics and behaviors. run_sessions reduces the sessions in their submission order, so the merged results are the
+same regardless of the number of workers.
+
+fit_session_icas fits the ICAs that the sessions don't have yet ahead of run_sessions, concurrently in a process pool
+of workers with limited thread pools, on the checkpointed preprocess stage. The ica stage then only loads and applies
+them.
+
+On Windows the workers are spawned and re-import the main script, which must keep its main block under
+if __name__ == '__main__'
+"""
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import mne
+import numpy as np
+from threadpoolctl import threadpool_limits
+
+from eyetracking import detect_gaze_events, varjo_gaze_xy_status, preprocess_pupil, load_participant_gaze_model, \
+    nslr_hmm_classify_sessions
+from profiling import profile_stage, get_profiler
+from fs_utils import hash_inputs, file_identity, load_session_data, load_checkpoint, save_checkpoint, \
+    load_cached_array, save_cached_array
+from utils import generate_pupil_event_epochs, filter_resample_exg, load_or_fit_ica, generate_condition_eeg_event_epochs, \
+    add_gaze_em_to_data, add_em_ts_to_data, rescale_merge_exg, create_gaze_behavior_events, \
+    find_fixation_saccade_targets, deconvolve_condition_eeg, EpochAccumulator, compact_marker_array, expand_marker_array
+
+# stage name -> (upstream stages, names of the parameters in config that the stage's output depends on)
+SESSION_STAGES = {
+    'load': ((), ()),
+    'align': (('load',), ('eventMarker_conditionIndex_dict', 'eyetracking_srate', 'exg_srate')),
+    'gaze_detect': (('load', 'align'), ('varjoEyetracking_channelNames', 'gaze_detector')),
+    'preprocess': (('load',), ('exg_channels', 'exg_channel_types', 'exg_srate', 'exg_preprocess_mode')),
+    'ica': (('preprocess',), ('is_ica_on_epochs',)),
+    'epoch': (('load', 'gaze_detect', 'preprocess', 'ica'),
+              ('varjoEyetracking_channelNames', 'eyetracking_srate', 'is_preprocess_pupil', 'info_chns', 'event_ids',
+               'locked_marker', 'tmin_pupil', 'tmax_pupil', 'tmin_eeg', 'tmax_eeg', 'is_deconvolve_continuous',
+               'deconvolution_erp_window', 'deconvolution_lambda', 'deconvolution_method')),
+}
+
+
+def session_stage_keys(data_path, item_catalog_path, session_log_path, session_ICA_path, bad_channels,
+                       gaze_model_path, config):
+    """
+    the checkpoint keys of all the stages of a session, computed without loading the session
+    :return: dict of stage name -> key
+    """
+    stage_inputs = {'load': dict(data=file_identity(data_path) or file_identity(data_path.replace('dats', 'p'))),
+                    'align': dict(item_catalog=file_identity(item_catalog_path), session_log=file_identity(session_log_path)),
+                    'gaze_detect': dict(gaze_model=None if gaze_model_path is None else file_identity(gaze_model_path)),
+                    'preprocess': dict(bad_channels=bad_channels),
+                    'ica': dict(ica=file_identity(session_ICA_path + '-ica.fif'), ica_exclude=file_identity(session_ICA_path + '.txt'))}
+    keys = dict()
+    for stage, (upstream, parameters) in SESSION_STAGES.items():
+        keys[stage] = hash_inputs(stage=stage, upstream=[keys[x] for x in upstream],
+                                  parameters=dict((x, config[x]) for x in parameters), **stage_inputs.get(stage, {}))
+    return keys
+
+
+def downstream_stages(stages):
+    """
+    :return: the given stages and all the stages downstream of them
+    """
+    downstream = set(stages)
+    for stage, (upstream, _) in SESSION_STAGES.items():  # the stages are in topological order
+        if downstream.intersection(upstream):
+            downstream.add(stage)
+    return downstream
+
+
+def aggregate_key(session_tasks, **params):
+    """
+    checkpoint key of the aggregate of all the sessions: changes if any session's epochs or the session list changes
+    :param params: the parameters of the aggregation, e.g., whether it keeps the epochs or only their running statistics
+    """
+    return hash_inputs(stage='aggregate', sessions=[(task[4], task[5], session_stage_keys(*task[:4], *task[6:9])['epoch'])
+                                                    for task in session_tasks], **params)
+
+
+def load_aggregate(session_tasks, **params):
+    """
+    :param params: the parameters of the aggregation, see aggregate_key
+    :return: the checkpointed aggregate of the sessions, None if it is not checkpointed, or if any stage of the sessions
+    is forced to recompute with recompute_stages or is_regenerate_ica, which leaves the session keys unchanged
+    """
+    config = session_tasks[0][8]
+    if config['checkpoint_root'] is None or any(task[8]['recompute_stages'] or task[8]['is_regenerate_ica'] for task in session_tasks):
+        return None
+    return load_checkpoint(config['checkpoint_root'], 'aggregate', aggregate_key(session_tasks, **params))
+
+
+def _align_stage(run, session_files, config):
+    data = run('load')
+    item_catalog = json.load(open(session_files[1]))
+    session_log = json.load(open(session_files[2]))
+    item_codes = list(item_catalog.values())
+
+    # markers
+    event_markers_timestamps = data['Unity.ReNa.EventMarkers'][1]
+    item_markers = data['Unity.ReNa.ItemMarkers'][0]
+    item_marker_timestamps = data['Unity.ReNa.ItemMarkers'][1]
+
+    aligned = dict()
+    for condition_name, condition_event_marker_index in config['eventMarker_conditionIndex_dict'].items():
+        event_markers = data['Unity.ReNa.EventMarkers'][0][condition_event_marker_index]
+        condition_aligned = dict()
+        # identify the events and add the event and gaze event markers to the timestamps of both eyetracking and exg,
+        # only the markers are kept, the data channels are added back when epoching
+        for stream_name, stream, srate in [('eyetracking', 'Unity.VarjoEyeTrackingComplete', config['eyetracking_srate']),
+                                           ('exg', 'BioSemi', config['exg_srate'])]:
+            timestamps = data[stream][1]
+            with profile_stage('add_em_ts_to_data', condition=condition_name, stream=stream_name):
+                data_em = add_em_ts_to_data(event_markers, event_markers_timestamps, np.empty((0, len(timestamps))),
+                                            timestamps, session_log, item_codes, srate)
+            with profile_stage('add_gaze_em_to_data', condition=condition_name, stream=stream_name):
+                data_egm, fixation_durations, normalized_fixation_count = add_gaze_em_to_data(
+                    item_markers, item_marker_timestamps, event_markers, event_markers_timestamps, data_em, session_log,
+                    item_codes, srate, verbose=1)
+            condition_aligned[stream_name + '_markers'] = compact_marker_array(data_egm)
+            if stream_name == 'eyetracking':
+                condition_aligned['fixation_durations'] = fixation_durations
+                condition_aligned['normalized_fixation_count'] = normalized_fixation_count
+        aligned[condition_name] = condition_aligned
+    return aligned
+
+
+def _gaze_detect_stage(run, session_files, config, gaze_model_path):
+    data = run('load')
+    eyetracking_timestamps = data['Unity.VarjoEyeTrackingComplete'][1]
+    exg_timestamps = data['BioSemi'][1]
+    gaze_xy, gaze_status = varjo_gaze_xy_status(data['Unity.VarjoEyeTrackingComplete'][0], config['varjoEyetracking_channelNames'])
+    gaze_detector_kwargs = dict()
+    if config['gaze_detector'] == 'nslr_hmm':  # classified once here, as the detection is repeated for each condition
+        with profile_stage('gaze_classification'):
+            gaze_model = load_participant_gaze_model(gaze_model_path, None) if gaze_model_path is not None else dict()
+            gaze_detector_kwargs['sample_classes'] = nslr_hmm_classify_sessions([(gaze_xy, gaze_status, eyetracking_timestamps)], **gaze_model)[0]
+
+    detected = dict()
+    for condition_name, condition_aligned in run('align').items():
+        # the gaze events are detected for each condition as find_fixation_saccade_targets sets their targets
+        with profile_stage('gaze_event_detection', condition=condition_name):
+            gaze_behavior_events, fixations, saccades = detect_gaze_events(config['gaze_detector'], gaze_xy, gaze_status,
+                                                                           eyetracking_timestamps, **gaze_detector_kwargs)
+        _, _, data_exg_egm = expand_marker_array(condition_aligned['exg_markers'], exg_timestamps)
+        _, _, data_eyetracking_egm = expand_marker_array(condition_aligned['eyetracking_markers'], eyetracking_timestamps)
+        with profile_stage('gaze_behavior_events', condition=condition_name):
+            fixations = find_fixation_saccade_targets(fixations, saccades, eyetracking_timestamps, data_exg_egm)
+
+            exg_gb_markers = create_gaze_behavior_events(fixations, saccades, eyetracking_timestamps, data_exg_egm[0])
+            eyetracking_gb_markers = create_gaze_behavior_events(fixations, saccades, eyetracking_timestamps, data_eyetracking_egm[0])
+        detected[condition_name] = {'exg_markers': compact_marker_array(np.concatenate([data_exg_egm, exg_gb_markers])),
+                                    'eyetracking_markers': compact_marker_array(np.concatenate([data_eyetracking_egm, eyetracking_gb_markers])),
+                                    'fixations': fixations, 'saccades': saccades}
+    return detected
+
+
+def _preprocess_stage(run, session_files, config, bad_channels):
+    data = run('load')
+    eeg_data = data['BioSemi'][0][1:65, :]  # take only the EEG channels
+    ecg_data = data['BioSemi'][0][65:67, :]  # take only the EEG channels
+    # merge and rescale eeg and ecg, then preprocess the session's exg once for all the conditions
+    with profile_stage('filtering'):
+        return filter_resample_exg(rescale_merge_exg(eeg_data, ecg_data), data['BioSemi'][1], config['exg_channels'],
+                                   config['exg_channel_types'], srate=config['exg_srate'], bad_channels=bad_channels,
+                                   preprocess_mode=config['exg_preprocess_mode'])
+
+
+def _ica_stage(run, session_files, config):
+    """
+    :return: the ICA reconstructed raw and None, or None and the ICA if it is to be applied to the epochs
+    """
+    raw_exg, _ = run('preprocess')
+    with profile_stage('ica_fit'):
+        session_ica = load_or_fit_ica(raw_exg, session_files[3], is_regenerate_ica=config['is_regenerate_ica'],
+                                      is_interactive=config['is_interactive_ica'], decim=config['ica_decim'],
+                                      max_duration=config['ica_max_duration'])
+    if config['is_ica_on_epochs']:
+        return None, session_ica
+    with profile_stage('ica_apply'):
+        return session_ica.apply(raw_exg.copy()), None
+
+
+def _epoch_stage(run, session_files, config, participant_index, session_index):
+    varjoEyetracking_channelNames = config['varjoEyetracking_channelNames']
+    event_ids, locked_marker, info_chns = config['event_ids'], config['locked_marker'], config['info_chns']
+    data = run('load')
+    raw_exg, preprocessed_exg_timestamps = run('preprocess')
+    raw_exg_ica_cleaned, session_ica = run('ica')
+
+    eyetracking_timestamps = data['Unity.VarjoEyeTrackingComplete'][1]
+    eyetracking_data = data['Unity.VarjoEyeTrackingComplete'][0]
+    if config['is_preprocess_pupil']:
+        pupil_channel_indices = [varjoEyetracking_channelNames.index('{0}_pupil_size'.format(x)) for x in ['left', 'right']]
+        eyetracking_data = eyetracking_data.copy()  # keep the loaded session data intact
+        eyetracking_data[pupil_channel_indices], _, _ = preprocess_pupil(eyetracking_data, eyetracking_timestamps,
+                                                                        varjoEyetracking_channelNames, srate=config['eyetracking_srate'])
+
+    # create channels based on the event channels added
+    exg_egbm_marker_channels = info_chns + ['EventMarker'] + ['GazeMarker'] + ["GazeBehavior"]
+    eyetracking_egbm_channels = ['LSLTimestamp'] + varjoEyetracking_channelNames + info_chns + ['EventMarker'] + ['GazeMarker'] + ["GazeBehavior"]
+    eyetracking_egbm_channel_types = ['misc'] + ['misc'] * len(varjoEyetracking_channelNames) + ['stim'] * 3 + ['stim'] * 3
+
+    raw_exg_deconvolution = raw_exg_ica_cleaned
+    if config['is_deconvolve_continuous'] and raw_exg_deconvolution is None:
+        # the deconvolution needs the continuous cleaned EEG even when the ICA is applied to the epochs, reconstruct it
+        # once for all the conditions
+        with profile_stage('ica_apply'):
+            raw_exg_deconvolution = session_ica.apply(raw_exg.copy())
+
+    epoched = dict()
+    for condition_name, condition_detected in run('gaze_detect').items():
+        print("Processing Condition {0} for participant-code[{1}], session {2}".format(condition_name,
+                                                                                   int(participant_index),
+                                                                                   session_index + 1))
+        # add the eyetracking data back between the timestamps and the markers
+        start, end, eyetracking_egbm_markers = expand_marker_array(condition_detected['eyetracking_markers'], eyetracking_timestamps)
+        data_eyetracking_egbm = np.concatenate([eyetracking_egbm_markers[:1], eyetracking_data[:, start:end], eyetracking_egbm_markers[1:]])
+        with profile_stage('pupil_epoching', condition=condition_name):
+            _epochs_pupil, _ = generate_pupil_event_epochs(data_eyetracking_egbm,
+                                                           eyetracking_egbm_channels, eyetracking_egbm_channel_types,
+                                                           config['tmin_pupil'], config['tmax_pupil'],
+                                                           event_ids, locked_marker, is_return_mne=False)
+        del data_eyetracking_egbm
+
+        # the compact exg markers are moved to the preprocessed exg's samples by condition_view
+        with profile_stage('eeg_epoching', condition=condition_name):
+            _epochs_exg, _epochs_eeg_ICA_cleaned, labels_array, _epochs_design_matrix = generate_condition_eeg_event_epochs(
+                raw_exg, raw_exg_ica_cleaned, preprocessed_exg_timestamps,
+                condition_detected['exg_markers'],
+                exg_egbm_marker_channels,
+                config['tmin_eeg'], config['tmax_eeg'],
+                event_ids, locked_marker, ica=session_ica)
+        rerps = None
+        if config['is_deconvolve_continuous']:
+            with profile_stage('deconvolution', condition=condition_name):
+                rerps = deconvolve_condition_eeg(
+                    raw_exg_deconvolution, preprocessed_exg_timestamps, condition_detected['exg_markers'], exg_egbm_marker_channels,
+                    event_ids, locked_marker, erp_window=config['deconvolution_erp_window'],
+                    lamb=config['deconvolution_lambda'], method=config['deconvolution_method'])
+        epoched[condition_name] = {'epochs': (_epochs_pupil, _epochs_exg, _epochs_eeg_ICA_cleaned, labels_array, _epochs_design_matrix),
+                                   'rerps': rerps}
+    return epoched
+
+
+def _load_raw_checkpoint(checkpoint_root, stage, key, run):
+    cached, metadata = load_cached_array(os.path.join(checkpoint_root, stage), key)
+    if cached is None:
+        return None
+    if stage == 'preprocess':
+        raw = mne.io.RawArray(cached[1:], mne.create_info(metadata['data_channels'], sfreq=metadata['srate'],
+                                                          ch_types=metadata['data_channel_types']))
+        raw.set_montage(mne.channels.make_standard_montage('biosemi64'))
+        return raw, np.array(cached[0])
+    raw_exg, _ = run('preprocess')
+    return mne.io.RawArray(cached, raw_exg.info.copy()), None
+
+
+def _save_raw_checkpoint(checkpoint_root, stage, key, output):
+    if stage == 'preprocess':
+        raw, resampled_timestamps = output
+        save_cached_array(os.path.join(checkpoint_root, stage), key, np.concatenate([resampled_timestamps[None, :], raw.get_data()]),
+                          data_channels=raw.ch_names, data_channel_types=raw.get_channel_types(), srate=raw.info['sfreq'])
+    elif output[0] is not None:  # the ICA applied to the epochs is checkpointed by its own solution file
+        save_cached_array(os.path.join(checkpoint_root, stage), key, output[0].get_data())
+
+
+def process_session(data_path, item_catalog_path, session_log_path, session_ICA_path, participant_index, session_index,
+                    bad_channels, gaze_model_path, config, data=None, return_stage=None):
+    """
+    :param gaze_model_path: the participant's NSLR-HMM model saved by load_participant_gaze_model, None to use the
+    default model, unused by the other gaze detectors
+    :param config: dict of the analysis parameters, see session_config in ReNaAnalysisEEG.py, config['checkpoint_root']
+    is the checkpoint directory or None to disable checkpointing, the stages in config['recompute_stages'] and their
+    downstream stages are recomputed even if they are checkpointed
+    :param data: the loaded session, if None it is loaded from data_path only if a stage has to be recomputed
+    :param return_stage: if given, only this stage and its upstream stages are run and its output is returned, e.g.,
+    'preprocess' for the preprocessed exg to review the ICA on, see review_ica.py
+    :return: list of (condition name, result) in the order of config['eventMarker_conditionIndex_dict'], result is a
+    dict of epochs: (pupil, eeg, eeg ica epochs, labels, EpochDesignMatrix), fixation_durations,
+    normalized_fixation_count, fixations, saccades and rerps (None if deconvolution is off)
+    """
+    session_files = data_path, item_catalog_path, session_log_path, session_ICA_path
+    stage_keys = session_stage_keys(*session_files, bad_channels, gaze_model_path, config)
+    checkpoint_root = config['checkpoint_root']
+    recompute_stages = downstream_stages(list(config['recompute_stages']) + (['ica'] if config['is_regenerate_ica'] else []))
+    mne.set_log_level(verbose='CRITICAL')
+
+    stage_functions = {'load': lambda: data if data is not None else load_session_data(data_path),
+                       'align': lambda: _align_stage(run, session_files, config),
+                       'gaze_detect': lambda: _gaze_detect_stage(run, session_files, config, gaze_model_path),
+                       'preprocess': lambda: _preprocess_stage(run, session_files, config, bad_channels),
+                       'ica': lambda: _ica_stage(run, session_files, config),
+                       'epoch': lambda: _epoch_stage(run, session_files, config, participant_index, session_index)}
+    outputs = dict()
+
+    def run(stage):
+        if stage in outputs:
+            return outputs[stage]
+        key, output = stage_keys[stage], None
+        is_checkpointed = checkpoint_root is not None and stage != 'load' and not (stage == 'ica' and config['is_ica_on_epochs'])
+        if is_checkpointed and stage not in recompute_stages:
+            with profile_stage('load_checkpoint', stage=stage):
+                output = _load_raw_checkpoint(checkpoint_root, stage, key, run) if stage in ('preprocess', 'ica') else \
+                    load_checkpoint(checkpoint_root, stage, key)
+            if output is not None:
+                print('Loaded stage {0} of participant-code[{1}], session {2} from checkpoint {3}'.format(
+                    stage, int(participant_index), session_index + 1, key))
+        if output is None:
+            with profile_stage(stage):
+                output = stage_functions[stage]()
+            if stage == 'ica':  # a newly fitted ICA changes the keys of the ICA and its downstream stages
+                stage_keys.update(session_stage_keys(*session_files, bad_channels, gaze_model_path, config))
+            if is_checkpointed:
+                with profile_stage('save_checkpoint', stage=stage):
+                    if stage in ('preprocess', 'ica'):
+                        _save_raw_checkpoint(checkpoint_root, stage, stage_keys[stage], output)
+                    else:
+                        save_checkpoint(checkpoint_root, stage, stage_keys[stage], output)
+        outputs[stage] = output
+        return output
+
+    if return_stage is not None:
+        return run(return_stage)
+    with profile_stage('session', participant=participant_index, session=session_index):
+        epoched, detected, aligned = run('epoch'), run('gaze_detect'), run('align')
+    return [(condition_name, {'epochs': epoched[condition_name]['epochs'],
+                              'fixation_durations': aligned[condition_name]['fixation_durations'],
+                              'normalized_fixation_count': aligned[condition_name]['normalized_fixation_count'],
+                              'fixations': detected[condition_name]['fixations'],
+                              'saccades': detected[condition_name]['saccades'],
+                              'rerps': epoched[condition_name]['rerps']})
+            for condition_name in config['eventMarker_conditionIndex_dict'].keys()]
+
+
+def reduce_session_result(participant_index, session_result, participant_condition_epoch_dict,
+                          condition_gaze_statistics, condition_gaze_behaviors, participant_condition_rerp_dict,
+                          grand_averages=(), is_keep_epochs=True):
+    """
+    merge the result of process_session into the accumulated results of all the sessions, in place
+    :param grand_averages: pairs of (GrandAverageAccumulator, index of the epochs to feed it in the epochs tuple)
+    :param is_keep_epochs: add the session's epochs to participant_condition_epoch_dict, set to False when only the
+    grand_averages are read from them, so they are freed once the session is reduced
+    """
+    for condition_name, result in session_result:
+        fixation_durations, normalized_fixation_count = result['fixation_durations'], result['normalized_fixation_count']
+        # record gaze statistics
+        if fixation_durations is not None and normalized_fixation_count is not None:
+            if 'durations' in condition_gaze_statistics[condition_name].keys():
+                condition_gaze_statistics[condition_name]['durations'] = dict([(event_type, duration_list +
+                                                                                condition_gaze_statistics[
+                                                                                    condition_name][
+                                                                                    'durations'][event_type])
+                                                                               for event_type, duration_list in
+                                                                               fixation_durations.items()])
+            else:
+                condition_gaze_statistics[condition_name]['durations'] = fixation_durations
+            if 'counts' in condition_gaze_statistics[condition_name].keys():
+                condition_gaze_statistics[condition_name]['counts'] = dict([(event_type, 0.5 * (
+                        norm_count + condition_gaze_statistics[condition_name]['counts'][event_type])) for
+                                                                            event_type, norm_count in
+                                                                            normalized_fixation_count.items()])
+            else:
+                condition_gaze_statistics[condition_name]['counts'] = normalized_fixation_count
+
+        # Add to gaze behaviors
+        condition_gaze_behaviors[condition_name]['fixations'] = condition_gaze_behaviors[condition_name]['fixations'] + result['fixations']
+        condition_gaze_behaviors[condition_name]['saccades'] = condition_gaze_behaviors[condition_name]['saccades'] + result['saccades']
+
+        for grand_average, epochs_index in grand_averages:
+            grand_average.update(condition_name, result['epochs'][epochs_index])
+
+        # Add the new epochs to the epoch dictionary, they are concatenated once when read
+        if is_keep_epochs:
+            if condition_name not in participant_condition_epoch_dict[participant_index].keys():
+                participant_condition_epoch_dict[participant_index][condition_name] = EpochAccumulator()
+            participant_condition_epoch_dict[participant_index][condition_name].append(*result['epochs'])
+
+        if result['rerps'] is not None:
+            participant_condition_rerp_dict[participant_index][condition_name].append(result['rerps'])
+
+
+def _process_session_task(task):
+    # the worker's profiler records of this session are sent back with its result
+    session_result = process_session(*task)
+    return session_result, get_profiler().drain()
+
+
+def run_sessions(session_tasks, reduce, n_workers=1):
+    """
+    :param session_tasks: list of the argument tuples of process_session, one for each session
+    :param reduce: called with (task, session result) for every session, in the order of session_tasks
+    :param n_workers: number of worker processes, 1 to run in this process
+    """
+    if n_workers == 1:
+        for task in session_tasks:
+            reduce(task, process_session(*task))
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            # map yields in the submission order, and a finished session is reduced while the later ones still run
+            for task, (session_result, profile_records) in zip(session_tasks, executor.map(_process_session_task, session_tasks)):
+                get_profiler().records += profile_records
+                reduce(task, session_result)
+
+
+def _limit_worker_threads(n_threads):
+    # numpy is already imported when the initializer runs, so setting OMP_NUM_THREADS and the like would be too late
+    threadpool_limits(n_threads)
+
+
+def _fit_session_ica(task):
+    session_ICA_path, participant_index, session_index, config = task[3], task[4], task[5], task[8]
+    with profile_stage('session_ica', participant=participant_index, session=session_index):
+        raw_exg, _ = process_session(*task, return_stage='preprocess')
+        with profile_stage('ica_fit'):
+            load_or_fit_ica(raw_exg, session_ICA_path, is_regenerate_ica=config['is_regenerate_ica'],
+                            decim=config['ica_decim'], max_duration=config['ica_max_duration'])
+
+
+def _fit_session_ica_task(task):
+    _fit_session_ica(task)
+    return get_profiler().drain()
+
+
+def fit_session_icas(session_tasks, n_workers=1, n_threads=None):
+    """
+    fit the ICAs of the sessions that don't have one, or of all the sessions if is_regenerate_ica, before run_sessions.
+    The ICAs are fitted headless, see review_ica.py, on a decimated copy of the preprocessed exg, see fit_ica in
+    utils.py. The preprocess stage is checkpointed by the workers and reused by run_sessions
+    :param n_workers: number of worker processes, 1 to fit in this process with all its threads
+    :param n_threads: the size of the BLAS and OpenMP thread pools of each worker, n_workers * n_threads should not
+    exceed the number of cores, None to split the cores evenly across the workers
+    :return: the session tasks, with is_regenerate_ica off for the sessions whose ICA was refitted
+    """
+    fit_indices = [i for i, task in enumerate(session_tasks) if task[8]['is_regenerate_ica'] or
+                   not (os.path.exists(task[3] + '.txt') and os.path.exists(task[3] + '-ica.fif'))]
+    fit_tasks = [session_tasks[i] for i in fit_indices]
+    if n_workers == 1:
+        for task in fit_tasks:
+            _fit_session_ica(task)
+    elif len(fit_tasks) > 0:
+        n_threads = n_threads if n_threads is not None else max(1, (os.cpu_count() or 1) // n_workers)
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_limit_worker_threads, initargs=(n_threads,)) as executor:
+            for profile_records in executor.map(_fit_session_ica_task, fit_tasks):
+                get_profiler().records += profile_records
+    return [task[:8] + (dict(task[8], is_regenerate_ica=False),) + task[9:] if i in fit_indices else task
+            for i, task in enumerate(session_tasks)]
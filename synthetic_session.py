@@ -0,0 +1,289 @@
+"""
+Synthetic ReNa sessions with the stream names and layouts of the recorded .dats, to run and benchmark the pipeline
+without the recorded data, see benchmark_pipeline.py
+
+A session has the streams
+BioSemi: trigger, 64 EEG channels in the biosemi64 order and the EX channels (EX1 - EX2 is the ECG) in μV
+Unity.VarjoEyeTrackingComplete: the 34 channels of VARJO_CHANNEL_NAMES
+Unity.ReNa.EventMarkers: 16 rows, 4 (event, info1, info2, info3) for each of the conditions RSVP, Carousel, VS and TS.
+A block is its block ID (a key of the session log), then the item events, then 0
+Unity.ReNa.ItemMarkers: 330 rows, 11 for each of the 30 items of a block, the second row is the item code and the fifth
+is 1 while the gaze ray intersects the item
+each as [data, timestamps] on one clock, along with the item catalog (item name -> code) and the session log (block ID
+-> targets, distractors and novelties)
+
+The gaze alternates between fixations and saccades with blinks in between, fixations during a block fall on one of the
+block's items with probability on_item_probability. The EEG is pink noise from a few mixed sources, alpha, line noise,
+blinks on the frontal channels, ECG leaking into all channels, and fixation-locked lambda and, for targets, P300
+responses. The pupil dilates after fixating a target
+"""
+import json
+import os
+import pickle
+
+import numpy as np
+
+VARJO_CHANNEL_NAMES = ['raw_timestamp', 'log_time', 'focus_distance', 'frame_number', 'stability', 'status',
+                       'gaze_forward_x', 'gaze_forward_y', 'gaze_forward_z', 'gaze_origin_x', 'gaze_origin_y', 'gaze_origin_z',
+                       'HMD_position_x', 'HMD_position_y', 'HMD_position_z', 'HMD_rotation_x', 'HMD_rotation_y', 'HMD_rotation_z',
+                       'left_forward_x', 'left_forward_y', 'left_forward_z', 'left_origin_x', 'left_origin_y', 'left_origin_z',
+                       'left_pupil_size', 'left_status',
+                       'right_forward_x', 'right_forward_y', 'right_forward_z', 'right_origin_x', 'right_origin_y', 'right_origin_z',
+                       'right_pupil_size', 'right_status']
+
+BIOSEMI64_CHANNEL_NAMES = ['Fp1', 'AF7', 'AF3', 'F1', 'F3', 'F5', 'F7', 'FT7', 'FC5', 'FC3', 'FC1', 'C1', 'C3', 'C5', 'T7',
+                           'TP7', 'CP5', 'CP3', 'CP1', 'P1', 'P3', 'P5', 'P7', 'P9', 'PO7', 'PO3', 'O1', 'Iz', 'Oz', 'POz',
+                           'Pz', 'CPz', 'Fpz', 'Fp2', 'AF8', 'AF4', 'AFz', 'Fz', 'F2', 'F4', 'F6', 'F8', 'FT8', 'FC6', 'FC4',
+                           'FC2', 'FCz', 'Cz', 'C2', 'C4', 'C6', 'T8', 'TP8', 'CP6', 'CP4', 'CP2', 'P2', 'P4', 'P6', 'P8',
+                           'P10', 'PO8', 'PO4', 'O2']
+
+NUM_EVENT_MARKER_CONDITIONS = 4  # RSVP, Carousel, VS and TS, 4 event marker rows each
+NUM_BLOCK_ITEMS = 30
+NUM_ITEM_MARKER_ROWS = 11
+GAZE_VALID_STATUS = 2
+
+
+def _pink_noise(rng, shape):
+    """
+    1/f noise along the last axis, unit variance
+    """
+    white = rng.standard_normal(shape)
+    spectrum = np.fft.rfft(white, axis=-1)
+    frequencies = np.arange(spectrum.shape[-1])
+    frequencies[0] = 1
+    noise = np.fft.irfft(spectrum / np.sqrt(frequencies), n=white.shape[-1], axis=-1)
+    return noise / noise.std(axis=-1, keepdims=True)
+
+
+def _evoked_waveform(srate, latency, width, duration=1.):
+    times = np.arange(int(duration * srate)) / srate
+    return np.exp(-0.5 * ((times - latency) / width) ** 2)
+
+
+def _add_at(signal, onsets, waveform):
+    """
+    add the waveform to signal at every onset sample, clipped at the end of the signal
+    """
+    for onset in onsets:
+        end = min(onset + len(waveform), len(signal))
+        signal[onset:end] += waveform[:end - onset]
+
+
+def generate_gaze(rng, duration, srate, fixation_duration=(0.2, 0.6), saccade_amplitude=(3., 15.), blink_interval=4.,
+                  blink_duration=0.15, field_of_view=20.):
+    """
+    alternating fixations and saccades, with blinks
+    :return: gaze angles in degrees of shape (2, samples), the fixations as (onset, offset) samples, the blinks as
+    (onset, offset) samples
+    """
+    num_samples = int(duration * srate)
+    gaze_deg = np.zeros((2, num_samples))
+    fixations = []
+    position = np.zeros(2)
+    t = 0
+    while t < num_samples:
+        fixation_samples = int(rng.uniform(*fixation_duration) * srate)
+        gaze_deg[:, t:t + fixation_samples] = position[:, None]
+        fixations.append((t, min(t + fixation_samples, num_samples)))
+        t += fixation_samples
+        # saccade with a raised cosine velocity profile, its duration follows the main sequence
+        amplitude = rng.uniform(*saccade_amplitude)
+        direction = rng.uniform(0, 2 * np.pi)
+        target = np.clip(position + amplitude * np.array([np.cos(direction), np.sin(direction)]), -field_of_view, field_of_view)
+        saccade_samples = max(int((0.021 + 0.0022 * amplitude) * srate), 3)
+        progress = (1 - np.cos(np.pi * np.arange(1, saccade_samples + 1) / saccade_samples)) / 2
+        saccade = position[:, None] + (target - position)[:, None] * progress[None, :]
+        gaze_deg[:, t:t + saccade_samples] = saccade[:, :max(num_samples - t, 0)]
+        position = target
+        t += saccade_samples
+    gaze_deg += 0.01 * rng.standard_normal(gaze_deg.shape)  # fixational jitter
+    blink_onsets = np.cumsum(rng.exponential(blink_interval, int(2 * duration / blink_interval) + 1) + blink_duration)
+    blinks = [(int(onset * srate), min(int((onset + blink_duration) * srate), num_samples))
+              for onset in blink_onsets if onset + blink_duration < duration]
+    return gaze_deg, fixations, blinks
+
+
+def generate_session(duration=600., seed=0, exg_srate=2048, eyetracking_srate=200, item_marker_srate=60,
+                     num_exg_channels=73, num_blocks_per_condition=3, num_catalog_items=60, num_targets=3,
+                     num_novelties=3, item_interval=1., on_item_probability=0.5, block_gap=5.):
+    """
+    :param duration: length of the session in seconds
+    :param seed: seed of numpy's default_rng
+    :param num_exg_channels: number of BioSemi channels, at least 67: trigger, 64 EEG and the 2 ECG EX channels
+    :param num_blocks_per_condition: blocks of each of the four conditions, the blocks run one after another
+    :param item_interval: seconds between the item events of a block
+    :param block_gap: seconds between the blocks, and before the first and after the last block
+    :return: the session's data dict of stream name -> [data, timestamps], the item catalog and the session log
+    """
+    assert num_exg_channels >= 67
+    rng = np.random.default_rng(seed)
+    start_time = rng.uniform(1e4, 1e5)  # LSL clock
+    num_blocks = NUM_EVENT_MARKER_CONDITIONS * num_blocks_per_condition
+    block_duration = (duration - block_gap) / num_blocks - block_gap
+    assert block_duration > 2 * item_interval, 'the session is too short for {0} blocks'.format(num_blocks)
+
+    item_catalog = dict(('item{0}'.format(code), code) for code in range(1, num_catalog_items + 1))
+    item_codes = np.array(list(item_catalog.values()))
+    session_log = dict()
+
+    # event markers and item markers
+    event_marker_rows, event_marker_timestamps = [], []
+    item_marker_timestamps = start_time + np.arange(int(duration * item_marker_srate)) / item_marker_srate
+    item_markers = np.zeros((NUM_BLOCK_ITEMS * NUM_ITEM_MARKER_ROWS, len(item_marker_timestamps)))
+    blocks = []  # (block start, block end, block ID, block items)
+    for block_index in range(num_blocks):
+        condition_index = block_index // num_blocks_per_condition
+        block_id = 1000 + block_index + 1  # block IDs do not collide with the item codes
+        block_start = start_time + block_gap + block_index * (block_duration + block_gap)
+        block_end = block_start + block_duration
+        block_items = rng.choice(item_codes, NUM_BLOCK_ITEMS, replace=False)
+        session_log[str(block_id)] = {'targets': block_items[:num_targets].tolist(),
+                                      'novelties': block_items[num_targets:num_targets + num_novelties].tolist(),
+                                      'distractors': block_items[num_targets + num_novelties:].tolist()}
+        blocks.append((block_start, block_end, block_id, block_items))
+
+        marker_rows = slice(condition_index * 4, (condition_index + 1) * 4)
+        item_event_times = np.arange(block_start + item_interval, block_end - item_interval / 2, item_interval)
+        for marker_time, event in [(block_start, block_id)] + [(t, rng.choice(block_items)) for t in item_event_times] + [(block_end, 0)]:
+            event_marker = np.zeros(4 * NUM_EVENT_MARKER_CONDITIONS)
+            event_marker[marker_rows] = event, *(rng.integers(1, 10, 3) if event in block_items else (0, 0, 0))
+            event_marker_rows.append(event_marker)
+            event_marker_timestamps.append(marker_time)
+
+        in_block = np.logical_and(item_marker_timestamps >= block_start, item_marker_timestamps < block_end)
+        for item_index, item_code in enumerate(block_items):
+            item_rows = item_markers[item_index * NUM_ITEM_MARKER_ROWS:(item_index + 1) * NUM_ITEM_MARKER_ROWS]
+            item_rows[0, in_block] = item_index
+            item_rows[1, in_block] = item_code
+            item_rows[2, in_block] = rng.uniform(0, 60)  # foveate angle
+            item_rows[3, in_block] = 1  # in view
+            item_rows[5:8, in_block] = rng.uniform(-5, 5, 3)[:, None]  # position
+
+    # eyetracking
+    eyetracking_timestamps = start_time + np.arange(int(duration * eyetracking_srate)) / eyetracking_srate
+    gaze_deg, fixations, blinks = generate_gaze(rng, duration, eyetracking_srate)
+    eyetracking_data = np.zeros((len(VARJO_CHANNEL_NAMES), len(eyetracking_timestamps)))
+    channel = dict((name, eyetracking_data[i]) for i, name in enumerate(VARJO_CHANNEL_NAMES))
+    gaze_xyz = np.stack([np.sin(np.deg2rad(gaze_deg[0])), np.sin(np.deg2rad(gaze_deg[1]))])
+    gaze_xyz = np.concatenate([gaze_xyz, np.sqrt(1 - np.sum(gaze_xyz ** 2, axis=0, keepdims=True))])
+    for axis_index, axis in enumerate(['x', 'y', 'z']):
+        for prefix in ['gaze', 'left', 'right']:
+            channel['{0}_forward_{1}'.format(prefix, axis)][:] = gaze_xyz[axis_index]
+    channel['gaze_origin_x'][:] = 0.
+    channel['left_origin_x'][:], channel['right_origin_x'][:] = -0.032, 0.032
+    channel['raw_timestamp'][:] = (eyetracking_timestamps - start_time) * 1e9
+    channel['log_time'][:] = eyetracking_timestamps - start_time
+    channel['frame_number'][:] = np.arange(len(eyetracking_timestamps))
+    channel['focus_distance'][:] = 1.5 + 0.1 * _pink_noise(rng, len(eyetracking_timestamps))
+    channel['stability'][:] = 1.
+    channel['HMD_position_y'][:] = 1.7
+    channel['status'][:] = GAZE_VALID_STATUS
+    channel['left_status'][:], channel['right_status'][:] = 3, 3
+    pupil = 3.5 + 0.2 * _pink_noise(rng, len(eyetracking_timestamps))
+
+    # place the fixations during blocks on the items
+    target_fixation_onsets, fixation_onsets = [], []
+    for onset, offset in fixations:
+        fixation_onsets.append(onset)
+        onset_time, offset_time = eyetracking_timestamps[onset], eyetracking_timestamps[offset - 1]
+        block = [b for b in blocks if b[0] <= onset_time and offset_time < b[1]]
+        if len(block) == 0 or rng.uniform() > on_item_probability:
+            continue
+        _, _, block_id, block_items = block[0]
+        item_index = rng.integers(NUM_BLOCK_ITEMS)
+        # the gaze ray lands on the item after the saccade has settled
+        intersected = np.logical_and(item_marker_timestamps >= onset_time + 0.03, item_marker_timestamps <= offset_time)
+        item_markers[item_index * NUM_ITEM_MARKER_ROWS + 4, intersected] = 1
+        if block_items[item_index] in session_log[str(block_id)]['targets']:
+            target_fixation_onsets.append(onset)
+    _add_at(pupil, target_fixation_onsets, 0.3 * _evoked_waveform(eyetracking_srate, 1., 0.4, duration=3.))
+    channel['left_pupil_size'][:] = pupil + 0.05 * rng.standard_normal(len(pupil))
+    channel['right_pupil_size'][:] = pupil + 0.05 * rng.standard_normal(len(pupil))
+    for onset, offset in blinks:
+        channel['status'][onset:offset] = 0
+        for eye in ['left', 'right']:
+            channel['{0}_status'.format(eye)][onset:offset] = 0
+            channel['{0}_pupil_size'.format(eye)][onset:offset] = 0.
+
+    # exg, generated as float32 to keep long sessions in memory
+    exg_timestamps = start_time + np.arange(int(duration * exg_srate)) / exg_srate
+    num_exg_samples = len(exg_timestamps)
+    to_exg = exg_srate / eyetracking_srate
+    num_sources = 12
+    mixing = rng.standard_normal((64, num_sources)).astype(np.float32)
+    eeg = mixing @ (8 * _pink_noise(rng, (num_sources, num_exg_samples)) / np.sqrt(num_sources)).astype(np.float32)
+    eeg += rng.standard_normal(eeg.shape, dtype=np.float32) * 2
+    times = np.arange(num_exg_samples) / exg_srate
+
+    def topography(weights, default=0.):
+        return np.array([weights.get(name, default) for name in BIOSEMI64_CHANNEL_NAMES], dtype=np.float32)[:, None]
+
+    occipital = topography({'O1': 1., 'Oz': 1., 'O2': 1., 'Iz': .8, 'POz': .7, 'PO3': .7, 'PO4': .7, 'PO7': .5, 'PO8': .5}, .1)
+    frontal = topography({'Fp1': 1., 'Fpz': 1., 'Fp2': 1., 'AF7': .7, 'AF3': .6, 'AFz': .6, 'AF4': .6, 'AF8': .7,
+                          'F7': .4, 'F5': .35, 'F3': .3, 'F1': .3, 'Fz': .3, 'F2': .3, 'F4': .3, 'F6': .35, 'F8': .4}, .02)
+    parietal = topography({'Pz': 1., 'CPz': .9, 'P1': .8, 'P2': .8, 'POz': .7, 'CP1': .6, 'CP2': .6, 'Cz': .5}, .1)
+    alpha = (1 + 0.5 * _pink_noise(rng, num_exg_samples)) * np.sin(2 * np.pi * 10 * times)
+    eeg += 6 * occipital * alpha.astype(np.float32)[None, :]
+    eeg += 3 * np.sin(2 * np.pi * 60 * times).astype(np.float32)[None, :]
+
+    blink_signal = np.zeros(num_exg_samples)
+    _add_at(blink_signal, [int(onset * to_exg) for onset, _ in blinks], _evoked_waveform(exg_srate, 0.1, 0.05, duration=0.4))
+    eeg += 150 * frontal * blink_signal.astype(np.float32)[None, :]
+
+    evoked = np.zeros((2, num_exg_samples))
+    _add_at(evoked[0], [int(onset * to_exg) for onset in fixation_onsets], _evoked_waveform(exg_srate, 0.08, 0.02))
+    _add_at(evoked[1], [int(onset * to_exg) for onset in target_fixation_onsets], _evoked_waveform(exg_srate, 0.35, 0.08))
+    eeg += 5 * occipital * evoked[0].astype(np.float32)[None, :] + 8 * parietal * evoked[1].astype(np.float32)[None, :]
+
+    heart_beats = np.cumsum(rng.uniform(0.75, 1., int(duration) + 1))
+    ecg = np.zeros(num_exg_samples)
+    _add_at(ecg, [int(t * exg_srate) for t in heart_beats if t < duration], _evoked_waveform(exg_srate, 0.05, 0.008, duration=0.2)
+            - 0.2 * _evoked_waveform(exg_srate, 0.3, 0.04, duration=0.5)[:int(0.2 * exg_srate)])
+    ecg = ecg.astype(np.float32)
+    eeg += 5 * rng.uniform(0.2, 1., (64, 1)).astype(np.float32) * ecg[None, :]
+
+    exg = np.zeros((num_exg_channels, num_exg_samples), dtype=np.float32)
+    exg[1:65] = eeg
+    del eeg
+    exg[65] = 500 * ecg
+    exg[66] = -500 * ecg
+    exg[65:] += 5 * rng.standard_normal((num_exg_channels - 65, num_exg_samples), dtype=np.float32)
+
+    data = {'BioSemi': [exg, exg_timestamps],
+            'Unity.VarjoEyeTrackingComplete': [eyetracking_data, eyetracking_timestamps],
+            'Unity.ReNa.EventMarkers': [np.array(event_marker_rows).T, np.array(event_marker_timestamps)],
+            'Unity.ReNa.ItemMarkers': [item_markers, item_marker_timestamps]}
+    return data, item_catalog, session_log
+
+
+def write_varjo_preset(preset_path):
+    """
+    write the Varjo LSL preset with the channel names of the synthetic sessions, see varjoEyetrackingComplete_preset_path
+    """
+    with open(preset_path, 'w') as f:
+        json.dump({'StreamName': 'Unity.VarjoEyeTrackingComplete', 'ChannelNames': VARJO_CHANNEL_NAMES}, f)
+
+
+def write_synthetic_participants(data_root, num_participants, num_sessions, duration, seed=0, **kwargs):
+    """
+    write synthetic sessions in the layout of the Subjects directory read by ReNaAnalysisEEG.py: data_root/participant/
+    session.p, session_ReNaItemCatalog.json and session_ReNaSessionLog.json. The session data is saved as the pickle
+    that load_session_data reads in place of the .dats. Existing sessions are kept
+    :param kwargs: passed to generate_session
+    """
+    for participant_index in range(num_participants):
+        participant_directory = os.path.join(data_root, str(participant_index))
+        os.makedirs(participant_directory, exist_ok=True)
+        for session_index in range(num_sessions):
+            data_path = os.path.join(participant_directory, '{0}.p'.format(session_index))
+            if os.path.exists(data_path):
+                continue
+            print('Generating participant {0}, session {1}, {2} seconds'.format(participant_index, session_index, duration))
+            data, item_catalog, session_log = generate_session(duration, seed=[seed, participant_index, session_index], **kwargs)
+            with open(os.path.join(participant_directory, '{0}_ReNaItemCatalog.json'.format(session_index)), 'w') as f:
+                json.dump(item_catalog, f)
+            with open(os.path.join(participant_directory, '{0}_ReNaSessionLog.json'.format(session_index)), 'w') as f:
+                json.dump(session_log, f)
+            with open(data_path + '.tmp', 'wb') as f:
+                pickle.dump(data, f, protocol=4)
+            os.replace(data_path + '.tmp', data_path)
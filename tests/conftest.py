@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the analysis modules are scripts in the repository root, and nslr_hmm is vendored in nslr-hmm-master
+repository_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository_root)
+sys.path.insert(1, os.path.join(repository_root, 'nslr-hmm-master'))
@@ -0,0 +1,156 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('sklearn')  # deconv_utils splits the cross-validation folds with sklearn
+
+from sklearn.model_selection import KFold
+
+from Learning.deconv_utils import ridge_regression_direct, ridge_path, cross_validate_ridge, deconvolve_continuous, \
+    overlap_corrected_epochs, ChannelNormalizer
+
+
+def random_regression(num_epochs=12, num_times=5, num_features=4, num_channels=3, seed=0):
+    rng = np.random.default_rng(seed)
+    X = rng.standard_normal((num_epochs, num_times, num_features))
+    Y = X @ rng.standard_normal((num_features, num_channels)) + rng.standard_normal((num_times, num_channels)) \
+        + 0.1 * rng.standard_normal((num_epochs, num_times, num_channels))
+    return X, Y
+
+
+def test_ridge_regression_direct_solves_the_penalized_normal_equations():
+    X, Y = random_regression()
+    num_epochs, num_times, num_features = X.shape
+    lamb = 0.5
+    # the bias is a one-hot column per time point, penalized like the weights
+    A = np.concatenate([X, np.broadcast_to(np.eye(num_times), (num_epochs, num_times, num_times))], axis=-1).reshape(num_epochs * num_times, -1)
+    expected = np.linalg.solve(A.T @ A + lamb * np.eye(A.shape[1]), A.T @ Y.reshape(num_epochs * num_times, -1))
+    weights, bias, loss_train, loss_test = ridge_regression_direct(X, Y, X[:2], Y[:2], lamb)
+    assert np.allclose(weights, expected[:num_features])
+    assert np.allclose(bias, expected[num_features:])
+    assert np.isclose(loss_test[0], np.mean(np.abs(Y[:2] - (X[:2] @ weights + bias))))
+    assert loss_train[0] > np.mean(np.abs(Y - (X @ weights + bias)))  # includes the penalty
+
+
+def centered_ridge(X, Y, lamb):
+    """
+    the reference ridge_path solution: the bias is the per time point mean, so center per time point and solve the
+    weights with lstsq on the design augmented with sqrt(lamb) I
+    """
+    X_mean, Y_mean = X.mean(axis=0), Y.mean(axis=0)
+    X_centered = (X - X_mean).reshape(-1, X.shape[-1])
+    augmented = np.concatenate([X_centered, np.sqrt(lamb) * np.eye(X.shape[-1])])
+    targets = np.concatenate([(Y - Y_mean).reshape(-1, Y.shape[-1]), np.zeros((X.shape[-1], Y.shape[-1]))])
+    weights = np.linalg.lstsq(augmented, targets, rcond=None)[0]
+    return weights, Y_mean - X_mean @ weights
+
+
+def test_ridge_path_matches_lstsq_for_every_lambda():
+    X, Y = random_regression()
+    lambdas = [0., 0.1, 10.]
+    weights, bias = ridge_path(X, Y, lambdas)
+    assert weights.shape == (3, 4, 3) and bias.shape == (3, 5, 3)
+    for l, lamb in enumerate(lambdas):
+        expected_weights, expected_bias = centered_ridge(X, Y, lamb)
+        assert np.allclose(weights[l], expected_weights) and np.allclose(bias[l], expected_bias)
+
+
+def test_cross_validate_ridge_matches_refitting_every_fold():
+    X, Y = random_regression(num_epochs=20)
+    lambdas = [0.01, 1., 100.]
+    best_lambda, fold_losses, weights, bias = cross_validate_ridge(X, Y, lambdas, n_folds=4, n_jobs=2, random_state=0)
+    expected_losses = np.zeros((4, len(lambdas)))
+    for k, (train_index, test_index) in enumerate(KFold(n_splits=4, shuffle=True, random_state=0).split(X)):
+        for l, lamb in enumerate(lambdas):
+            fold_weights, fold_bias = centered_ridge(X[train_index], Y[train_index], lamb)
+            expected_losses[k, l] = np.mean(np.abs(Y[test_index] - (X[test_index] @ fold_weights + fold_bias)))
+    assert np.allclose(fold_losses, expected_losses)
+    assert best_lambda == lambdas[np.argmin(expected_losses.mean(axis=0))]
+    expected_weights, expected_bias = centered_ridge(X, Y, best_lambda)
+    assert np.allclose(weights, expected_weights) and np.allclose(bias, expected_bias)
+
+
+@pytest.mark.parametrize('method', ['cholesky', 'lsqr', 'cg'])
+def test_deconvolve_continuous_recovers_overlapping_kernels(method):
+    from utils import build_design_matrix
+    rng = np.random.default_rng(0)
+    num_samples, num_lags = 2000, 20
+    event_markers = np.zeros(num_samples)
+    event_markers[rng.choice(num_samples - num_lags, 150, replace=False)] = rng.integers(1, 3, 150)
+    design_matrix = build_design_matrix(event_markers, 100, (0., num_lags / 100.), event_type_of_interest=(1, 2))
+    kernels = rng.standard_normal((2 * num_lags, 3))
+    data = (design_matrix @ kernels).T
+    betas = deconvolve_continuous(data, design_matrix, lamb=0., method=method, tol=1e-12)
+    assert np.allclose(betas, kernels)
+
+
+def test_deconvolve_continuous_warns_when_cg_does_not_converge():
+    from utils import build_design_matrix
+    rng = np.random.default_rng(0)
+    event_markers = np.zeros(500)
+    event_markers[rng.choice(480, 40, replace=False)] = 1
+    design_matrix = build_design_matrix(event_markers, 100, (0., 0.2), event_type_of_interest=(1,))
+    data = rng.standard_normal((1, 500))
+    with pytest.warns(UserWarning, match='did not converge'):
+        deconvolve_continuous(data, design_matrix, method='cg', tol=1e-12, max_iter=1)
+
+
+def test_deconvolve_continuous_falls_back_to_lsqr_on_singular_normal_equations():
+    from utils import build_design_matrix
+    event_markers = np.zeros(500)
+    event_markers[np.arange(50, 450, 40)] = 1
+    event_markers[np.arange(55, 455, 40)] = 2  # type 2 always follows type 1 by 5 samples, the columns are collinear
+    design_matrix = build_design_matrix(event_markers, 100, (0., 0.1), event_type_of_interest=(1, 2))
+    data = (design_matrix @ np.ones((20, 2))).T
+    with pytest.warns(UserWarning, match='singular'):
+        betas = deconvolve_continuous(data, design_matrix, lamb=0., method='cholesky')
+    assert np.all(np.isfinite(betas)) and np.allclose(design_matrix @ betas, data.T)
+    assert np.all(np.isfinite(deconvolve_continuous(data, design_matrix, lamb=1., method='cholesky')))
+
+
+def test_overlap_corrected_epochs_leaves_the_own_response():
+    rng = np.random.default_rng(0)
+    num_epochs, num_times, num_lags, onset_index = 8, 30, 10, 5
+    event_codes, labels = [1, 2], rng.integers(1, 3, num_epochs)
+    design_matrices = np.zeros((num_epochs, num_times, 2 * num_lags))
+    for e in range(num_epochs):
+        for event_time, event_code in [(onset_index, labels[e]), (onset_index + 7, rng.integers(1, 3))]:  # an overlapping event
+            block = event_codes.index(event_code)
+            design_matrices[e, event_time + np.arange(num_lags), block * num_lags + np.arange(num_lags)] += 1
+    weights, bias = rng.standard_normal((2 * num_lags, 3)), rng.standard_normal((num_times, 3))
+    channel_mean, channel_std = rng.standard_normal(3), rng.uniform(1, 2, 3)
+    data = (design_matrices @ weights + bias) * channel_std + channel_mean
+
+    corrected, corrected_stats = overlap_corrected_epochs(data, design_matrices, labels, weights, bias, event_codes,
+                                                          onset_index, index_window=(2, 25), channel_mean=channel_mean,
+                                                          channel_std=channel_std)
+    assert corrected.shape == (num_epochs, 23, 3)
+    for e in range(num_epochs):
+        own = np.zeros((num_times, 3))
+        own[onset_index:onset_index + num_lags] = weights[event_codes.index(labels[e]) * num_lags + np.arange(num_lags)]
+        assert np.allclose(corrected[e], own[2:25] * channel_std)
+    assert np.allclose(corrected_stats[1][0], corrected[labels == 1].mean(axis=0))
+
+
+def test_overlap_corrected_epochs_rejects_labels_without_a_weight_block():
+    num_epochs, num_times, num_lags = 3, 20, 5
+    design_matrices, data = np.zeros((num_epochs, num_times, 2 * num_lags)), np.zeros((num_epochs, num_times, 1))
+    with pytest.raises(ValueError):
+        overlap_corrected_epochs(data, design_matrices, np.array([1, 2, 3]), np.zeros((2 * num_lags, 1)),
+                                 np.zeros((num_times, 1)), [1, 2], 5)
+
+
+def test_channel_normalizer_matches_numpy_statistics_over_chunks(tmp_path):
+    rng = np.random.default_rng(0)
+    X = rng.normal(3., 2., (50, 7, 4))
+    X[:, :, 3] = 5.  # a constant channel
+    normalizer = ChannelNormalizer(chunk_size=8).fit(X[:30])
+    normalizer.partial_fit(X[30:])
+    assert np.allclose(normalizer.mean, X.mean(axis=(0, 1)))
+    assert np.allclose(normalizer.std[:3], X[:, :, :3].std(axis=(0, 1))) and normalizer.std[3] == 1.
+    assert np.allclose(normalizer.inverse_transform(normalizer.transform(X)), X)
+
+    channels_first = ChannelNormalizer(channel_axis=1, chunk_size=3).fit(np.moveaxis(X, -1, 1))
+    assert np.allclose(channels_first.mean, normalizer.mean) and np.allclose(channels_first.std, normalizer.std)
+    normalizer.save(tmp_path / 'normalizer.npz')
+    loaded = ChannelNormalizer.load(tmp_path / 'normalizer.npz')
+    assert np.allclose(loaded.transform(X), normalizer.transform(X))
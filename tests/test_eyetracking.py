@@ -0,0 +1,75 @@
+import math
+
+import numpy as np
+import pytest
+
+from eyetracking import gaze_event_detection_nslr_hmm, detect_gaze_events, _class_runs, NSLR_HMM_FIXATION, \
+    NSLR_HMM_SACCADE, SACCADE_CODE, FIXATION_CODE, preprocess_pupil, average_binocular_pupil
+
+
+def stepping_gaze(n_samples=600, srate=200, saccade_onsets=(100, 300, 500), saccade_samples=10, step_deg=5.):
+    """gaze that jumps step_deg to the right during each saccade, and the matching NSLR-HMM sample classes"""
+    timestamps = np.arange(n_samples) / srate
+    x_deg = np.zeros(n_samples)
+    sample_classes = np.full(n_samples, NSLR_HMM_FIXATION)
+    for onset in saccade_onsets:
+        x_deg[onset:onset + saccade_samples] += np.linspace(0, step_deg, saccade_samples)
+        x_deg[onset + saccade_samples:] += step_deg
+        sample_classes[onset:onset + saccade_samples] = NSLR_HMM_SACCADE
+    gaze_xy = np.sin(np.stack([x_deg, np.zeros(n_samples)]) * math.pi / 180)
+    return gaze_xy, np.full(n_samples, 2), timestamps, sample_classes
+
+
+def test_class_runs():
+    onsets, offsets = _class_runs(np.array([1, 1, 0, 0, 1, 0, 1, 1, 1], dtype=bool))
+    assert onsets.tolist() == [0, 4, 6]
+    assert offsets.tolist() == [2, 5, 9]
+
+
+def test_nslr_hmm_detection_from_sample_classes():
+    gaze_xy, gaze_status, timestamps, sample_classes = stepping_gaze()
+    events, fixations, saccades = gaze_event_detection_nslr_hmm(gaze_xy, gaze_status, timestamps, sample_classes=sample_classes)
+    assert [(s.onset, s.offset) for s in saccades] == [(100, 110), (300, 310), (500, 510)]
+    assert [(f.onset, f.offset) for f in fixations] == [(110, 300), (310, 500)]
+    assert fixations[0].preceding_saccade is saccades[0] and fixations[0].following_saccade is saccades[1]
+    assert np.all(events[100:110] == SACCADE_CODE) and np.all(events[110:300] == FIXATION_CODE)
+    assert saccades[0].amplitude == pytest.approx(5., rel=0.05)
+
+
+def test_nslr_hmm_detection_skips_saccades_with_invalid_status():
+    gaze_xy, gaze_status, timestamps, sample_classes = stepping_gaze()
+    gaze_status[305] = 0
+    events, fixations, saccades = gaze_event_detection_nslr_hmm(gaze_xy, gaze_status, timestamps, sample_classes=sample_classes)
+    assert [s.onset for s in saccades] == [100, 500]
+
+
+def test_detect_gaze_events_rejects_unknown_detector():
+    gaze_xy, gaze_status, timestamps, _ = stepping_gaze()
+    with pytest.raises(ValueError):
+        detect_gaze_events('unknown', gaze_xy, gaze_status, timestamps)
+
+
+def test_preprocess_pupil_interpolates_the_padded_blinks():
+    srate, n_samples = 200, 1000
+    timestamps = np.arange(n_samples) / srate
+    channel_names = ['left_pupil_size', 'right_pupil_size', 'left_status', 'right_status']
+    pupil_size = 3e-3 + 1e-4 * np.sin(2 * np.pi * 0.5 * timestamps)
+    data = np.stack([pupil_size, pupil_size, np.full(n_samples, 3), np.full(n_samples, 3)])
+    data[0, 400:440] = 0.  # a blink in the left eye
+    data[2, 400:440] = 0
+    data[1, 700] = 5e-3  # a dilation speed outlier in the right eye
+
+    pupil, _, invalid = preprocess_pupil(data, timestamps, channel_names, srate=srate, lowpass=None)
+    assert pupil.shape == invalid.shape == (2, n_samples)
+    # the samples next to the blink change at outlier speed too, then the mask is padded by 0.1 s before and 0.15 s after
+    assert np.array_equal(np.argwhere(invalid[0])[:, 0], np.arange(399 - 20, 440 + 30 + 1))
+    assert np.array_equal(np.argwhere(invalid[1])[:, 0], np.arange(699 - 20, 701 + 30 + 1))
+    assert np.allclose(pupil[0, 379:471], np.interp(timestamps[379:471], timestamps[[378, 471]], pupil_size[[378, 471]]))
+    assert np.allclose(pupil[:, ~invalid.any(axis=0)], data[:2, ~invalid.any(axis=0)])
+
+
+def test_average_binocular_pupil_falls_back_to_the_valid_eye():
+    pupil = np.array([[3., np.nan, 0., np.nan], [5., 4., 2., np.nan]])
+    assert np.allclose(average_binocular_pupil(pupil), [4., 4., 1., np.nan], equal_nan=True)
+    assert np.allclose(average_binocular_pupil(pupil, is_zero_nan=True), [4., 4., 2., np.nan], equal_nan=True)
+    assert average_binocular_pupil(np.stack([pupil, pupil]), axis=1).shape == (2, 4)
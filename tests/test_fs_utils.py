@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('rena')  # fs_utils reads the .dats with rena
+
+from fs_utils import hash_inputs, load_cached_array, save_cached_array, load_checkpoint, save_checkpoint
+
+
+def test_hash_inputs_changes_with_any_input():
+    data = np.arange(12, dtype=float).reshape(3, 4)
+    key = hash_inputs(data, srate=128, bad_channels=None)
+    assert key == hash_inputs(data.copy(), bad_channels=None, srate=128)
+    changed = data.copy()
+    changed[1, 2] += 1e-9
+    assert len({key, hash_inputs(changed, srate=128, bad_channels=None), hash_inputs(data.reshape(4, 3), srate=128, bad_channels=None),
+                hash_inputs(data.astype(np.float32), srate=128, bad_channels=None), hash_inputs(data, srate=256, bad_channels=None),
+                hash_inputs(data, srate=128, bad_channels=['Fp1'])}) == 6
+
+
+def test_hash_inputs_accepts_arrays_and_slices_as_parameters():
+    assert hash_inputs(notch_freqs=np.arange(60, 241, 60), condition=slice(0, 4)) != \
+           hash_inputs(notch_freqs=np.arange(60, 241, 60), condition=slice(4, 8))
+
+
+def test_cached_array_round_trip(tmp_path):
+    cache_root = str(tmp_path / 'cache')
+    assert load_cached_array(cache_root, 'missing') == (None, None)
+    array = np.random.default_rng(0).standard_normal((4, 100))
+    save_cached_array(cache_root, 'key', array, srate=128, data_channels=['Fz', 'Cz'], notch_freqs=np.arange(60, 121, 60))
+    cached, metadata = load_cached_array(cache_root, 'key')
+    assert np.array_equal(cached, array)
+    assert metadata == {'srate': 128, 'data_channels': ['Fz', 'Cz'], 'notch_freqs': [60, 120]}
+    assert not (tmp_path / 'cache' / 'key.npy.tmp').exists()
+
+
+def test_checkpoint_round_trip(tmp_path):
+    output = {'epochs': np.arange(6.).reshape(2, 3), 'labels': [1, 2]}
+    assert load_checkpoint(str(tmp_path), 'epoch', 'abc') is None
+    save_checkpoint(str(tmp_path), 'epoch', 'abc', output)
+    loaded = load_checkpoint(str(tmp_path), 'epoch', 'abc')
+    assert np.array_equal(loaded['epochs'], output['epochs']) and loaded['labels'] == [1, 2]
+    assert sorted(p.name for p in (tmp_path / 'epoch').iterdir()) == ['abc.p']  # no temporary file is left
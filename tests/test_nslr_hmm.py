@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+
+nslr_hmm = pytest.importorskip('nslr_hmm')  # requires nslr
+
+
+class TableObservationModel:
+    """the features are the emission likelihoods themselves"""
+    def __init__(self, n_states):
+        self.idxclass = np.arange(n_states)
+
+    def liks(self, feature):
+        return feature
+
+
+def random_hmm(rng, n_states=4, n_segments=60):
+    transitions = rng.uniform(0.05, 1., size=(n_states, n_states))
+    transitions /= transitions.sum(axis=1, keepdims=True)
+    emissions = rng.uniform(0.01, 1., size=(n_segments, n_states))
+    return transitions, emissions
+
+
+def decode_fixed_lag(transitions, emissions, lag):
+    decoder = nslr_hmm.FixedLagViterbi(lag=lag, observation_model=TableObservationModel(len(transitions)),
+                                       transition_model=transitions)
+    committed = []
+    for emission in emissions:
+        committed += decoder.push_feature(emission.copy())
+    committed += decoder.flush()
+    assert [i for i, _ in committed] == list(range(len(emissions)))
+    return [c for _, c in committed]
+
+
+def offline_viterbi(transitions, emissions):
+    initial = np.ones(len(transitions)) / len(transitions)
+    return nslr_hmm.viterbi(initial, transitions, [e / e.sum() for e in emissions])
+
+
+@pytest.mark.parametrize('lag', [0, 1, 3, 10, 100])
+def test_fixed_lag_viterbi_commits_the_offline_path_of_the_prefix(lag):
+    # the label committed for segment t is that of the best path over the segments up to t + lag
+    transitions, emissions = random_hmm(np.random.default_rng(lag))
+    committed = decode_fixed_lag(transitions, emissions, lag)
+    expected = [offline_viterbi(transitions, emissions[:min(t + lag, len(emissions) - 1) + 1])[t] for t in range(len(emissions))]
+    assert committed == expected
+
+
+def test_fixed_lag_viterbi_with_a_long_lag_is_the_offline_path():
+    transitions, emissions = random_hmm(np.random.default_rng(0))
+    assert decode_fixed_lag(transitions, emissions, len(emissions)) == offline_viterbi(transitions, emissions)
+
+
+def test_fixed_lag_viterbi_rejects_a_negative_lag():
+    with pytest.raises(ValueError):
+        nslr_hmm.FixedLagViterbi(lag=-1)
+
+
+def test_model_round_trip(tmp_path):
+    model_path = str(tmp_path / 'model.npz')
+    nslr_hmm.save_model(model_path, nslr_hmm.GazeTransitionModel, nslr_hmm.GazeObservationModel, n_segments=10)
+    transition_model, observation_model, metadata = nslr_hmm.load_model(model_path)
+    assert np.array_equal(transition_model, nslr_hmm.GazeTransitionModel)
+    assert metadata['n_segments'] == 10
+    assert list(observation_model.idxclass) == list(nslr_hmm.GazeObservationModel.idxclass)
+    for feature in [(0., 0.), (2., -1.), (1., 0.5)]:
+        assert np.allclose(observation_model.liks(feature), nslr_hmm.GazeObservationModel.liks(feature))
+
+
+def test_load_model_rejects_other_format_versions(tmp_path):
+    model_path = str(tmp_path / 'model.npz')
+    nslr_hmm.save_model(model_path, nslr_hmm.GazeTransitionModel, nslr_hmm.GazeObservationModel)
+    with np.load(model_path) as f:
+        arrays = dict(f)
+    arrays['metadata'] = np.array('{"format_version": -1}')
+    np.savez(model_path, **arrays)
+    with pytest.raises(ValueError):
+        nslr_hmm.load_model(model_path)
+
+
+def test_participant_gaze_model_is_loaded_from_its_file(tmp_path):
+    from eyetracking import load_participant_gaze_model
+    model_path = str(tmp_path / 'GazeHMMModel.npz')
+    nslr_hmm.save_model(model_path, nslr_hmm.GazeTransitionModel, nslr_hmm.GazeObservationModel, n_segments=10)
+    gaze_model = load_participant_gaze_model(model_path, sessions=None)  # the sessions are only needed to fit it
+    assert np.array_equal(gaze_model['transition_model'], nslr_hmm.GazeTransitionModel)
+
+
+class Segment:
+    def __init__(self, i, t, x):
+        self.i, self.t, self.x = i, t, x
+
+
+def fixed_segmentation(ts, xs, segment_samples=5):
+    """piecewise linear segments of segment_samples samples, in place of the nslr segmentation"""
+    bounds = list(range(0, len(ts), segment_samples)) + [len(ts)]
+    segments = [Segment((a, b), (ts[a], ts[b - 1]), np.array([xs[a], xs[b - 1]])) for a, b in zip(bounds[:-1], bounds[1:])]
+    return type('Segmentation', (), {'segments': segments})()
+
+
+def test_classify_gaze_batch_decodes_each_session_like_classify_segments(monkeypatch):
+    monkeypatch.setattr(nslr_hmm.nslr_hmm.nslr, 'fit_gaze', lambda ts, xs, **kwargs: fixed_segmentation(ts, xs), raising=False)
+    rng = np.random.default_rng(0)
+    sessions = [(np.arange(n) / 60., np.cumsum(rng.standard_normal((n, 2)) * rng.choice([0.01, 2.], (n, 1)), axis=0))
+                for n in [100, 37, 240]]
+    results = nslr_hmm.classify_gaze_batch(sessions)
+    assert len(results) == 3
+    for (ts, xs), (sample_classes, segmentation, seg_classes) in zip(sessions, results):
+        assert np.array_equal(seg_classes, nslr_hmm.classify_segments(segmentation.segments))
+        assert np.array_equal(sample_classes, np.repeat(seg_classes, [b - a for a, b in (s.i for s in segmentation.segments)]))
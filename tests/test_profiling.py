@@ -0,0 +1,41 @@
+import json
+import time
+
+import pytest
+
+pytest.importorskip('psutil')
+
+from profiling import StageProfiler, summarize_records, summary_table, save_trace
+
+
+def test_nested_stages_inherit_args_and_are_subtracted_from_the_self_time():
+    profiler = StageProfiler()
+    with profiler.stage('session', participant='0', session=1):
+        with profiler.stage('epoching', condition='RSVP'):
+            time.sleep(0.05)
+        time.sleep(0.02)
+    child, parent = profiler.drain()
+    assert profiler.records == []
+    assert (child['name'], parent['name']) == ('epoching', 'session')
+    assert child['args'] == {'participant': '0', 'session': 1, 'condition': 'RSVP'}
+    assert child['wall'] >= 0.05 and parent['wall'] >= child['wall'] + 0.02
+    assert parent['self_wall'] == pytest.approx(parent['wall'] - child['wall'])
+    assert parent['peak_rss'] >= child['peak_rss'] > 0
+
+
+def record(name, wall, peak_rss, **args):
+    return {'name': name, 'args': args, 'pid': 1, 'tid': 1, 'start': 0., 'wall': wall, 'cpu': wall / 2,
+            'self_wall': wall / 4, 'self_cpu': wall / 8, 'peak_rss': peak_rss}
+
+
+def test_summarize_records_groups_by_name_and_args(tmp_path):
+    records = [record('ica', 2., 10, participant='0'), record('ica', 4., 30, participant='1'), record('load', 1., 20, participant='0')]
+    summary = summarize_records(records)
+    assert summary[('ica',)] == {'count': 2, 'wall': 6., 'self_wall': 1.5, 'cpu': 3., 'self_cpu': 0.75, 'peak_rss': 30}
+    assert set(summarize_records(records, by=('name', 'participant')).keys()) == {('ica', '0'), ('ica', '1'), ('load', '0')}
+    assert summary_table(records).splitlines()[2].startswith('ica')  # sorted by the self wall time
+
+    save_trace(records, str(tmp_path / 'trace.json'))
+    with open(tmp_path / 'trace.json') as f:
+        trace_events = json.load(f)['traceEvents']
+    assert [x['dur'] for x in trace_events] == [2e6, 4e6, 1e6] and trace_events[0]['args']['participant'] == '0'
@@ -0,0 +1,119 @@
+import os
+from collections import defaultdict
+
+import numpy as np
+import pytest
+
+pytest.importorskip('mne')
+pytest.importorskip('rena')  # utils reads the .dats with rena
+pytest.importorskip('threadpoolctl')
+
+import session_pipeline
+from fs_utils import save_checkpoint
+from session_pipeline import reduce_session_result, session_stage_keys, downstream_stages, aggregate_key, SESSION_STAGES, \
+    fit_session_icas, load_aggregate
+from utils import ArrayEpochs, GrandAverageAccumulator
+
+
+def session_files(root):
+    paths = [str(root / x) for x in ['0.dats', '0_ReNaItemCatalog.json', '0_ReNaSessionLog.json', '0_ParticipantSessionICA']]
+    for path in paths[:3] + [paths[3] + '-ica.fif', paths[3] + '.txt']:
+        with open(path, 'w') as f:
+            f.write('0')
+    return paths
+
+
+def stage_config(**changes):
+    config = dict((parameter, 0) for _, parameters in SESSION_STAGES.values() for parameter in parameters)
+    config.update(changes)
+    return config
+
+
+@pytest.mark.parametrize('parameter, stage', [('exg_preprocess_mode', 'preprocess'), ('gaze_detector', 'gaze_detect'),
+                                              ('deconvolution_lambda', 'epoch'), ('is_ica_on_epochs', 'ica')])
+def test_a_parameter_changes_only_the_keys_downstream_of_its_stage(tmp_path, parameter, stage):
+    paths = session_files(tmp_path)
+    keys = session_stage_keys(*paths, None, None, stage_config())
+    changed_keys = session_stage_keys(*paths, None, None, stage_config(**{parameter: 1}))
+    assert set(x for x in keys if keys[x] != changed_keys[x]) == downstream_stages([stage])
+
+
+def test_input_files_and_the_aggregate_parameters_change_the_keys(tmp_path):
+    paths = session_files(tmp_path)
+    keys = session_stage_keys(*paths, None, None, stage_config())
+    assert session_stage_keys(*paths, ['Fz'], None, stage_config())['align'] == keys['align']  # bad channels
+    with open(paths[3] + '.txt', 'w') as f:  # new ICA exclusions
+        f.write('0\n1')
+    changed_keys = session_stage_keys(*paths, None, None, stage_config())
+    assert set(x for x in keys if keys[x] != changed_keys[x]) == {'ica', 'epoch'}
+
+    task = tuple(paths) + ('0', 0, None, None, stage_config(), None)
+    assert aggregate_key([task]) == aggregate_key([task])
+    assert aggregate_key([task], is_streaming_grand_average=True) != aggregate_key([task], is_streaming_grand_average=False)
+
+
+def test_a_refit_gaze_model_changes_the_keys_downstream_of_gaze_detect(tmp_path):
+    paths = session_files(tmp_path)
+    gaze_model_path = str(tmp_path / 'GazeHMMModel.npz')
+    with open(gaze_model_path, 'w') as f:
+        f.write('0')
+    keys = session_stage_keys(*paths, None, gaze_model_path, stage_config(gaze_detector='nslr_hmm'))
+    assert keys == session_stage_keys(*paths, None, gaze_model_path, stage_config(gaze_detector='nslr_hmm'))
+    with open(gaze_model_path, 'w') as f:  # the model is refit
+        f.write('01')
+    changed_keys = session_stage_keys(*paths, None, gaze_model_path, stage_config(gaze_detector='nslr_hmm'))
+    assert set(x for x in keys if keys[x] != changed_keys[x]) == downstream_stages(['gaze_detect'])
+
+
+@pytest.mark.parametrize('changes', [dict(recompute_stages=('gaze_detect',)), dict(recompute_stages=('aggregate',)),
+                                     dict(is_regenerate_ica=True)])
+def test_a_forced_stage_bypasses_the_saved_aggregate(tmp_path, changes):
+    config = stage_config(checkpoint_root=str(tmp_path / 'checkpoints'), recompute_stages=(), is_regenerate_ica=False)
+    task = tuple(session_files(tmp_path)) + ('0', 0, None, None, config, None)
+    save_checkpoint(config['checkpoint_root'], 'aggregate', aggregate_key([task], is_streaming_grand_average=True), 'aggregate')
+    assert load_aggregate([task], is_streaming_grand_average=True) == 'aggregate'
+    assert load_aggregate([task], is_streaming_grand_average=False) is None
+    forced_task = task[:8] + (dict(config, **changes),) + task[9:]
+    assert aggregate_key([forced_task], is_streaming_grand_average=True) == aggregate_key([task], is_streaming_grand_average=True)
+    assert load_aggregate([forced_task], is_streaming_grand_average=True) is None
+
+
+def session_result(labels):
+    epochs = ArrayEpochs(np.ones((len(labels), 2, 5)), labels, {'Distractor': 1, 'Target': 2}, ['a', 'b'], 0., 10.)
+    return [('RSVP', {'fixation_durations': None, 'normalized_fixation_count': None, 'fixations': [], 'saccades': [],
+                      'epochs': (epochs, None, epochs, np.asarray(labels), None), 'rerps': {'Target': np.zeros((2, 5))}})]
+
+
+@pytest.mark.parametrize('is_keep_epochs', [True, False])
+def test_reduce_session_result_keeps_the_epochs_only_if_asked(is_keep_epochs):
+    participant_condition_epoch_dict = defaultdict(dict)
+    participant_condition_rerp_dict = defaultdict(lambda: defaultdict(list))
+    condition_gaze_behaviors = defaultdict(lambda: {'fixations': [], 'saccades': []})
+    grand_average = GrandAverageAccumulator({'Distractor': 'Distractor', 'Target': 'Target'})
+    for labels in [[1, 2, 2], [1, 1]]:
+        reduce_session_result('0', session_result(labels), participant_condition_epoch_dict, defaultdict(dict),
+                              condition_gaze_behaviors, participant_condition_rerp_dict,
+                              grand_averages=[(grand_average, 2)], is_keep_epochs=is_keep_epochs)
+    assert grand_average.stats['RSVP']['Distractor'].count == 3 and grand_average.stats['RSVP']['Target'].count == 2
+    assert len(participant_condition_rerp_dict['0']['RSVP']) == 2
+    if is_keep_epochs:
+        assert participant_condition_epoch_dict['0']['RSVP'][3].tolist() == [1, 2, 2, 1, 1]
+    else:
+        assert len(participant_condition_epoch_dict['0']) == 0
+
+
+def test_fit_session_icas_fits_only_the_missing_icas_in_this_process_without_thread_limits(tmp_path, monkeypatch):
+    from threadpoolctl import threadpool_info
+    fitted = []
+    monkeypatch.setattr(session_pipeline, '_fit_session_ica', lambda task: fitted.append((task[5], threadpool_info())))
+    tasks = []
+    for session_index, is_regenerate_ica in [(0, False), (1, False), (2, True)]:
+        (tmp_path / str(session_index)).mkdir()
+        paths = session_files(tmp_path / str(session_index))
+        tasks.append(tuple(paths) + ('0', session_index, None, None, stage_config(is_regenerate_ica=is_regenerate_ica), None))
+    os.remove(tasks[1][3] + '-ica.fif')
+
+    fitted_tasks = fit_session_icas(tasks, n_workers=1, n_threads=1)
+    assert [session_index for session_index, _ in fitted] == [1, 2]
+    assert [x['num_threads'] for x in fitted[0][1]] == [x['num_threads'] for x in threadpool_info()]
+    assert fitted_tasks[0] is tasks[0] and not fitted_tasks[2][8]['is_regenerate_ica'] and tasks[2][8]['is_regenerate_ica']
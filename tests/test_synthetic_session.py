@@ -0,0 +1,42 @@
+import json
+import os
+import pickle
+
+import numpy as np
+
+from synthetic_session import generate_session, write_synthetic_participants, VARJO_CHANNEL_NAMES, \
+    NUM_EVENT_MARKER_CONDITIONS, NUM_BLOCK_ITEMS, NUM_ITEM_MARKER_ROWS
+
+
+def test_generate_session_has_the_stream_layouts_of_the_recordings():
+    data, item_catalog, session_log = generate_session(120., seed=1, exg_srate=256, eyetracking_srate=200, item_marker_srate=60)
+    expected_shapes = {'BioSemi': (73, 120 * 256), 'Unity.VarjoEyeTrackingComplete': (len(VARJO_CHANNEL_NAMES), 120 * 200),
+                       'Unity.ReNa.ItemMarkers': (NUM_BLOCK_ITEMS * NUM_ITEM_MARKER_ROWS, 120 * 60)}
+    for stream_name, (stream, timestamps) in data.items():
+        assert stream.shape[1] == len(timestamps) and np.all(np.diff(timestamps) > 0)
+        if stream_name in expected_shapes:
+            assert stream.shape == expected_shapes[stream_name]
+    event_markers = data['Unity.ReNa.EventMarkers'][0]
+    assert event_markers.shape[0] == 4 * NUM_EVENT_MARKER_CONDITIONS
+
+    # every block of the session log starts in the event rows of one condition
+    assert len(session_log) == NUM_EVENT_MARKER_CONDITIONS * 3
+    assert set(int(x) for x in session_log.keys()) <= set(np.unique(event_markers[0::4]).astype(int))
+    for block in session_log.values():
+        assert set(block['targets'] + block['distractors'] + block['novelties']) <= set(item_catalog.values())
+
+    same_seed, _, _ = generate_session(120., seed=1, exg_srate=256)
+    assert np.array_equal(same_seed['BioSemi'][0], data['BioSemi'][0])
+
+
+def test_write_synthetic_participants_keeps_existing_sessions(tmp_path):
+    write_synthetic_participants(str(tmp_path), 1, 2, 120., exg_srate=256)
+    assert sorted(os.listdir(tmp_path / '0')) == ['0.p', '0_ReNaItemCatalog.json', '0_ReNaSessionLog.json',
+                                                  '1.p', '1_ReNaItemCatalog.json', '1_ReNaSessionLog.json']
+    modified_time = os.stat(tmp_path / '0' / '0.p').st_mtime_ns
+    write_synthetic_participants(str(tmp_path), 1, 2, 120., exg_srate=256)
+    assert os.stat(tmp_path / '0' / '0.p').st_mtime_ns == modified_time
+    with open(tmp_path / '0' / '1.p', 'rb') as f:
+        assert set(pickle.load(f).keys()) == {'BioSemi', 'Unity.VarjoEyeTrackingComplete', 'Unity.ReNa.EventMarkers', 'Unity.ReNa.ItemMarkers'}
+    with open(tmp_path / '0' / '1_ReNaSessionLog.json') as f:
+        assert len(json.load(f)) == 12
@@ -0,0 +1,340 @@
+import numpy as np
+import pytest
+import scipy.stats
+
+mne = pytest.importorskip('mne')
+pytest.importorskip('rena')  # utils reads the .dats with rena
+
+from utils import condition_view, resample_event_array
+
+
+def test_resample_event_array_moves_events_to_the_nearest_sample():
+    event_timestamps = np.arange(100) / 200.
+    data_timestamps = np.arange(64) / 128.
+    event_array = np.zeros((2, 100))
+    event_array[0, 10], event_array[1, 37] = 6, 7
+    resampled = resample_event_array(event_array, event_timestamps, data_timestamps)
+    assert resampled.shape == (2, 64)
+    assert np.argwhere(resampled).tolist() == [[0, int(round(10 / 200. * 128))], [1, int(round(37 / 200. * 128))]]
+    assert resampled[0, 6] == 6 and resampled[1, 24] == 7
+
+
+def test_conditions_are_views_of_the_shared_session_data():
+    data_timestamps = 1000. + np.arange(128 * 20) / 128.
+    conditions = []
+    for start, end, code in [(2., 8., 6), (11., 19., 7)]:  # two conditions of one session
+        marker_timestamps = np.arange(1000. + start, 1000. + end, 1 / 200.)
+        markers = np.zeros((1, len(marker_timestamps)))
+        markers[0, 100] = code
+        conditions.append(condition_view(data_timestamps, np.concatenate([marker_timestamps[None, :], markers])))
+    for (condition_start, condition_end, condition_events), (start, end, code) in zip(conditions, [(2., 8., 6), (11., 19., 7)]):
+        assert condition_start == int(start * 128)
+        assert condition_end - condition_start == condition_events.shape[1]
+        assert np.argwhere(condition_events[0] == code)[:, 0].tolist() == [int(round(0.5 * 128))]
+
+
+def test_decimation_stages():
+    from utils import decimation_stages
+    assert decimation_stages(2048, 128) == [4, 4]
+    assert decimation_stages(2048, 256) == [8]
+    assert decimation_stages(128, 128) == []
+    with pytest.raises(ValueError):
+        decimation_stages(2048, 100)
+    with pytest.raises(ValueError):
+        decimation_stages(2048 * 11, 2048)
+
+
+def test_decimate_exg_keeps_the_passband_and_aligns_the_timestamps():
+    from utils import decimate_exg
+    srate, resample_srate = 2048, 128
+    timestamps = 500. + np.arange(srate * 10) / srate
+    exg = np.stack([np.sin(2 * np.pi * 10 * timestamps), np.sin(2 * np.pi * 300 * timestamps)])
+    decimated, decimated_timestamps = decimate_exg(exg, timestamps, srate, resample_srate)
+    assert decimated.shape == (2, 10 * resample_srate)
+    assert np.array_equal(decimated_timestamps, timestamps[::16])
+    middle = slice(resample_srate, -resample_srate)  # away from the filter edges
+    assert np.allclose(decimated[0, middle], np.sin(2 * np.pi * 10 * decimated_timestamps[middle]), atol=1e-2)
+    assert np.max(np.abs(decimated[1, middle])) < 1e-2  # above the new Nyquist, must not alias
+
+
+def test_decimate_first_agrees_with_standard_preprocessing():
+    from utils import filter_resample_exg
+    srate = 2048
+    channels = mne.channels.make_standard_montage('biosemi64').ch_names
+    rng = np.random.default_rng(0)
+    timestamps = np.arange(srate * 30) / srate
+    sources = np.stack([np.sin(2 * np.pi * f * timestamps + p) for f, p in zip(rng.uniform(2, 30, 8), rng.uniform(0, 2 * np.pi, 8))])
+    exg = 1e-5 * (rng.standard_normal((len(channels), 8)) @ sources + 0.1 * rng.standard_normal((len(channels), len(timestamps))))
+    raws = [filter_resample_exg(exg, timestamps, channels, ['eeg'] * len(channels), srate=srate, preprocess_mode=mode)
+            for mode in ['standard', 'decimate_first']]
+    (standard, standard_timestamps), (decimated, decimated_timestamps) = raws
+    assert standard.info['sfreq'] == decimated.info['sfreq'] == 128
+    num_times = min(standard.n_times, decimated.n_times)
+    middle = slice(256, num_times - 256)
+    assert np.allclose(standard_timestamps[middle], decimated_timestamps[middle], atol=1 / srate)
+    correlations = [np.corrcoef(a, b)[0, 1] for a, b in zip(standard.get_data()[:, middle], decimated.get_data()[:, middle])]
+    assert np.min(correlations) > 0.99
+
+
+def test_epoch_design_matrix_slices_the_continuous_design_matrix():
+    from utils import build_design_matrix, EpochDesignMatrix
+    srate, erp_window = 100, (0., 0.2)
+    event_markers = np.zeros(1000)
+    event_markers[[100, 110, 400, 700]] = [1, 2, 3, 1]
+    design_matrix = build_design_matrix(event_markers, srate, erp_window)
+    dense = design_matrix.toarray()
+    event_indices, tmin, num_times = np.array([100, 400, 700]), -0.1, 41
+    epoch_design_matrix = EpochDesignMatrix([design_matrix], [event_indices], tmin, num_times, srate)
+    expected = np.stack([dense[i - 10:i + 31].T for i in event_indices])
+    assert len(epoch_design_matrix) == 3
+    assert np.array_equal(epoch_design_matrix.get_data(), expected)
+    concatenated = EpochDesignMatrix.concatenate([epoch_design_matrix, epoch_design_matrix])
+    assert np.array_equal(concatenated.get_data(), np.concatenate([expected, expected]))
+
+
+def test_build_design_matrix_places_every_event_window():
+    from utils import build_design_matrix, design_matrix_column_names
+    srate, erp_window = 100, (0., 0.1)
+    event_markers = np.zeros(200)
+    event_markers[[20, 25, 195]] = [2, 1, 2]
+    amplitude = np.zeros(200)
+    amplitude[[20, 25, 195]] = [3., 4., 5.]
+    design_matrix = build_design_matrix(event_markers, srate, erp_window, event_type_of_interest=(2, 1),
+                                        covariates={'amplitude': amplitude}).toarray()
+    assert design_matrix.shape == (200, 3 * 10)
+    assert len(design_matrix_column_names(srate, erp_window, (2, 1), ['amplitude'])) == 30
+    lags = np.arange(10)
+    assert np.array_equal(np.argwhere(design_matrix[:, :10]), np.stack([np.concatenate([20 + lags, 195 + lags[:5]]),
+                                                                        np.concatenate([lags, lags[:5]])], axis=1))
+    assert np.array_equal(design_matrix[25 + lags, 10 + lags], np.ones(10))  # type 1 is the second block
+    # the covariate block carries the values of all the events, a sample where two windows overlap has both
+    assert design_matrix[27, 20 + 7] == 3. and design_matrix[27, 20 + 2] == 4.
+    assert design_matrix[199, 20 + 4] == 5. and np.sum(design_matrix[:, 20:]) == 10 * 3. + 10 * 4. + 5 * 5.
+
+
+def test_build_design_matrix_rounds_the_erp_window_to_samples():
+    from utils import build_design_matrix, design_matrix_column_names
+    srate, erp_window = 100, (-0.2, 0.09)  # 100 * 0.29 is 28.999..., which truncates to 28
+    event_markers = np.zeros(100)
+    event_markers[50] = 1
+    design_matrix = build_design_matrix(event_markers, srate, erp_window, event_type_of_interest=(1,)).toarray()
+    assert design_matrix.shape == (100, 29) and len(design_matrix_column_names(srate, erp_window, (1,))) == 29
+    assert np.array_equal(np.argwhere(design_matrix[:, 0])[:, 0], [30])  # the window starts 20 samples before the event
+
+
+def test_interpolate_epochs_matches_per_channel_interpolation():
+    from utils import interpolate_epochs, interpolate_nan
+    rng = np.random.default_rng(0)
+    epochs = rng.uniform(1., 2., (6, 2, 40))
+    epochs[0, 0, 10:15] = np.nan  # inside
+    epochs[1, 1, :4] = np.nan  # leading, extrapolated
+    epochs[2, 0, -3:] = 0.  # trailing zeros
+    epochs[3, 1, ::2] = np.nan  # exactly half is kept
+    epochs[4, 0, :25] = np.nan  # more than half, rejected
+    interpolated, rejected = interpolate_epochs(epochs, is_zero_nan=True)
+    assert rejected.tolist() == [False, False, False, False, True, False] and interpolated.shape == (5, 2, 40)
+    expected = epochs[~rejected].copy()
+    expected[expected == 0] = np.nan
+    expected = np.array([[interpolate_nan(channel) for channel in epoch] for epoch in expected])
+    assert np.allclose(interpolated, expected)
+    assert np.allclose(interpolated[0, 0, 10:15], np.interp(np.arange(10, 15), [9, 15], epochs[0, 0, [9, 15]]))
+
+
+def test_pupil_epochs_fall_back_to_the_valid_eye():
+    from utils import prepare_pupil_epochs_for_viz
+    rng = np.random.default_rng(0)
+    epochs = rng.uniform(2e-3, 4e-3, (5, 2, 100))
+    epochs[:, 0] = np.nan  # the left eye is not tracked
+    epochs[0, 1, 10:20] = 0.
+    y = prepare_pupil_epochs_for_viz(epochs)
+    assert y.shape == (5, 100) and not np.any(np.isnan(y))
+    assert np.allclose(y[1:], scipy.stats.zscore(epochs[1:, 1], axis=1))
+
+
+def test_condition_eeg_epochs_match_mne_epochs():
+    from utils import generate_condition_eeg_event_epochs
+    srate, num_samples = 128, 128 * 10
+    rng = np.random.default_rng(0)
+    info = mne.create_info(['Fz', 'Cz', 'Pz'], sfreq=srate, ch_types='eeg')
+    raw = mne.io.RawArray(rng.standard_normal((3, num_samples)) * 1e-5, info, verbose=False)
+    raw.set_montage(mne.channels.make_standard_montage('biosemi64'))
+    data_timestamps = 1000. + np.arange(num_samples) / srate
+    event_markers = np.zeros(num_samples)
+    event_markers[[300, 500, 700, 900]] = [1, 2, 1, 2]
+    event_markers[10] = 3  # the only event of type 3 is too close to the start for its epoch
+    marker_array = np.stack([data_timestamps, event_markers])
+    event_ids = {'Distractor': 1, 'Target': 2, 'Novelty': 3}
+
+    epochs, epochs_ica_cleaned, labels, design_matrix = generate_condition_eeg_event_epochs(
+        raw, raw, data_timestamps, marker_array, ['EventMarker'], -0.2, 0.8, event_ids, 'EventMarker')
+    assert labels.tolist() == [1, 2, 1, 2] and epochs.event_id == {'Distractor': 1, 'Target': 2}
+
+    stim_raw = raw.copy().add_channels([mne.io.RawArray(event_markers[None], mne.create_info(['EventMarker'], srate, 'stim'), verbose=False)])
+    expected = mne.Epochs(stim_raw, mne.find_events(stim_raw, shortest_event=1, verbose=False), event_ids, -0.2, 0.8,
+                          baseline=(-0.1, 0.0), preload=True, on_missing='ignore', verbose=False)
+    assert np.array_equal(expected.events, epochs.events)
+    assert np.allclose(expected.get_data(), epochs.get_data())
+    assert np.allclose(epochs_ica_cleaned.get_data(picks='eeg'), expected.get_data(picks='eeg'))
+    assert len(design_matrix) == 4
+
+
+def test_find_event_onsets_matches_mne_find_events():
+    from utils import find_event_onsets
+    event_channel = np.array([0, 3, 1, 0, 0, 2, 2, 1, 0, 5])
+    assert find_event_onsets(event_channel).tolist() == [[1, 0, 3], [5, 0, 2], [9, 0, 5]]
+    rng = np.random.default_rng(0)
+    for event_channel in [np.array([3, 3, 0, 2, 0]), np.array([3, 5, 0, 1, 2, 3, 0])] + \
+                         [rng.choice(4, 50, p=[0.6, 0.2, 0.1, 0.1]) for _ in range(20)]:
+        raw = mne.io.RawArray(event_channel[None, :].astype(float), mne.create_info(['STI'], 100., ['stim']), verbose=False)
+        assert np.array_equal(find_event_onsets(event_channel),
+                              mne.find_events(raw, shortest_event=1, verbose=False).reshape(-1, 3))
+
+
+def test_extract_event_epochs_matches_mne_epochs():
+    from utils import extract_event_epochs
+    srate, num_samples = 200, 2000
+    data = np.random.default_rng(0).standard_normal((2, num_samples))
+    event_channel = np.zeros(num_samples)
+    event_channel[[100, 600, 601, 1000, 1990]] = [1, 2, 2, 4, 1]  # a held marker is one event, the last one is too late
+    epochs, labels, event_indices = extract_event_epochs(data, event_channel, {'A': 1, 'B': 2}, -0.5, 1., srate, baseline=(-0.5, 0.))
+    assert labels.tolist() == [1, 2] and event_indices.tolist() == [100, 600]
+
+    raw = mne.io.RawArray(np.concatenate([data, event_channel[None]]), mne.create_info(['x', 'y', 'stim'], srate, ['eeg', 'eeg', 'stim']), verbose=False)
+    expected = mne.Epochs(raw, mne.find_events(raw, shortest_event=1, verbose=False), {'A': 1, 'B': 2}, -0.5, 1.,
+                          baseline=(-0.5, 0.), picks=['x', 'y'], preload=True, verbose=False)
+    assert np.allclose(epochs, expected.get_data(copy=False)) and epochs.dtype == np.float64
+    assert not np.shares_memory(epochs, data)
+
+
+def test_epoch_accumulator_concatenates_each_modality_once():
+    import pickle
+    from utils import EpochAccumulator
+    accumulator = EpochAccumulator()
+    accumulator.append(np.zeros((2, 3)), np.array([1, 2]))
+    accumulator.append(np.ones((4, 3)), np.array([2, 2, 1, 1]))
+    data, labels = accumulator
+    assert len(accumulator) == 2 and data.shape == (6, 3) and labels.tolist() == [1, 2, 2, 2, 1, 1]
+    assert accumulator[0] is data  # read again from the cache
+    accumulator.append(np.ones((1, 3)), np.array([3]))
+    assert accumulator[0].shape == (7, 3)
+
+    merged = EpochAccumulator.merge([accumulator, pickle.loads(pickle.dumps(accumulator))])
+    assert merged[1].tolist() == 2 * [1, 2, 2, 2, 1, 1, 3]
+    assert '_concatenated' not in accumulator.__getstate__()
+
+
+def test_running_epoch_stats_match_the_concatenated_epochs():
+    from utils import RunningEpochStats
+    rng = np.random.default_rng(0)
+    batches = [rng.normal(i, 1. + i, (n, 2, 5)) for i, n in enumerate([3, 1, 10])]
+    stats = RunningEpochStats().update(batches[0]).update(np.empty((0, 2, 5)))
+    stats.merge(RunningEpochStats().update(batches[1]).update(batches[2]))
+    epochs = np.concatenate(batches)
+    assert stats.count == 14
+    assert np.allclose(stats.mean, epochs.mean(axis=0)) and np.allclose(stats.sem, scipy.stats.sem(epochs, axis=0))
+
+
+def test_grand_average_accumulator_streams_the_sessions_of_each_event_group():
+    from utils import GrandAverageAccumulator, ArrayEpochs
+    rng = np.random.default_rng(0)
+    event_ids = {'Distractor': 1, 'Target': 2}
+    sessions = [ArrayEpochs(rng.standard_normal((6, 2, 11)), [1, 2, 1, 1, 2, 1], event_ids, ['a', 'b'], -0.5, 10.),
+                ArrayEpochs(rng.standard_normal((3, 2, 11)), [1, 1, 1], {'Distractor': 1}, ['a', 'b'], -0.5, 10.)]
+    grand_average = GrandAverageAccumulator({'Distractor': 'Distractor', 'Target': ['Target']}, transform=lambda y: y[:, 0])
+    for session in sessions:
+        grand_average.update('RSVP', session)
+    all_epochs = ArrayEpochs.concatenate(sessions)
+    assert grand_average.stats['RSVP']['Distractor'].count == 7 and grand_average.stats['RSVP']['Target'].count == 2
+    assert np.allclose(grand_average.stats['RSVP']['Distractor'].mean, all_epochs['Distractor'].get_data()[:, 0].mean(axis=0))
+    assert grand_average.time_indices('RSVP', -0.2, 0.3) == (slice(3, 9), 5)
+
+
+def test_running_epoch_stats_sem_is_nan_for_a_single_epoch():
+    from utils import RunningEpochStats
+    with np.errstate(all='raise'):
+        assert np.all(np.isnan(RunningEpochStats().update(np.ones((1, 2, 5))).sem))
+        assert RunningEpochStats().update(np.ones((1, 2, 5))).sem.shape == (2, 5)
+
+
+def test_pupil_grand_average_draws_the_same_lines_as_the_epochs(monkeypatch):
+    import matplotlib.pyplot as plt
+    from utils import GrandAverageAccumulator, ArrayEpochs, prepare_pupil_epochs_for_viz, visualize_pupil_epochs, \
+        visualize_pupil_grand_average
+    plt.switch_backend('Agg')
+    drawn = []
+    monkeypatch.setattr(plt, 'show', lambda: (drawn.append([line.get_ydata() for line in plt.gcf().axes[0].lines]), plt.clf()))
+    rng = np.random.default_rng(0)
+    event_ids, event_groups, color_dict = {'Distractor': 1, 'Target': 2}, {'Distractor': 'Distractor', 'Target': ['Target']}, \
+                                          {'Distractor': 'blue', 'Target': 'red'}
+    epochs = ArrayEpochs(rng.uniform(2e-3, 4e-3, (6, 2, 21)), [1, 2, 1, 1, 2, 1], event_ids, ['left', 'right'], -0.5, 20.)
+    grand_average = GrandAverageAccumulator(event_groups, transform=prepare_pupil_epochs_for_viz)
+    grand_average.update('RSVP', epochs)
+    visualize_pupil_epochs(epochs, event_groups, -0.5, 0.5, color_dict, 'RSVP', srate=20)
+    visualize_pupil_grand_average(grand_average, 'RSVP', -0.5, 0.5, color_dict, 'RSVP')
+    assert len(drawn[0]) == len(drawn[1]) == 2 and all(np.allclose(x, y) for x, y in zip(*drawn))
+
+
+def test_compact_marker_array_expands_back_to_the_full_array():
+    from utils import compact_marker_array, expand_marker_array
+    data_timestamps = 50. + np.arange(1000) / 200.
+    markers = np.zeros((2, 600))
+    markers[0, [10, 300]], markers[1, 450] = [1, 2], 7
+    marker_array = np.concatenate([data_timestamps[None, 200:800], markers])
+    compact = compact_marker_array(marker_array)
+    assert compact.shape == (3, 5)  # the first and the last sample are kept with the three events
+    start, end, expanded = expand_marker_array(compact, data_timestamps)
+    assert (start, end) == (200, 800) and np.array_equal(expanded, marker_array)
+
+
+def artifact_raw(seed=0, srate=128, duration=60.):
+    """EEG mixed from random sources, with ECG leaking into all the channels and blinks decaying from the front"""
+    rng = np.random.default_rng(seed)
+    num_samples = int(srate * duration)
+    ch_names = ['Fp1', 'Fpz', 'Fp2', 'F3', 'Fz', 'F4', 'C3', 'Cz', 'C4', 'P3', 'Pz', 'P4', 'O1', 'Oz', 'O2']
+    ecg, blink = np.zeros(num_samples), np.zeros(num_samples)
+    ecg[(np.arange(0.5, duration, 0.8) * srate).astype(int)] = 1
+    blink[(rng.uniform(0, duration - 1, 20) * srate).astype(int)] = 1
+    ecg, blink = np.convolve(ecg, np.hanning(9), mode='same'), np.convolve(blink, np.hanning(40), mode='same')
+    eeg = rng.standard_normal((len(ch_names), len(ch_names) - 2)) @ rng.laplace(size=(len(ch_names) - 2, num_samples)) \
+          + 5 * rng.uniform(0.5, 1, (len(ch_names), 1)) * ecg + np.linspace(20, 0, len(ch_names))[:, None] * blink
+    info = mne.create_info(ch_names + ['ECG00'], srate, ['eeg'] * len(ch_names) + ['ecg'])
+    raw = mne.io.RawArray(np.concatenate([eeg, 5 * ecg[None]]) * 1e-6, info, verbose=False)
+    raw.set_montage(mne.channels.make_standard_montage('biosemi64'))
+    return raw
+
+
+def test_load_or_fit_ica_saves_the_flagged_excludes_unreviewed(tmp_path):
+    from utils import load_or_fit_ica, load_ica_flags, save_ica_excludes
+    ica_path = str(tmp_path / '0_ParticipantSessionICA')
+    raw = artifact_raw()
+    ica = load_or_fit_ica(raw, ica_path, n_components=14)
+    flags = load_ica_flags(ica_path)
+    assert len(flags['ecg_scores']) == len(flags['eog_scores']) == 14 and not flags['reviewed']
+    assert int(np.argmax(flags['eog_scores'])) in flags['eog']  # the blinks
+    assert ica.exclude == sorted(set(flags['ecg'] + flags['eog']))
+    assert load_or_fit_ica(raw, ica_path).exclude == ica.exclude  # loaded, not refitted
+
+    save_ica_excludes(ica_path, [2, 5], dict(flags, reviewed=True))
+    assert load_or_fit_ica(raw, ica_path).exclude == [2, 5] and load_ica_flags(ica_path)['reviewed']
+    save_ica_excludes(str(tmp_path / 'unflagged'), [1])
+    assert load_ica_flags(str(tmp_path / 'unflagged')) is None
+
+
+def test_fit_ica_trains_on_the_eeg_of_spread_segments():
+    from utils import fit_ica
+    raw = artifact_raw(duration=120.)
+    ica = fit_ica(raw, n_components=5, max_duration=30., num_segments=3, decim=2)
+    assert ica.ch_names == raw.copy().pick_types(eeg=True).ch_names  # the ECG channel is not fitted
+    assert ica.n_samples_ == int(30. * 128) // 2
+    assert raw.info['highpass'] == 0.  # the high-pass is applied to the training copy only
+    assert ica.apply(raw.copy()).get_data().shape == raw.get_data().shape
+
+
+def test_epoch_design_matrix_saves_the_layout_deconv_loads(tmp_path):
+    from utils import build_design_matrix, EpochDesignMatrix
+    event_markers = np.zeros(100)
+    event_markers[[30, 60]] = [1, 2]
+    epoch_design_matrix = EpochDesignMatrix([build_design_matrix(event_markers, 100, (0., 0.1))], [np.array([30, 60])], -0.1, 31, 100)
+    epoch_design_matrix.save(str(tmp_path / 'dm.npy'))
+    saved = np.load(tmp_path / 'dm.npy')
+    assert saved.shape == (2, 30, 31) and np.array_equal(saved, epoch_design_matrix.get_data())
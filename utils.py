@@ -1,10 +1,13 @@
 import math
 import os
 import random
+import time
 from copy import copy
 
 import numpy as np
 import scipy
+import scipy.signal
+import scipy.sparse
 from mne.io import RawArray
 from mne.preprocessing import create_ecg_epochs
 from scipy.interpolate import interp1d
@@ -14,11 +17,11 @@ import imageio
 import mne
 import numpy as np
 import matplotlib.pyplot as plt
-from mne import find_events, Epochs
 from params import event_id_color_code_dict, event_color_dict, event_marker_color_dict
 from rena.utils.data_utils import RNStream
 
-from eyetracking import running_mean, Saccade
+from eyetracking import running_mean, Saccade, average_binocular_pupil
+from Learning.deconv_utils import deconvolve_continuous, split_rerps
 
 FIXATION_MINIMAL_TIME = 1e-3 * 141.42135623730952
 ITEM_TYPE_ENCODING = {1: 'distractor', 2: 'target', 3: 'novelty'}
@@ -49,29 +52,56 @@ def interpolate_array_nan(data_array):
     return np.array([interpolate_nan(x) for x in data_array])
 
 
+def interpolate_epochs(epoch_array, is_zero_nan=False):
+    """
+    linearly interpolate (and extrapolate at the edges) the nan of every channel of every epoch in one vectorized pass,
+    the same result as interpolate_nan on each channel
+    an epoch is rejected if any of its channels is more than half nan, as in interpolate_nan
+    :param epoch_array: of shape (epochs, channels, time)
+    :param is_zero_nan: treat zeros as nan, e.g., the pupil size is zero when the eye is not tracked
+    :return: the interpolated kept epochs, and the boolean mask of the rejected epochs
+    """
+    epoch_array = np.asarray(epoch_array)
+    invalid = np.isnan(epoch_array)
+    if is_zero_nan:
+        invalid |= epoch_array == 0
+    num_valid = epoch_array.shape[-1] - np.sum(invalid, axis=-1)
+    rejected = np.any((np.sum(invalid, axis=-1) / epoch_array.shape[-1] > 0.5) | (num_valid < 2), axis=-1)
+    print("Rejected {0} epochs of {1} total".format(np.sum(rejected), len(epoch_array)))
+
+    out = epoch_array[~rejected].astype(float, copy=False)  # the boolean index already copies, the interpolation fills the copy in place
+    invalid = invalid[~rejected]
+    if not np.any(invalid):
+        return out, rejected
+    rows, out_rows = invalid.reshape(-1, out.shape[-1]), out.reshape(-1, out.shape[-1])
+    indices = np.arange(out.shape[-1])
+    # index of the previous and next valid sample of every sample, -1 or len when there is none
+    previous_valid = np.maximum.accumulate(np.where(rows, -1, indices), axis=-1)
+    next_valid = np.minimum.accumulate(np.where(rows, len(indices), indices)[:, ::-1], axis=-1)[:, ::-1]
+    # extrapolate the leading and trailing nan from the first two and the last two valid samples
+    row_range = np.arange(len(rows))
+    first_valid, last_valid = next_valid[:, 0], previous_valid[:, -1]
+    second_valid, second_last_valid = next_valid[row_range, first_valid + 1], previous_valid[row_range, last_valid - 1]
+    leading, trailing = previous_valid == -1, next_valid == len(indices)
+    previous_valid = np.where(leading, first_valid[:, None], np.where(trailing, second_last_valid[:, None], previous_valid))
+    next_valid = np.where(leading, second_valid[:, None], np.where(trailing, last_valid[:, None], next_valid))
+
+    row_index, sample_index = np.nonzero(rows)
+    x0, x1 = previous_valid[row_index, sample_index], next_valid[row_index, sample_index]
+    y0, y1 = out_rows[row_index, x0], out_rows[row_index, x1]
+    out_rows[row_index, sample_index] = y0 + (y1 - y0) * (sample_index - x0) / (x1 - x0)
+    return out, rejected
+
+
 def interpolate_epochs_nan(epoch_array):
     """
     :param data_array: channel first, time last
     """
-    rtn = []
-    rejected_count = 0
-    for e in epoch_array:
-        temp = []
-        try:
-            for x in e:
-                temp.append(interpolate_nan(x))
-        except ValueError:  # something wrong with this epoch, maybe more than half are nan
-            rejected_count += 1
-            continue  # reject this epoch
-        rtn.append(temp)
-    print("Rejected {0} epochs of {1} total".format(rejected_count, len(epoch_array)))
-    return np.array(rtn)
+    return interpolate_epochs(epoch_array)[0]
 
 
 def interpolate_epoch_zeros(e):
-    copy = np.copy(e)
-    copy[copy == 0] = np.nan
-    return interpolate_epochs_nan(copy)
+    return interpolate_epochs(e, is_zero_nan=True)[0]
 
 def find_value_thresholding_interval(array, timestamps, value_threshold, time_threshold, time_tolerance=0.25):
     # change all zeros before the first non-zero entry to be nan
@@ -145,26 +175,111 @@ def add_em_ts_to_data(event_markers, event_marker_timestamps, data_array, data_t
 def add_design_matrix_to_data(data_array, event_marker_index, srate, erp_window, event_type_of_interest=(1, 2, 3)):
     '''
     expect data_array to have be of shape [time, LSLTimestamp(x 1)+data(x n)+event_markers(x n)]
+    prefer build_design_matrix, which keeps the design matrix out of the data array
     :param data_eventMarker_array_:
     :param event_type_of_interest: 1, 2, 3 only interested in targets distrctors and novelties
     :return:
     '''
-    # get the event marker array
-    eventMarker_array = data_array[event_marker_index]
-    num_samples_erp_window = int(srate * (erp_window[1] - erp_window[0]))
-    design_matrix = np.zeros((len(event_type_of_interest) * num_samples_erp_window, data_array.shape[1]))
-    event_indices = [((flatten_list(np.argwhere(eventMarker_array == event_type)))) for event_type in event_type_of_interest]
-    event_indices = flatten_list([[(e, event_type) for e in events] for event_type, events in zip(event_type_of_interest, event_indices)])
-    for event_index, event_type in event_indices:
-        dm_time_start_index = event_index
-        dm_erpTime_start_index = (event_type - 1) * num_samples_erp_window
-        for i in range(num_samples_erp_window):
-            assert design_matrix[dm_erpTime_start_index+i, dm_time_start_index+i] == 0  # there cannot be overlapping events in the design matrix
-            design_matrix[dm_erpTime_start_index+i, dm_time_start_index+i] = 1
-    design_matrix_channel_names = flatten_list([['DM_E{0}_T{1}'.format(e_type, i) for i in range(num_samples_erp_window)] for e_type in event_type_of_interest])
+    design_matrix = build_design_matrix(data_array[event_marker_index], srate, erp_window, event_type_of_interest).T.toarray()
+    design_matrix_channel_names = design_matrix_column_names(srate, erp_window, event_type_of_interest)
     return np.concatenate([data_array, design_matrix], axis=0), design_matrix, design_matrix_channel_names
 
 
+def design_matrix_column_names(srate, erp_window, event_type_of_interest=(1, 2, 3), covariate_names=()):
+    num_samples_erp_window = int(round(srate * (erp_window[1] - erp_window[0])))
+    return flatten_list([['DM_E{0}_T{1}'.format(e_type, i) for i in range(num_samples_erp_window)] for e_type in event_type_of_interest] +
+                        [['DM_{0}_T{1}'.format(name, i) for i in range(num_samples_erp_window)] for name in covariate_names])
+
+
+def build_design_matrix(event_marker_array, srate, erp_window, event_type_of_interest=(1, 2, 3), covariates=None):
+    '''
+    build the time-expanded deconvolution design matrix as a sparse matrix of shape (samples, columns), in one
+    vectorized step
+    there is one block of erp window columns for each event type, column (event type index) * window + i is one at the
+    samples i samples after the events of that type. Overlapping events are summed, which is what the deconvolution
+    separates
+    :param event_marker_array: one event marker channel
+    :param covariates: optional dict of name -> array of the same length as event_marker_array, holding the value of a
+    continuous covariate (e.g., saccade amplitude) at the event samples. Each covariate adds a block of erp window
+    columns, after the event type blocks, carrying its value at all the events of interest
+    :return: scipy.sparse.csr_matrix
+    '''
+    covariates = covariates if covariates else {}
+    num_samples_erp_window = int(round(srate * (erp_window[1] - erp_window[0])))
+    lags = np.arange(num_samples_erp_window)
+    num_blocks = len(event_type_of_interest) + len(covariates)
+
+    is_event = np.isin(event_marker_array, event_type_of_interest)
+    event_indices = np.argwhere(is_event)[:, 0]
+    type_indices = np.searchsorted(np.sort(event_type_of_interest), event_marker_array[event_indices])
+    type_indices = np.argsort(event_type_of_interest)[type_indices]  # in the order of event_type_of_interest
+
+    block_indices = [type_indices] + [np.full(len(event_indices), len(event_type_of_interest) + i) for i in range(len(covariates))]
+    values = [np.ones(len(event_indices))] + [np.asarray(c, dtype=float)[event_indices] for c in covariates.values()]
+    rows = np.tile(event_indices[:, None] + int(round(srate * erp_window[0])) + lags[None, :], (1 + len(covariates), 1))
+    columns = np.concatenate(block_indices)[:, None] * num_samples_erp_window + lags[None, :]
+    values = np.broadcast_to(np.concatenate(values)[:, None], rows.shape)
+
+    in_range = np.logical_and(rows >= 0, rows < len(event_marker_array))
+    return scipy.sparse.coo_matrix((values[in_range], (rows[in_range], columns[in_range])),
+                                   shape=(len(event_marker_array), num_blocks * num_samples_erp_window)).tocsr()
+
+
+class EpochDesignMatrix:
+    """
+    the design matrix of a set of epochs, kept as the sparse continuous design matrix from build_design_matrix and the
+    sample indices of the epoch events, so the dense per-epoch slices are only created when they are read
+    """
+    def __init__(self, design_matrices, event_indices, tmin, num_times, srate, column_names=None):
+        """
+        :param design_matrices: list of sparse design matrices, event_indices index into the one of the same position
+        :param event_indices: list of arrays of event sample indices, one for each design matrix
+        """
+        self.design_matrices = design_matrices
+        self.event_indices = event_indices
+        self.tmin = tmin
+        self.num_times = num_times
+        self.srate = srate
+        self.column_names = column_names
+        self.start_offset = int(round(tmin * srate))
+
+    @classmethod
+    def from_epochs(cls, design_matrix, epochs, column_names=None):
+        """
+        :param epochs: mne.Epochs cut from a raw with first_samp of zero, the design matrix rows must be aligned with
+        that raw
+        """
+        return cls([design_matrix], [epochs.events[:, 0]], epochs.tmin, len(epochs.times), epochs.info['sfreq'],
+                   column_names=column_names)
+
+    @staticmethod
+    def concatenate(epoch_design_matrices):
+        first = epoch_design_matrices[0]
+        return EpochDesignMatrix(flatten_list([x.design_matrices for x in epoch_design_matrices]),
+                                 flatten_list([x.event_indices for x in epoch_design_matrices]),
+                                 first.tmin, first.num_times, first.srate, column_names=first.column_names)
+
+    def __len__(self):
+        return sum(len(x) for x in self.event_indices)
+
+    def get_data(self):
+        """
+        :return: dense design matrices of all the epochs, of shape (epochs, design matrix columns, time) like the
+        channels of mne.Epochs.get_data
+        """
+        out = []
+        for design_matrix, event_indices in zip(self.design_matrices, self.event_indices):
+            rows = (np.asarray(event_indices)[:, None] + self.start_offset + np.arange(self.num_times)[None, :]).ravel()
+            out.append(design_matrix[rows].toarray().reshape(len(event_indices), self.num_times, -1).transpose(0, 2, 1))
+        return np.concatenate(out)
+
+    def save(self, path):
+        """
+        export the per-epoch design matrices as .npy, in the layout Learning/deconv.py loads
+        """
+        np.save(path, self.get_data())
+
+
 def add_gaze_em_to_data(item_markers, item_markers_timestamps, event_markers, event_marker_timestamps,
                         data_array,  # this data array already has timestamps, this function is called after add_em_ts_to_data
                         session_log, item_codes, srate, verbose, pre_block_time=1, post_block_time=1, foveate_value_threshold=15, foveate_duration_threshold=FIXATION_MINIMAL_TIME):
@@ -326,26 +441,144 @@ def extract_block_data(_data, channel_names, srate, fixations, saccades, pre_blo
     # return block_sequences  # a list of block sequences
 
 
+def extract_event_epochs(data, event_channel, event_ids, tmin, tmax, srate, baseline=None):
+    """
+    NumPy epoching of continuous data, without creating mne objects
+    :param data: of shape (channels, samples), only the channels to epoch
+    :param event_channel: the stim channel the epochs are locked to, of shape (samples,)
+    :param event_ids: dict of event name -> event code, the other events are ignored
+    :param baseline: (start, end) in seconds, the mean of which is subtracted from each epoch and channel, as mne does
+    :return: epochs of shape (epochs, channels, time), their labels, and the sample index of their events; events whose
+    epoch falls outside the data are dropped
+    """
+    events = find_event_onsets(event_channel)
+    start_offset = int(round(tmin * srate))
+    num_times = int(round(tmax * srate)) - start_offset + 1
+    events = events[np.logical_and.reduce([np.isin(events[:, 2], list(event_ids.values())),
+                                           events[:, 0] + start_offset >= 0,
+                                           events[:, 0] + start_offset + num_times <= data.shape[-1]])]
+    epochs = gather_epochs(data, events[:, 0], start_offset, num_times).astype(float, copy=False)  # the gather already copies
+    if baseline is not None:
+        times = (np.arange(num_times) + start_offset) / srate
+        baseline_mask = np.logical_and(times >= baseline[0], times <= baseline[1])
+        epochs -= np.mean(epochs[:, :, baseline_mask], axis=-1, keepdims=True)
+    return epochs, events[:, 2], events[:, 0]
+
+
+class ArrayEpochs:
+    """
+    epochs held as a NumPy array with their labels, selected by event name like mne.Epochs (epochs['Target']), the mne
+    object is only created by to_mne when it is needed, e.g., for mne plotting
+    """
+    def __init__(self, data, labels, event_ids, ch_names, tmin, srate):
+        """
+        :param data: of shape (epochs, channels, time)
+        :param event_ids: dict of event name -> event code of the events that are in the epochs
+        """
+        self.data = data
+        self.labels = np.asarray(labels)
+        self.event_ids = event_ids
+        self.ch_names = ch_names
+        self.tmin = tmin
+        self.srate = srate
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, event_names):
+        event_names = [event_names] if type(event_names) is str else event_names
+        if not all(x in self.event_ids.keys() for x in event_names):
+            raise KeyError('Event {0} is not in these epochs'.format(event_names))
+        mask = np.isin(self.labels, [self.event_ids[x] for x in event_names])
+        return ArrayEpochs(self.data[mask], self.labels[mask], dict((x, self.event_ids[x]) for x in event_names),
+                           self.ch_names, self.tmin, self.srate)
+
+    def get_data(self):
+        return self.data
+
+    @staticmethod
+    def concatenate(array_epochs):
+        first = array_epochs[0]
+        event_ids = dict()
+        [event_ids.update(x.event_ids) for x in array_epochs]
+        return ArrayEpochs(np.concatenate([x.data for x in array_epochs]), np.concatenate([x.labels for x in array_epochs]),
+                           event_ids, first.ch_names, first.tmin, first.srate)
+
+    def to_mne(self, ch_types='misc'):
+        events = np.stack([np.arange(len(self.labels)), np.zeros(len(self.labels), dtype=int), self.labels], axis=1)
+        info = mne.create_info(self.ch_names, sfreq=self.srate, ch_types=ch_types)
+        return mne.EpochsArray(self.data, info, events=events, tmin=self.tmin, event_id=self.event_ids, verbose=False)
+
+
+class EpochAccumulator:
+    """
+    collects the per-session epoch chunks of a condition, e.g., (pupil, eeg, eeg ica epochs, labels, EpochDesignMatrix),
+    and concatenates each modality once, on its first read, instead of growing the accumulated epochs every session
+    reads like the tuple of modalities: accumulator[2], or pupil, eeg, eeg_ica, labels, dm = accumulator
+    """
+    def __init__(self, chunks=None):
+        self.chunks = chunks if chunks is not None else []
+        self._concatenated = dict()
+
+    def append(self, *modalities):
+        self.chunks.append(modalities)
+        self._concatenated = dict()
+
+    @staticmethod
+    def merge(accumulators):
+        """
+        :return: an accumulator of the chunks of all the accumulators, e.g., of all the participants of a condition, each
+        of its modalities is still concatenated only once
+        """
+        return EpochAccumulator(flatten_list([x.chunks for x in accumulators]))
+
+    def __len__(self):
+        return len(self.chunks[0]) if len(self.chunks) > 0 else 0
+
+    def __getitem__(self, modality_index):
+        if modality_index not in self._concatenated.keys():
+            self._concatenated[modality_index] = _concatenate_epoch_chunks([x[modality_index] for x in self.chunks])
+        return self._concatenated[modality_index]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __getstate__(self):  # only pickle the chunks, the concatenation is redone when read
+        return {'chunks': self.chunks}
+
+    def __setstate__(self, state):
+        self.chunks = state['chunks']
+        self._concatenated = dict()
+
+
+def _concatenate_epoch_chunks(chunks):
+    if len(chunks) == 1:
+        return chunks[0]
+    if isinstance(chunks[0], mne.BaseEpochs):
+        return mne.concatenate_epochs(chunks)
+    if isinstance(chunks[0], (ArrayEpochs, EpochDesignMatrix)):
+        return type(chunks[0]).concatenate(chunks)
+    return np.concatenate(chunks)
+
+
 def generate_pupil_event_epochs(data_, data_channels, data_channel_types, tmin, tmax, event_ids, locked_marker, erp_window=(.0, .8),srate=200,
-                                verbose='WARNING'):  # use a fixed sampling rate for the sampling rate to match between recordings
+                                verbose='WARNING', pupil_channels=('left_pupil_size', 'right_pupil_size'), is_return_mne=True):  # use a fixed sampling rate for the sampling rate to match between recordings
+    """
+    epoch the pupil channels of the eyetracking data with extract_event_epochs, only the pupil channels are read
+    :param is_return_mne: return mne.Epochs, otherwise ArrayEpochs which can be turned into mne.Epochs when needed
+    :return: the pupil epochs and their labels
+    """
     mne.set_log_level(verbose=verbose)
-
-    info = mne.create_info(
-        data_channels,
-        sfreq=srate,
-        ch_types=data_channel_types)  # with 3 additional info markers
-    raw = mne.io.RawArray(data_, info)
+    pupil_indices = [data_channels.index(x) for x in pupil_channels]
+    event_channel = data_[data_channels.index(locked_marker)]
 
     # only keep events that are in the block
-    event_ids = dict([(event_name, event_code) for event_name, event_code in event_ids.items() if event_code in np.unique(mne.find_events(raw, stim_channel=locked_marker)[:, 2])])
+    event_ids = dict([(event_name, event_code) for event_name, event_code in event_ids.items() if event_code in np.unique(event_channel)])
     # pupil epochs
-    epochs_pupil = Epochs(raw, events=find_events(raw, stim_channel=locked_marker), event_id=event_ids, tmin=tmin,
-                          tmax=tmax,
-                          baseline=(-0.5, 0.0),
-                          preload=True,
-                          verbose=False, picks=['left_pupil_size', 'right_pupil_size'])
-    labels_array = epochs_pupil.events[:, 2]
-    return epochs_pupil, labels_array
+    epochs_data, labels_array, _ = extract_event_epochs(data_[pupil_indices], event_channel, event_ids, tmin, tmax, srate,
+                                                        baseline=(-0.5, 0.0))
+    epochs_pupil = ArrayEpochs(epochs_data, labels_array, event_ids, list(pupil_channels), int(round(tmin * srate)) / srate, srate)
+    return (epochs_pupil.to_mne() if is_return_mne else epochs_pupil), labels_array
 
 
 def rescale_merge_exg(data_array_EEG, data_array_ECG):
@@ -355,62 +588,92 @@ def rescale_merge_exg(data_array_EEG, data_array_ECG):
     data_array = np.concatenate([data_array_EEG, data_array_ECG])
     return data_array
 
-def generate_eeg_event_epochs(data_, data_channels, data_channle_types, ica_path, tmin, tmax, event_ids, locked_marker, erp_window=(.0, .8), srate=2048, verbose='CRITICAL',
-                              is_regenerate_ica=False, lowcut=1, highcut=50., resample_srate=128, bad_channels=None):
-    mne.set_log_level(verbose=verbose)
-    biosemi_64_montage = mne.channels.make_standard_montage('biosemi64')
-    info = mne.create_info(
-        data_channels,
-        sfreq=srate,
-        ch_types=data_channle_types)  # with 3 additional info markers and design matrix
-    raw = mne.io.RawArray(data_, info)
-    raw.set_montage(biosemi_64_montage)
-    raw, _ = mne.set_eeg_reference(raw, 'average',
-                                   projection=False)
-    # import matplotlib as mpl
-    # import matplotlib.pyplot as plt
-    # mpl.use('Qt5Agg')
-    # raw.plot(scalings='auto')
-    if bad_channels:
-        raw.info['bads'] = bad_channels
-        raw.interpolate_bads(method={'eeg': 'MNE'}, verbose='INFO')
+def propose_ica_excludes(ica, raw, ecg_ch_name='ECG00', eog_proxy_ch_names=('Fp1', 'Fpz', 'Fp2')):
+    """
+    flag the ECG components by their correlation with the ECG channel, and the EOG-like components by their
+    correlation with the frontal channels, which stand in for the EOG channels the sessions don't have
+    :return: dict of ecg and eog, the flagged component indices, and ecg_scores and eog_scores, the absolute scores of
+    all the components, the max across the frontal channels for eog
+    """
+    ecg_indices, ecg_scores = ica.find_bads_ecg(raw, ch_name=ecg_ch_name, method='correlation', threshold='auto')
+    eog_proxy_ch_names = [x for x in eog_proxy_ch_names if x in raw.ch_names and x not in raw.info['bads']]
+    if len(eog_proxy_ch_names) > 0:
+        eog_indices, eog_scores = ica.find_bads_eog(raw, ch_name=eog_proxy_ch_names)
+        eog_scores = np.max(np.abs(np.atleast_2d(eog_scores)), axis=0)
+    else:
+        eog_indices, eog_scores = [], np.zeros(ica.n_components_)
+    return {'ecg': [int(x) for x in ecg_indices], 'eog': [int(x) for x in eog_indices],
+            'ecg_scores': np.abs(ecg_scores).tolist(), 'eog_scores': eog_scores.tolist()}
 
-    raw = raw.filter(l_freq=lowcut, h_freq=highcut)  # bandpass filter
-    raw = raw.notch_filter(freqs=np.arange(60, 241, 60), filter_length='auto')
-    raw = raw.resample(resample_srate)
 
-    # recreate raw with design matrix
-    data_array_with_dm, design_matrix, dm_ch_names = add_design_matrix_to_data(raw.get_data(), -4, resample_srate, erp_window=erp_window)
+def load_ica_flags(ica_path):
+    """
+    :return: the flags saved with the ICA solution by load_or_fit_ica, see propose_ica_excludes, with reviewed, whether
+    the exclude list has been reviewed. None if the solution was saved without flags
+    """
+    if not os.path.exists(ica_path + '-flags.json'):
+        return None
+    with open(ica_path + '-flags.json', 'r') as f:
+        return json.load(f)
 
-    info = mne.create_info(
-        data_channels + dm_ch_names,
-        sfreq=resample_srate,
-        ch_types=data_channle_types + len(dm_ch_names) * ['stim'])  # with 3 additional info markers and design matrix
-    raw = mne.io.RawArray(data_array_with_dm, info)
-    raw.set_montage(biosemi_64_montage)
 
+def save_ica_excludes(ica_path, ica_exclude, ica_flags=None):
+    """
+    save the exclude list of an ICA solution next to it, and its flags if given
+    """
+    with open(ica_path + '.txt', "w") as f:
+        f.writelines("%s\n" % ica_comp for ica_comp in ica_exclude)
+    if ica_flags is not None:
+        with open(ica_path + '-flags.json', 'w') as f:
+            json.dump(ica_flags, f)
+
+
+def fit_ica(raw, n_components=20, max_iter=800, random_state=97, highpass=1., decim=None, max_duration=None,
+            num_segments=10):
+    """
+    fit an ICA on a lean training copy of raw: its EEG channels only, high-passed at highpass Hz if raw is not already,
+    and if max_duration is given, num_segments evenly spaced segments of max_duration seconds in total. The fit uses
+    every decim-th sample of the copy. The solution applies to raw, or any data with its EEG channels, at the full rate
+    """
+    training_raw = raw.copy().pick_types(eeg=True)
+    if training_raw.info['highpass'] < highpass:
+        training_raw.filter(l_freq=highpass, h_freq=None)
+    if max_duration is not None and training_raw.times[-1] > max_duration:
+        segment_duration = max_duration / num_segments
+        training_raw = mne.concatenate_raws([training_raw.copy().crop(t, t + segment_duration, include_tmax=False)
+                                             for t in np.linspace(0, training_raw.times[-1] - segment_duration, num_segments)])
+    ica = mne.preprocessing.ICA(n_components=n_components, random_state=random_state, max_iter=max_iter)
+    ica.fit(training_raw, picks='eeg', decim=decim)
+    return ica
+
+
+def load_or_fit_ica(raw, ica_path, is_regenerate_ica=False, ecg_ch_name='ECG00', is_interactive=False,
+                    eog_proxy_ch_names=('Fp1', 'Fpz', 'Fp2'), **fit_kwargs):
+    """
+    load the ICA solution and exclude list for a session from ica_path, fit one on raw if it does not exist
+    the ECG and EOG-like components are flagged with propose_ica_excludes and excluded. If is_interactive, the sources
+    and components are plotted and the manual exclusions are asked for, otherwise the flagged exclusions are saved
+    unreviewed and can be reviewed later with review_ica.py
+    :param fit_kwargs: passed to fit_ica, e.g., decim and max_duration for a faster fit
+    """
     # check if ica for this participant and session exists, create one if not
     if is_regenerate_ica or (not os.path.exists(ica_path + '.txt') or not os.path.exists(ica_path + '-ica.fif')):
-        ica = mne.preprocessing.ICA(n_components=20, random_state=97, max_iter=800)
-        ica.fit(raw, picks='eeg')
-        ecg_indices, ecg_scores = ica.find_bads_ecg(raw, ch_name='ECG00', method='correlation',
-                                                    threshold='auto')
-        # ica.plot_scores(ecg_scores)
-        if len(ecg_indices) > 0:
-            [print(
-                'Found ECG component at ICA index {0} with score {1}, adding to ICA exclude'.format(x, ecg_scores[x]))
-             for x in ecg_indices]
-            ica.exclude += ecg_indices
-        else:
-            print('No channel found to be significantly correlated with ECG, skipping auto ECG artifact removal')
-        ica.plot_sources(raw)
-        ica.plot_components()
-        ica_excludes = input("Enter manual ICA components to exclude (use space to deliminate): ")
-        if len(ica_excludes) > 0: ica.exclude += [int(x) for x in ica_excludes.split(' ')]
-        f = open(ica_path + '.txt', "w")
-        f.writelines("%s\n" % ica_comp for ica_comp in ica.exclude)
-        f.close()
+        ica = fit_ica(raw, **fit_kwargs)
+        ica_flags = propose_ica_excludes(ica, raw, ecg_ch_name=ecg_ch_name, eog_proxy_ch_names=eog_proxy_ch_names)
+        for artifact in ['ecg', 'eog']:
+            if len(ica_flags[artifact]) > 0:
+                [print('Found {0} component at ICA index {1} with score {2}, adding to ICA exclude'.format(
+                    artifact.upper(), x, ica_flags[artifact + '_scores'][x])) for x in ica_flags[artifact]]
+            else:
+                print('No component found to be significantly correlated with {0}, skipping auto {0} artifact removal'.format(artifact.upper()))
+        ica.exclude += sorted(set(ica_flags['ecg'] + ica_flags['eog']))
+        if is_interactive:
+            ica.plot_sources(raw)
+            ica.plot_components()
+            ica_excludes = input("Enter manual ICA components to exclude (use space to deliminate): ")
+            if len(ica_excludes) > 0: ica.exclude += [int(x) for x in ica_excludes.split(' ')]
         ica.save(ica_path + '-ica.fif', overwrite=True)
+        save_ica_excludes(ica_path, ica.exclude, dict(ica_flags, reviewed=is_interactive))
 
         print('Saving ICA components', end='')
     else:
@@ -421,65 +684,362 @@ def generate_eeg_event_epochs(data_, data_channels, data_channle_types, ica_path
         print('Found and loaded existing ICA file', end='')
 
     print(': ICA exlucde component {0}'.format(str(ica.exclude)))
+    return ica
+
+
+def resample_timestamps(timestamps, srate, resample_srate, num_resampled):
+    """
+    @return: the timestamps of the resampled samples, interpolated from the original timestamps
+    """
+    return np.interp(np.arange(num_resampled) * srate / resample_srate, np.arange(len(timestamps)), timestamps)
+
+
+def decimation_stages(srate, resample_srate, max_stage_factor=8):
+    """
+    split an integer decimation ratio into the fewest stages of at most max_stage_factor, as balanced as possible,
+    e.g., 2048 -> 128 is [4, 4]. Decimating in stages keeps each anti-aliasing filter short
+    """
+    if srate % resample_srate != 0:
+        raise ValueError("Decimation requires srate {0} to be an integer multiple of resample_srate {1}".format(srate, resample_srate))
+
+    def _split(ratio):
+        if ratio == 1:
+            return []
+        candidates = [[f] + _split(ratio // f) for f in range(min(ratio, max_stage_factor), 1, -1) if ratio % f == 0]
+        candidates = [c for c in candidates if np.prod(c) == ratio]
+        return min(candidates, key=lambda c: (len(c), max(c))) if candidates else []
+
+    ratio = int(srate // resample_srate)
+    factors = _split(ratio)
+    if np.prod(factors) != ratio:
+        raise ValueError("Decimation ratio {0} has a prime factor larger than {1}".format(ratio, max_stage_factor))
+    return sorted(factors, reverse=True)
+
+
+def decimate_exg(exg_data, exg_timestamps, srate, resample_srate):
+    """
+    anti-aliased polyphase decimation of the exg in integer-ratio stages
+    decimated sample k is aligned with original sample k * srate / resample_srate, so the returned timestamps are
+    exactly the original timestamps of those samples and event sample positions map exactly
+    """
+    data = exg_data
+    for factor in decimation_stages(srate, resample_srate):
+        data = scipy.signal.resample_poly(data, 1, factor, axis=1)
+    ratio = int(srate // resample_srate)
+    return data, exg_timestamps[::ratio][:data.shape[1]]
+
+
+def filter_resample_exg(exg_data, exg_timestamps, data_channels, data_channel_types, srate=2048, lowcut=1, highcut=50.,
+                        resample_srate=128, bad_channels=None, notch_freqs=np.arange(60, 241, 60),
+                        preprocess_mode='standard'):
+    """
+    the filtering part of preprocess_session_exg, without ICA
+    :param preprocess_mode: 'standard': band-pass and notch filter at the recording rate, then resample
+    'decimate_first': decimate to resample_srate first, then reference, interpolate bads, band-pass and notch at the low
+    rate, only the notch frequencies below the new Nyquist are applied. Referencing and bad channel interpolation are
+    spatial and commute with the decimation
+    :return: the preprocessed raw and its timestamps
+    """
+    biosemi_64_montage = mne.channels.make_standard_montage('biosemi64')
+    if preprocess_mode == 'decimate_first':
+        exg_data, resampled_timestamps = decimate_exg(exg_data, exg_timestamps, srate, resample_srate)
+        notch_freqs = [f for f in notch_freqs if f < resample_srate / 2]
+        info = mne.create_info(data_channels, sfreq=resample_srate, ch_types=data_channel_types)
+    elif preprocess_mode == 'standard':
+        info = mne.create_info(data_channels, sfreq=srate, ch_types=data_channel_types)
+    else:
+        raise ValueError("Unknown preprocess_mode {0}, must be 'standard' or 'decimate_first'".format(preprocess_mode))
+    raw = mne.io.RawArray(exg_data, info)
+    raw.set_montage(biosemi_64_montage)
+    raw, _ = mne.set_eeg_reference(raw, 'average',
+                                   projection=False)
+    if bad_channels:
+        raw.info['bads'] = bad_channels
+        raw.interpolate_bads(method={'eeg': 'MNE'}, verbose='INFO')
+
+    raw = raw.filter(l_freq=lowcut, h_freq=highcut)  # bandpass filter
+    if len(notch_freqs) > 0:
+        raw = raw.notch_filter(freqs=notch_freqs, filter_length='auto')
+    if preprocess_mode == 'standard':
+        raw = raw.resample(resample_srate)
+        resampled_timestamps = resample_timestamps(exg_timestamps, srate, resample_srate, raw.n_times)
+    return raw, resampled_timestamps
+
+
+def compare_preprocessing_modes(exg_data, exg_timestamps, data_channels, data_channel_types, event_timestamps,
+                                tmin=-0.1, tmax=0.8, srate=2048, resample_srate=128, modes=('standard', 'decimate_first'),
+                                **kwargs):
+    """
+    validate the preprocessing modes of filter_resample_exg against the first one: epoch the same events from each
+    mode's output, average them into ERPs and compare the ERPs per channel, also times each mode
+    :param event_timestamps: timestamps of the events to epoch, in the same clock as exg_timestamps
+    :param kwargs: passed to filter_resample_exg, e.g., lowcut, highcut, bad_channels
+    :return: dict of mode -> {'seconds', 'erp' (channels x time)}, and for the modes other than the reference also
+    'correlation' and 'relative_rmse' per channel
+    """
+    report = {}
+    num_samples = int(round((tmax - tmin) * resample_srate))
+    for mode in modes:
+        start_time = time.time()
+        raw, resampled_timestamps = filter_resample_exg(exg_data, exg_timestamps, data_channels, data_channel_types,
+                                                        srate=srate, resample_srate=resample_srate, preprocess_mode=mode,
+                                                        **kwargs)
+        seconds = time.time() - start_time
+        data = raw.get_data()
+        onsets = np.searchsorted(resampled_timestamps, event_timestamps) + int(round(tmin * resample_srate))
+        onsets = onsets[np.logical_and(onsets >= 0, onsets + num_samples <= data.shape[1])]
+        epochs = data[:, onsets[:, None] + np.arange(num_samples)]  # channels x epochs x time
+        report[mode] = {'seconds': seconds, 'erp': np.mean(epochs, axis=1), 'num_epochs': len(onsets)}
+
+    reference = report[modes[0]]['erp']
+    for mode in modes[1:]:
+        erp = report[mode]['erp']
+        erp_centered, reference_centered = erp - erp.mean(axis=1, keepdims=True), reference - reference.mean(axis=1, keepdims=True)
+        report[mode]['correlation'] = np.sum(erp_centered * reference_centered, axis=1) / np.sqrt(
+            np.sum(erp_centered ** 2, axis=1) * np.sum(reference_centered ** 2, axis=1))
+        report[mode]['relative_rmse'] = np.sqrt(np.mean((erp - reference) ** 2, axis=1)) / np.sqrt(np.mean(reference ** 2, axis=1))
+
+    print('Preprocessing mode comparison, reference mode is {0}'.format(modes[0]))
+    for mode in modes:
+        line = '{0}: {1:.2f} seconds, {2} epochs'.format(mode, report[mode]['seconds'], report[mode]['num_epochs'])
+        if mode != modes[0]:
+            line += ', {0:.2f}x faster, ERP correlation min {1:.4f} median {2:.4f}, relative RMSE max {3:.4f} median {4:.4f}'.format(
+                report[modes[0]]['seconds'] / report[mode]['seconds'],
+                np.min(report[mode]['correlation']), np.median(report[mode]['correlation']),
+                np.max(report[mode]['relative_rmse']), np.median(report[mode]['relative_rmse']))
+        print(line)
+    return report
+
+
+def preprocess_session_exg(exg_data, exg_timestamps, data_channels, data_channel_types, ica_path, srate=2048,
+                           verbose='CRITICAL', is_regenerate_ica=False, lowcut=1, highcut=50., resample_srate=128,
+                           bad_channels=None, notch_freqs=np.arange(60, 241, 60), preprocess_mode='standard',
+                           is_apply_ica=True):
+    """
+    preprocess the continuous exg of a whole session once: average reference, bad channel interpolation, band-pass,
+    notch, resampling and ICA. The returned data is shared by all the conditions of the session, see
+    generate_condition_eeg_event_epochs
+    :param exg_data: exg only, without timestamps or event marker channels
+    :param preprocess_mode: 'standard' or 'decimate_first', see filter_resample_exg
+    :param is_apply_ica: if False, the continuous data is not ICA reconstructed and the fitted ICA is returned in its
+    place, to be applied to the epochs by generate_condition_eeg_event_epochs
+    :return: raw, ICA reconstructed raw (or the ICA), and the timestamps of the resampled data
+    """
+    mne.set_log_level(verbose=verbose)
+    raw, resampled_timestamps = filter_resample_exg(exg_data, exg_timestamps, data_channels, data_channel_types,
+                                                    srate=srate, lowcut=lowcut, highcut=highcut,
+                                                    resample_srate=resample_srate, bad_channels=bad_channels,
+                                                    notch_freqs=notch_freqs, preprocess_mode=preprocess_mode)
+
+    ica = load_or_fit_ica(raw, ica_path, is_regenerate_ica=is_regenerate_ica)
+    if not is_apply_ica:
+        return raw, ica, resampled_timestamps
     raw_ica_recon = raw.copy()
     ica.apply(raw_ica_recon)
-    # raw.plot(scalings='auto')
-    # reconst_raw.plot(show_scrollbars=False, scalings='auto')
+    return raw, raw_ica_recon, resampled_timestamps
+
+
+def resample_event_array(event_array, event_timestamps, data_timestamps):
+    """
+    move the events in event_array, sampled at event_timestamps, to the nearest sample of data_timestamps
+    :param event_array: channel first, time last, may have multiple event channels
+    """
+    out = np.zeros((event_array.shape[0], len(data_timestamps)))
+    channel_indices, event_indices = np.nonzero(event_array)
+    data_indices = np.clip(np.searchsorted(data_timestamps, event_timestamps[event_indices]), 1, len(data_timestamps) - 1)
+    data_indices -= (event_timestamps[event_indices] - data_timestamps[data_indices - 1]) < (data_timestamps[data_indices] - event_timestamps[event_indices])
+    out[channel_indices, data_indices] = event_array[channel_indices, event_indices]
+    return out
+
+
+def condition_view(data_timestamps, marker_array):
+    """
+    :return: the start and end index of a condition in the session data, and the condition's events moved to the session
+    data's samples, see generate_condition_eeg_event_epochs for the arguments
+    """
+    condition_start = np.searchsorted(data_timestamps, marker_array[0, 0])
+    condition_end = np.searchsorted(data_timestamps, marker_array[0, -1], side='right')
+    condition_events = resample_event_array(marker_array[1:], marker_array[0], data_timestamps[condition_start:condition_end])
+    return condition_start, condition_end, condition_events
+
+
+def compact_marker_array(marker_array):
+    """
+    drop the samples of a marker array (e.g., from add_em_ts_to_data and add_gaze_em_to_data) that have no event,
+    keeping the first and the last sample so condition_view and expand_marker_array give the same result on the compact
+    array as on the full one
+    """
+    keep = np.any(marker_array[1:] != 0, axis=0)
+    keep[[0, -1]] = True
+    return marker_array[:, keep]
+
+
+def expand_marker_array(marker_array, data_timestamps):
+    """
+    inverse of compact_marker_array
+    :param data_timestamps: the timestamps the full marker array was sampled at
+    :return: the start and end index of the marker array in data_timestamps, and the full marker array
+    """
+    start = np.searchsorted(data_timestamps, marker_array[0, 0])
+    end = np.searchsorted(data_timestamps, marker_array[0, -1], side='right')
+    events = resample_event_array(marker_array[1:], marker_array[0], data_timestamps[start:end])
+    return start, end, np.concatenate([data_timestamps[None, start:end], events])
+
+
+def deconvolve_condition_eeg(raw, data_timestamps, marker_array, marker_channels, event_ids, locked_marker,
+                             erp_window=(-0.2, 0.8), lamb=1., method='cholesky', covariates=None):
+    """
+    regression-based ERPs (rERPs) of a condition, deconvolved on the condition's continuous data instead of epochs, so
+    the overlapping responses of adjacent events (e.g., consecutive fixations) are separated
+    :param raw: session-level preprocessed raw, e.g., the ICA cleaned raw from preprocess_session_exg
+    :param covariates: optional dict of name -> array aligned with the condition's samples, see build_design_matrix
+    :return: dict of event name -> rERP of shape (EEG channels, erp window)
+    """
+    condition_start, condition_end, condition_events = condition_view(data_timestamps, marker_array)
+    srate = int(raw.info['sfreq'])
+    event_ids = dict([(event_name, event_code) for event_name, event_code in event_ids.items()
+                      if event_code in np.unique(condition_events[marker_channels.index(locked_marker)])])
+    design_matrix = build_design_matrix(condition_events[marker_channels.index(locked_marker)], srate, erp_window,
+                                        event_type_of_interest=tuple(event_ids.values()), covariates=covariates)
+    data = raw.get_data(picks='eeg', start=condition_start, stop=condition_end)
+    betas = deconvolve_continuous(data, design_matrix, lamb=lamb, method=method)
+    return split_rerps(betas, list(event_ids.keys()) + list(covariates.keys() if covariates else []),
+                       int(round(srate * (erp_window[1] - erp_window[0]))))
+
+
+def find_event_onsets(event_channel):
+    """
+    the events of one stim channel as mne.find_events(shortest_event=1) finds them with its default
+    consecutive='increasing' and initial_event=False: the samples where the channel steps up to a larger value, the
+    value of the channel is cast to int and its absolute value is taken, a nonzero value at the first sample is not an
+    event
+    :return: array of shape (events, 3) of sample index, previous value and event code
+    """
+    event_channel = np.abs(np.asarray(event_channel).astype(np.int64))
+    onsets = np.argwhere(event_channel[1:] > event_channel[:-1])[:, 0] + 1
+    return np.stack([onsets, event_channel[onsets - 1], event_channel[onsets]], axis=1).astype(int)
+
+
+def gather_epochs(data, event_indices, start_offset, num_times):
+    """
+    cut the epochs out of continuous data with one gather from a zero-copy strided view of all the windows
+    :param data: of shape (channels, samples)
+    :param event_indices: sample index of each event, the windows must be within the data
+    :return: epochs of shape (epochs, channels, time)
+    """
+    windows = np.lib.stride_tricks.sliding_window_view(data, num_times, axis=-1)
+    return np.moveaxis(windows, 1, 0)[np.asarray(event_indices) + start_offset]
+
+
+def generate_condition_eeg_event_epochs(raw, raw_ica_recon, data_timestamps, marker_array, marker_channels, tmin, tmax,
+                                        event_ids, locked_marker, erp_window=(.0, .8), event_marker_channel='EventMarker',
+                                        ica=None):
+    """
+    epoch one condition out of the session-level preprocessed exg from preprocess_session_exg
+    the events are found once and both the epochs and the ICA cleaned epochs are gathered from the same event indices,
+    events whose epoch falls outside the condition are dropped, as mne.Epochs does
+    :param raw_ica_recon: the ICA reconstructed raw, if None, ica is applied to the epochs instead so the continuous data
+    is never reconstructed
+    :param data_timestamps: timestamps of the preprocessed data
+    :param marker_array: first row is the timestamps, the rest are the event channels of this condition (e.g., from
+    add_em_ts_to_data and add_gaze_em_to_data), may be sampled at a different rate from the preprocessed data
+    :param marker_channels: names of the event channels in marker_array, excluding the timestamps
+    :param ica: the fitted ICA with its exclude list, required if raw_ica_recon is None
+    :return: epochs, ICA cleaned epochs, their labels and the EpochDesignMatrix of the ICA cleaned epochs
+    """
+    # the condition's view of the session data
+    condition_start, condition_end, condition_events = condition_view(data_timestamps, marker_array)
+    srate = raw.info['sfreq']
+    design_matrix = build_design_matrix(condition_events[marker_channels.index(event_marker_channel)], int(srate), erp_window)
 
-    reject = dict(eeg=600.)  # DO NOT reject or we will have a mismatch between EEG and pupil
     # only keep events that are in the block
-    event_ids = dict([(event_name, event_code) for event_name, event_code in event_ids.items() if event_code in np.unique(mne.find_events(raw, stim_channel=locked_marker, shortest_event=1)[:, 2])])  # we may not have all target, distractor and novelty, especially in free-viewing
-    epochs = Epochs(raw, events=find_events(raw, stim_channel=locked_marker, shortest_event=1), event_id=event_ids, tmin=tmin,
-                    tmax=tmax,
-                    baseline=(-0.1, 0.0),
-                    preload=True,
-                    verbose=False,
-                    reject=reject)
-
-    epochs_ICA_cleaned = Epochs(raw_ica_recon, events=find_events(raw, stim_channel=locked_marker, shortest_event=1), event_id=event_ids,
-                                tmin=tmin,
-                                tmax=tmax,
-                                baseline=(-0.1, 0.0),
-                                preload=True,
-                                verbose=False,
-                                reject=reject)
+    events = find_event_onsets(condition_events[marker_channels.index(locked_marker)])
+    event_ids = dict([(event_name, event_code) for event_name, event_code in event_ids.items() if event_code in np.unique(events[:, 2])])  # we may not have all target, distractor and novelty, especially in free-viewing
+    start_offset = int(round(tmin * srate))
+    num_times = int(round(tmax * srate)) - start_offset + 1
+    events = events[np.logical_and.reduce([np.isin(events[:, 2], list(event_ids.values())),
+                                           events[:, 0] + start_offset >= 0,
+                                           events[:, 0] + start_offset + num_times <= condition_end - condition_start])]
+    event_ids = dict([(event_name, event_code) for event_name, event_code in event_ids.items() if event_code in events[:, 2]])  # some may only have had events at the edges
+    marker_epochs = gather_epochs(condition_events, events[:, 0], start_offset, num_times)
+
+    def _epochs_array(r):
+        data = gather_epochs(r.get_data(start=condition_start, stop=condition_end), events[:, 0], start_offset, num_times)
+        info = mne.create_info(r.ch_names + marker_channels, sfreq=srate,
+                               ch_types=r.get_channel_types() + len(marker_channels) * ['stim'])
+        _epochs = mne.EpochsArray(np.concatenate([data, marker_epochs], axis=1), info, events=events,
+                                  tmin=start_offset / srate, event_id=event_ids, baseline=(-0.1, 0.0), verbose=False)
+        _epochs.set_montage(r.get_montage())
+        return _epochs
+
+    epochs = _epochs_array(raw)
+    if raw_ica_recon is not None:
+        epochs_ICA_cleaned = _epochs_array(raw_ica_recon)
+    else:
+        epochs_ICA_cleaned = ica.apply(epochs.copy())
 
     labels_array = epochs.events[:, 2]
+    epochs_design_matrix = EpochDesignMatrix.from_epochs(design_matrix, epochs_ICA_cleaned,
+                                                         column_names=design_matrix_column_names(int(srate), erp_window))
+    return epochs, epochs_ICA_cleaned, labels_array, epochs_design_matrix
+
+
+def generate_eeg_event_epochs(data_, data_channels, data_channle_types, ica_path, tmin, tmax, event_ids, locked_marker, erp_window=(.0, .8), srate=2048, verbose='CRITICAL',
+                              is_regenerate_ica=False, lowcut=1, highcut=50., resample_srate=128, bad_channels=None):
+    """
+    preprocess and epoch a single condition, the first row of data_ must be the timestamps, the stim channels hold the
+    events. To share the preprocessing across conditions, use preprocess_session_exg and
+    generate_condition_eeg_event_epochs instead
+    """
+    exg_picks = [i for i, t in enumerate(data_channle_types) if t in ('eeg', 'ecg')]
+    stim_picks = [i for i, t in enumerate(data_channle_types) if t == 'stim']
+    raw, raw_ica_recon, resampled_timestamps = preprocess_session_exg(
+        data_[exg_picks], data_[0], [data_channels[i] for i in exg_picks], [data_channle_types[i] for i in exg_picks],
+        ica_path, srate=srate, verbose=verbose, is_regenerate_ica=is_regenerate_ica, lowcut=lowcut, highcut=highcut,
+        resample_srate=resample_srate, bad_channels=bad_channels)
+    epochs, epochs_ICA_cleaned, labels_array, _ = generate_condition_eeg_event_epochs(
+        raw, raw_ica_recon, resampled_timestamps, data_[[0] + stim_picks], [data_channels[i] for i in stim_picks],
+        tmin, tmax, event_ids, locked_marker, erp_window=erp_window)
     return epochs, epochs_ICA_cleaned, labels_array, raw, raw_ica_recon
 
 
-def visualize_pupil_epochs(epochs, event_groups, tmin, tmax, color_dict, title, srate=200, verbose='INFO', fig_size=(25.6, 14.4), gaze_behavior=None):
-    plt.rcParams["figure.figsize"] = fig_size
-    mne.set_log_level(verbose=verbose)
-    # epochs = epochs.apply_baseline((0.0, 0.0))
-    for event_name, events in event_groups.items():
-        try:
-            y = epochs[events].get_data()
-        except KeyError:  # meaning this event does not exist in these epochs
-            continue
-        y = interpolate_epoch_zeros(y)  # remove nan
-        y = interpolate_epochs_nan(y)  # remove nan
-        assert np.sum(np.isnan(y)) == 0
-        if len(y) == 0:
-            print("visualize_pupil_epochs: all epochs bad, skipping {0}".format(events))
-            continue
-        y = np.mean(y, axis=1)  # average left and right
-        y = scipy.stats.zscore(y, axis=1, ddof=0, nan_policy='propagate')
+def prepare_pupil_epochs_for_viz(y):
+    """
+    the per epoch steps of visualize_pupil_epochs: average left and right, falling back to the valid eye, interpolate
+    zeros and nan, z-score each epoch
+    :param y: pupil epochs of shape (epochs, left and right, time)
+    :return: of shape (epochs, time)
+    """
+    y = average_binocular_pupil(y, axis=1, is_zero_nan=True)
+    y, _ = interpolate_epochs(y[:, None, :])  # remove nan
+    assert np.sum(np.isnan(y)) == 0
+    y = y[:, 0]
+    if len(y) == 0:
+        return np.empty((0, y.shape[-1]))
+    return scipy.stats.zscore(y, axis=1, ddof=0, nan_policy='propagate')
 
-        y_mean = np.mean(y, axis=0)
-        y_mean = y_mean - y_mean[int(abs(tmin) * srate)]  # baseline correct
-        y1 = y_mean + scipy.stats.sem(y, axis=0)  # this is the upper envelope
-        y2 = y_mean - scipy.stats.sem(y, axis=0)  # this is the lower envelope
 
-        time_vector = np.linspace(tmin, tmax, y.shape[-1])
+def _plot_event_averages(event_averages, event_groups, tmin, tmax, color_dict, ylabel, title, gaze_behavior=None, out_path=None):
+    """
+    the drawing shared by the epoch and the grand average visualizations: the mean of each event group with its SEM as
+    a shade, and the histogram of the saccade durations
+    :param event_averages: dict of event group name -> (mean, SEM, number of epochs), the mean and SEM of shape (time,)
+    :param out_path: if given the figure is saved there instead of shown
+    """
+    for event_name, (y_mean, y_sem, count) in event_averages.items():
+        events = event_groups[event_name]
+        y1 = y_mean + y_sem  # this is the upper envelope
+        y2 = y_mean - y_sem  # this is the lower envelope
+
+        time_vector = np.linspace(tmin, tmax, len(y_mean))
         color = color_dict[events[0]] if type(events) is list else color_dict[events]
         plt.fill_between(time_vector, y1, y2, where=y2 <= y1, facecolor=color,
                          interpolate=True,
                          alpha=0.5)
         plt.plot(time_vector, y_mean, c=color,
-                 label='{0}, N={1}'.format(event_name, y.shape[0]))
+                 label='{0}, N={1}'.format(event_name, count))
     plt.xlabel('Time (sec)')
-    plt.ylabel('Pupil Diameter (averaged left and right z-score), shades are SEM')
+    plt.ylabel(ylabel)
     plt.legend()
 
     # plot gaze behavior if any
@@ -493,7 +1053,33 @@ def visualize_pupil_epochs(epochs, event_groups, tmin, tmax, color_dict, title,
 
     plt.legend()
     plt.title(title)
-    plt.show()
+    if out_path:
+        plt.savefig(out_path)
+        plt.clf()
+    else:
+        plt.show()
+
+
+def visualize_pupil_epochs(epochs, event_groups, tmin, tmax, color_dict, title, srate=200, verbose='INFO', fig_size=(25.6, 14.4), gaze_behavior=None):
+    plt.rcParams["figure.figsize"] = fig_size
+    mne.set_log_level(verbose=verbose)
+    # epochs = epochs.apply_baseline((0.0, 0.0))
+    event_averages = dict()
+    for event_name, events in event_groups.items():
+        try:
+            y = epochs[events].get_data()
+        except KeyError:  # meaning this event does not exist in these epochs
+            continue
+        y = prepare_pupil_epochs_for_viz(y)
+        if len(y) == 0:
+            print("visualize_pupil_epochs: all epochs bad, skipping {0}".format(events))
+            continue
+
+        y_mean = np.mean(y, axis=0)
+        y_mean = y_mean - y_mean[int(abs(tmin) * srate)]  # baseline correct
+        event_averages[event_name] = y_mean, scipy.stats.sem(y, axis=0), y.shape[0]
+    _plot_event_averages(event_averages, event_groups, tmin, tmax, color_dict,
+                         'Pupil Diameter (averaged left and right z-score), shades are SEM', title, gaze_behavior=gaze_behavior)
 
 
 def visualize_eeg_epochs(epochs, event_groups, tmin, tmax, color_dict, picks, title, out_dir=None, verbose='INFO', fig_size=(12.8, 7.2), is_plot_timeseries=True, is_plot_topo_map=True, gaze_behavior=None):
@@ -502,42 +1088,17 @@ def visualize_eeg_epochs(epochs, event_groups, tmin, tmax, color_dict, picks, ti
 
     if is_plot_timeseries:
         for ch in picks:
+            event_averages = dict()
             for event_name, events in event_groups.items():
                 try:
                     y = epochs.crop(tmin, tmax)[events].pick_channels([ch]).get_data().squeeze(1)
                 except KeyError:  # meaning this event does not exist in these epochs
                     continue
-                y_mean = np.mean(y, axis=0)
-                y1 = y_mean + scipy.stats.sem(y, axis=0)  # this is the upper envelope
-                y2 = y_mean - scipy.stats.sem(y, axis=0)
-
-                time_vector = np.linspace(tmin, tmax, y.shape[-1])
-                color = color_dict[events[0]] if type(events) is list else color_dict[events]
-                plt.fill_between(time_vector, y1, y2, where=y2 <= y1, facecolor=color,
-                                 interpolate=True,
-                                 alpha=0.5)
-                plt.plot(time_vector, y_mean, c=color,
-                         label='{0}, N={1}'.format(event_name, y.shape[0]))
-            plt.xlabel('Time (sec)')
-            plt.ylabel('BioSemi Channel {0} (μV), shades are SEM'.format(ch))
-            plt.legend()
-
-            # plot gaze behavior if any
-            if gaze_behavior:
-                if type(gaze_behavior[0]) is Saccade:
-                    durations = [x.duration for x in gaze_behavior if x.epoched]
-                    plt.twinx()
-                    n, bins, patches = plt.hist(durations, bins=10)
-                    plt.ylim(top=max(n) / 0.2)
-                    plt.ylabel('Saccade duration histogram')
-
-            plt.legend()
-            plt.title('{0} - Channel {1}'.format(title, ch))
-            if out_dir:
-                plt.savefig(os.path.join(out_dir, '{0} - Channel {1}.png'.format(title, ch)))
-                plt.clf()
-            else:
-                plt.show()
+                event_averages[event_name] = np.mean(y, axis=0), scipy.stats.sem(y, axis=0), y.shape[0]
+            _plot_event_averages(event_averages, event_groups, tmin, tmax, color_dict,
+                                 'BioSemi Channel {0} (μV), shades are SEM'.format(ch), '{0} - Channel {1}'.format(title, ch),
+                                 gaze_behavior=gaze_behavior,
+                                 out_path=os.path.join(out_dir, '{0} - Channel {1}.png'.format(title, ch)) if out_dir else None)
 
     # get the min and max for plotting the topomap
     if is_plot_topo_map:
@@ -551,6 +1112,143 @@ def visualize_eeg_epochs(epochs, event_groups, tmin, tmax, color_dict, picks, ti
             except KeyError:  # meaning this event does not exist in these epochs
                 continue
 
+class RunningEpochStats:
+    """
+    running count, mean and sum of squared deviations (M2) of epochs, updated a batch at a time with Welford's algorithm
+    (Chan et al.'s pairwise merge), so the mean and SEM never need all the epochs in memory
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, epochs):
+        """
+        :param epochs: of shape (epochs, ...), e.g., (epochs, channels, time)
+        """
+        epochs = np.asarray(epochs, dtype=np.float64)
+        if len(epochs) == 0:
+            return self
+        batch_mean = np.mean(epochs, axis=0)
+        self._merge(len(epochs), batch_mean, np.sum((epochs - batch_mean) ** 2, axis=0))
+        return self
+
+    def merge(self, other):
+        if other.count > 0:
+            self._merge(other.count, other.mean, other.m2)
+        return self
+
+    def _merge(self, count, mean, m2):
+        if self.count == 0:
+            self.count, self.mean, self.m2 = count, mean, m2
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / total
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * count / total
+        self.count = total
+
+    @property
+    def sem(self):
+        """
+        standard error of the mean with ddof=1, like scipy.stats.sem, nan with fewer than two epochs
+        """
+        if self.count < 2:
+            return np.full(np.shape(self.mean), np.nan)
+        return np.sqrt(self.m2 / (self.count - 1) / self.count)
+
+
+class GrandAverageAccumulator:
+    """
+    per condition and per event group RunningEpochStats, fed session by session, for grand average plots that do not
+    concatenate the epochs of all the participants, see visualize_eeg_grand_average and visualize_pupil_grand_average
+    """
+    def __init__(self, event_groups, transform=None, ch_type=None):
+        """
+        :param event_groups: dict of event group name -> event name or list of event names, like the event_groups of
+        visualize_eeg_epochs
+        :param transform: applied to each session's epoch data of an event group before it is accumulated, e.g.,
+        prepare_pupil_epochs_for_viz
+        :param ch_type: only accumulate the channels of this type, e.g., 'eeg', mne.Epochs only
+        """
+        self.event_groups = event_groups
+        self.transform = transform
+        self.ch_type = ch_type
+        self.stats = dict()  # condition name -> event group name -> RunningEpochStats
+        self.epochs_meta = dict()  # condition name -> (info, tmin, srate) of the epochs
+
+    def update(self, condition_name, epochs):
+        """
+        :param epochs: mne.Epochs or ArrayEpochs of one session
+        """
+        info = getattr(epochs, 'info', None)
+        picks = mne.pick_types(info, **{self.ch_type: True}) if self.ch_type is not None else None
+        for event_name, events in self.event_groups.items():
+            try:
+                y = epochs[events].get_data()
+            except KeyError:  # meaning this event does not exist in these epochs
+                continue
+            y = y[:, picks] if picks is not None else y
+            y = self.transform(y) if self.transform is not None else y
+            self.stats.setdefault(condition_name, dict()).setdefault(event_name, RunningEpochStats()).update(y)
+        if condition_name not in self.epochs_meta.keys():
+            srate = info['sfreq'] if info is not None else epochs.srate
+            self.epochs_meta[condition_name] = (mne.pick_info(info, picks) if picks is not None else info, epochs.tmin, srate)
+
+    def time_indices(self, condition_name, tmin, tmax):
+        """
+        :return: the index slice of the epochs between tmin and tmax, and the index of time zero
+        """
+        _, epochs_tmin, srate = self.epochs_meta[condition_name]
+        return slice(int(round((tmin - epochs_tmin) * srate)), int(round((tmax - epochs_tmin) * srate)) + 1), \
+               int(round(-epochs_tmin * srate))
+
+
+def visualize_pupil_grand_average(grand_average, condition_name, tmin, tmax, color_dict, title, fig_size=(25.6, 14.4), gaze_behavior=None):
+    """
+    visualize_pupil_epochs from a GrandAverageAccumulator fed with transform=prepare_pupil_epochs_for_viz
+    """
+    plt.rcParams["figure.figsize"] = fig_size
+    time_slice, zero_index = grand_average.time_indices(condition_name, tmin, tmax)
+    event_averages = dict()
+    for event_name, stats in grand_average.stats.get(condition_name, dict()).items():
+        y_mean = stats.mean - stats.mean[zero_index]  # baseline correct
+        event_averages[event_name] = y_mean[time_slice], stats.sem[time_slice], stats.count
+    _plot_event_averages(event_averages, grand_average.event_groups, tmin, tmax, color_dict,
+                         'Pupil Diameter (averaged left and right z-score), shades are SEM', title, gaze_behavior=gaze_behavior)
+
+
+def visualize_eeg_grand_average(grand_average, condition_name, tmin, tmax, color_dict, picks, title, out_dir=None, fig_size=(12.8, 7.2), is_plot_timeseries=True, is_plot_topo_map=True, gaze_behavior=None):
+    """
+    visualize_eeg_epochs from a GrandAverageAccumulator of mne.Epochs
+    """
+    plt.rcParams["figure.figsize"] = fig_size
+    info, epochs_tmin, _ = grand_average.epochs_meta[condition_name]
+    time_slice, _ = grand_average.time_indices(condition_name, tmin, tmax)
+    condition_stats = grand_average.stats.get(condition_name, dict())
+
+    if is_plot_timeseries:
+        for ch in picks:
+            ch_index = info.ch_names.index(ch)
+            event_averages = dict((event_name, (stats.mean[ch_index, time_slice], stats.sem[ch_index, time_slice], stats.count))
+                                  for event_name, stats in condition_stats.items())
+            _plot_event_averages(event_averages, grand_average.event_groups, tmin, tmax, color_dict,
+                                 'BioSemi Channel {0} (μV), shades are SEM'.format(ch), '{0} - Channel {1}'.format(title, ch),
+                                 gaze_behavior=gaze_behavior,
+                                 out_path=os.path.join(out_dir, '{0} - Channel {1}.png'.format(title, ch)) if out_dir else None)
+
+    # get the min and max for plotting the topomap
+    if is_plot_topo_map and len(condition_stats) > 0:
+        all_events_stats = RunningEpochStats()
+        [all_events_stats.merge(x) for x in condition_stats.values()]
+        vmax_EEG = np.max(all_events_stats.mean)
+        vmin_EEG = np.min(all_events_stats.mean)
+
+        for event_name, stats in condition_stats.items():
+            evoked = mne.EvokedArray(stats.mean, info, tmin=epochs_tmin, nave=stats.count, verbose=False)
+            evoked.plot_topomap(times=np.linspace(tmin, tmax, 6), size=3., title='{0} {1}'.format(event_name, title), time_unit='s', scalings=dict(eeg=1.), vmax=vmax_EEG, vmin=vmin_EEG)
+
+
 # def generate_condition_sequence(event_markers, event_marker_timestamps, data_array, data_timestamps, data_channel_names,
 #                                 session_log,
 #                                 item_codes,